@@ -1,4 +1,14 @@
 # E2EE.py - Secure Chat All-in-One with Background Image
+#
+# Scale-out: run several workers that share one broker, e.g.
+#   E2EE_BROKER=tcp://127.0.0.1:7070 E2EE_BROKER_HUB=1 E2EE_SECRET_KEY=... PORT=5000 python E2EE.py
+#   E2EE_BROKER=tcp://127.0.0.1:7070 E2EE_SECRET_KEY=... PORT=5001 python E2EE.py
+# behind a load balancer with sticky sessions. E2EE_BROKER=redis://... works
+# the same way when the `redis` package is installed.
+#
+# Engines: E2EE_ENGINE=eventlet | threading | asgi (default "auto": eventlet if
+# installed, else threading). "asgi" runs Socket.IO on asyncio under uvicorn
+# and needs the `uvicorn` and `asgiref` packages; `uvicorn E2EE:asgi_app` works too.
 
 # ===========================
 # Standard Library Imports
@@ -6,214 +16,3247 @@
 import os
 import sys
 import time
+import json
+import uuid
+import asyncio
+import queue
 import base64
-import random
+import mmap
+import io
+import gzip
+import zlib
+import hashlib
+import functools
+import heapq
+import bisect
+import struct
 import string
+import secrets
+import random
+import tempfile
 import socket
+import signal
 import threading
 import webbrowser
+from array import array
+from collections import OrderedDict, deque
+
+# ===========================
+# Engine: eventlet, threading or asgi
+# ===========================
+ENGINE = os.environ.get("E2EE_ENGINE", "auto")
+if ENGINE not in ("auto", "eventlet", "threading", "asgi"):
+    raise ValueError(f"Unsupported E2EE_ENGINE: {ENGINE}")
+ASYNC_MODE = "asgi" if ENGINE == "asgi" else "threading"
+if ENGINE in ("auto", "eventlet"):
+    try:
+        import eventlet  # type: ignore
+        eventlet.monkey_patch()
+        ASYNC_MODE = "eventlet"
+    except Exception:
+        # Fall back to threading if eventlet isn't present
+        if ENGINE == "eventlet":
+            raise
+
+# ===========================
+# Flask / SocketIO Imports
+# ===========================
+from flask import Flask, Response, request, redirect, url_for, session, send_file
+from flask_socketio import SocketIO
+from socketio import Manager, PubSubManager, AsyncManager, AsyncServer, ASGIApp
+from socketio.async_pubsub_manager import AsyncPubSubManager
+from engineio.packet import Packet as EioPacket, PING as EIO_PING
+from engineio.socket import Socket as EioSocket
+from engineio.async_socket import AsyncSocket as EioAsyncSocket
+from wsproto.extensions import PerMessageDeflate
+from wsproto.frame_protocol import CloseReason, Opcode
+
+# ===========================
+# Metrics
+# ===========================
+# Instruments are created once at import; recording a sample is a bisect and
+# two in-place adds, so they stay on in production. Updates are not locked:
+# under threading a rare lost increment is accepted in exchange for no contention.
+METRICS_ENABLED = os.environ.get("E2EE_METRICS", "1") not in ("", "0")
+
+class Counter:
+    __slots__ = ('name', 'help', 'value')
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+class Histogram:
+    """Fixed-bucket histogram; observe() allocates nothing beyond the float it is given."""
+
+    __slots__ = ('name', 'help', 'bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, name, help, bounds):
+        self.name = name
+        self.help = help
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)   # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, out):
+        out.append(f"# HELP {self.name} {self.help}")
+        out.append(f"# TYPE {self.name} histogram")
+        running = 0
+        for bound, n in zip(self.bounds, self.counts):
+            running += n
+            out.append(f'{self.name}_bucket{{le="{bound:g}"}} {running}')
+        out.append(f'{self.name}_bucket{{le="+Inf"}} {running + self.counts[-1]}')
+        out.append(f"{self.name}_sum {self.sum:.9g}")
+        out.append(f"{self.name}_count {self.count}")
+
+# 10us .. 2.5s, roughly x2.5 per step
+LATENCY_BUCKETS = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3,
+                   1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1.0, 2.5)
+# 100ns .. 100ms for lock wait/hold
+LOCK_BUCKETS = (1e-7, 2.5e-7, 5e-7, 1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5,
+                1e-4, 2.5e-4, 5e-4, 1e-3, 1e-2, 1e-1)
+
+ON_MESSAGE_SECONDS = Histogram("e2ee_on_message_seconds", "Time spent in the 'message' handler.", LATENCY_BUCKETS)
+ON_JOIN_SECONDS = Histogram("e2ee_on_join_seconds", "Time spent in the 'join' handler.", LATENCY_BUCKETS)
+LOCK_WAIT_SECONDS = Histogram("e2ee_store_lock_wait_seconds", "Time spent waiting for a room store lock.", LOCK_BUCKETS)
+LOCK_HOLD_SECONDS = Histogram("e2ee_store_lock_hold_seconds", "Time a room store lock was held.", LOCK_BUCKETS)
+SWEEP_SECONDS = Histogram("e2ee_expiry_sweep_seconds", "Duration of message expiry sweeps.", LATENCY_BUCKETS)
+MESSAGES_IN = Counter("e2ee_messages_in_total", "Chat messages accepted from clients.")
+BYTES_IN = Counter("e2ee_bytes_in_total", "Ciphertext bytes accepted from clients.")
+MESSAGES_OUT = Counter("e2ee_messages_out_total", "Chat messages delivered to client connections.")
+BYTES_OUT = Counter("e2ee_bytes_out_total", "Ciphertext bytes delivered to client connections.")
+
+def timed(histogram):
+    """Decorator recording the wrapped handler's wall time in `histogram`."""
+    def wrap(fn):
+        if not METRICS_ENABLED:
+            return fn
+        perf = time.perf_counter
+        def handler(*args, **kwargs):
+            started = perf()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                histogram.observe(perf() - started)
+        handler.__name__ = fn.__name__
+        handler.__doc__ = fn.__doc__
+        return handler
+    return wrap
+
+class TimedLock:
+    """threading.Lock that records wait and hold times; use only as a context manager."""
+
+    __slots__ = ('_lock', '_acquired')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._acquired = 0.0
+
+    def __enter__(self):
+        if self._lock.acquire(False):
+            # Uncontended: skip timing the wait
+            now = time.perf_counter()
+            LOCK_WAIT_SECONDS.observe(0.0)
+        else:
+            started = time.perf_counter()
+            self._lock.acquire()
+            now = time.perf_counter()
+            LOCK_WAIT_SECONDS.observe(now - started)
+        # Only the holder writes _acquired, so it is safe to keep on the lock
+        self._acquired = now
+        return self
+
+    def __exit__(self, *exc):
+        held = time.perf_counter() - self._acquired
+        self._lock.release()
+        LOCK_HOLD_SECONDS.observe(held)
+
+# ===========================
+# Flow Control
+# ===========================
+# Inbound: token buckets per socket and per username (rate in messages/sec, 0 disables).
+RATE_PER_SID = float(os.environ.get("E2EE_RATE_PER_SID", 5))
+BURST_PER_SID = float(os.environ.get("E2EE_BURST_PER_SID", 20))
+RATE_PER_USER = float(os.environ.get("E2EE_RATE_PER_USER", 10))
+BURST_PER_USER = float(os.environ.get("E2EE_BURST_PER_USER", 40))
+# What to do with a message over the limit: "drop" (sender gets 'rate_limited') or "disconnect"
+RATE_LIMIT_POLICY = os.environ.get("E2EE_RATE_LIMIT_POLICY", "drop")
+if RATE_LIMIT_POLICY not in ("drop", "disconnect"):
+    raise ValueError(f"Unsupported E2EE_RATE_LIMIT_POLICY: {RATE_LIMIT_POLICY}")
+# Outbound: packets a connection may have queued before it counts as a slow consumer (0 disables)
+OUTBOUND_LIMIT = int(os.environ.get("E2EE_OUTBOUND_LIMIT", 256))
+# "drop" skips the message for that socket (the client re-syncs on the seq gap),
+# "coalesce" skips messages until the socket drains, then sends one 'resync',
+# "disconnect" closes it
+SLOW_CONSUMER_POLICY = os.environ.get("E2EE_SLOW_CONSUMER_POLICY", "coalesce")
+if SLOW_CONSUMER_POLICY not in ("drop", "coalesce", "disconnect"):
+    raise ValueError(f"Unsupported E2EE_SLOW_CONSUMER_POLICY: {SLOW_CONSUMER_POLICY}")
+
+FLOW_STATS = {
+    'rate_drop': 0,
+    'rate_disconnect': 0,
+    'slow_drop': 0,
+    'slow_coalesce': 0,
+    'slow_disconnect': 0,
+    'resync_sent': 0,
+}
+
+class TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+
+    def take(self, now=None):
+        """Spend one token; returns False when the bucket is empty."""
+        if now is None:
+            now = time.monotonic()
+        tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if tokens < 1.0:
+            self.tokens = tokens
+            return False
+        self.tokens = tokens - 1.0
+        return True
+
+SID_BUCKETS = {}    # socket sid: TokenBucket
+USER_BUCKETS = {}   # username: TokenBucket, while the user has a socket on this worker
+
+def allow_message(sid, user):
+    """Charge one message to the socket and the user; False if either is over its rate."""
+    now = time.monotonic()
+    if RATE_PER_SID:
+        bucket = SID_BUCKETS.get(sid)
+        if bucket is None:
+            bucket = SID_BUCKETS[sid] = TokenBucket(RATE_PER_SID, BURST_PER_SID)
+        if not bucket.take(now):
+            return False
+    if RATE_PER_USER:
+        bucket = USER_BUCKETS.get(user)
+        if bucket is None:
+            bucket = USER_BUCKETS[user] = TokenBucket(RATE_PER_USER, BURST_PER_USER)
+        if not bucket.take(now):
+            return False
+    return True
+
+def _chat_payload(event, data):
+    """Return (messages, ciphertext bytes) carried by a 'message'/'messages' event."""
+    if event == 'message' and data.get('system'):
+        return 0, 0
+    items = data['messages'] if event == 'messages' else (data,)
+    size = 0
+    for item in items:
+        size += len(item.get('bin') or item.get('msg') or '')
+    return len(items), size
+
+class FlowControl:
+    """Client manager mixin that bounds each connection's outbound queue.
+
+    Before a chat broadcast is written to a room, members whose Engine.IO
+    send queue already holds OUTBOUND_LIMIT packets are handled according
+    to SLOW_CONSUMER_POLICY instead of being handed another packet. It is
+    also where outbound message/byte counters are taken. The sync and
+    asyncio managers below only differ in awaiting the writes.
+    """
+
+    flow_events = ('message', 'messages')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.behind = set()   # sids that skipped messages under "coalesce"
+
+    def _split(self, namespace, room, data):
+        """Yield (room, data) to deliver here; a mixed_room() broadcast only goes to
+        sub-rooms this worker has members in, and is base64-encoded only for text ones."""
+        if not room.startswith(MIXED_PREFIX):
+            yield room, data
+            return
+        room = room[len(MIXED_PREFIX):]
+        rooms = self.rooms.get(namespace, {})
+        if rooms.get(binary_room(room)):
+            yield binary_room(room), data
+        if rooms.get(text_room(room)):
+            yield text_room(room), text_copy(data)
+
+    def _queued(self, eio_sid):
+        sock = self.server.eio.sockets.get(eio_sid)
+        return sock.queue.qsize() if sock is not None else 0
+
+    def _plan(self, namespace, room, skip_sid):
+        """Returns (sids to skip, slow sids, sids owed a 'resync', members delivered to)."""
+        skip = list(skip_sid) if isinstance(skip_sid, list) else [skip_sid]
+        slow, resync = [], []
+        delivered = 0
+        for sid, eio_sid in self.get_participants(namespace, room):
+            if sid in skip:
+                continue
+            if OUTBOUND_LIMIT:
+                queued = self._queued(eio_sid)
+                if queued >= OUTBOUND_LIMIT:
+                    slow.append(sid)
+                    skip.append(sid)
+                    continue
+                if sid in self.behind:
+                    if queued > OUTBOUND_LIMIT // 2:
+                        skip.append(sid)
+                        continue
+                    # Drained: one 'resync' replaces everything it missed
+                    self.behind.discard(sid)
+                    FLOW_STATS['resync_sent'] += 1
+                    resync.append(sid)
+            delivered += 1
+        return skip, slow, resync, delivered
+
+    def _settle(self, event, data, slow, delivered):
+        """Count the delivery and apply the slow-consumer policy; returns sids to disconnect."""
+        if delivered and METRICS_ENABLED:
+            count, size = _chat_payload(event, data)
+            MESSAGES_OUT.inc(count * delivered)
+            BYTES_OUT.inc(size * delivered)
+        doomed = []
+        for sid in slow:
+            if SLOW_CONSUMER_POLICY == "disconnect":
+                FLOW_STATS['slow_disconnect'] += 1
+                doomed.append(sid)
+            elif SLOW_CONSUMER_POLICY == "coalesce":
+                FLOW_STATS['slow_coalesce'] += 1
+                self.behind.add(sid)
+            else:
+                FLOW_STATS['slow_drop'] += 1
+        return doomed
+
+class FlowControlManager(FlowControl, Manager):
+    def emit(self, event, data, namespace, room=None, skip_sid=None, callback=None, to=None, **kwargs):
+        room = to or room
+        if event not in self.flow_events or room is None or callback:
+            return super().emit(event, data, namespace, room=room, skip_sid=skip_sid, callback=callback, **kwargs)
+        for room, data in self._split(namespace, room, data):
+            self._emit_local(event, data, namespace, room, skip_sid, **kwargs)
+
+    def _emit_local(self, event, data, namespace, room, skip_sid, **kwargs):
+        skip, slow, resync, delivered = self._plan(namespace, room, skip_sid)
+        for sid in resync:
+            super().emit('resync', {}, namespace, room=sid)
+        super().emit(event, data, namespace, room=room, skip_sid=skip, **kwargs)
+        for sid in self._settle(event, data, slow, delivered):
+            self.server.disconnect(sid, namespace=namespace)
+
+    def disconnect(self, sid, namespace, **kwargs):
+        self.behind.discard(sid)
+        return super().disconnect(sid, namespace, **kwargs)
+
+class AsyncFlowControlManager(FlowControl, AsyncManager):
+    async def emit(self, event, data, namespace, room=None, skip_sid=None, callback=None, to=None, **kwargs):
+        room = to or room
+        if event not in self.flow_events or room is None or callback:
+            return await super().emit(event, data, namespace, room=room, skip_sid=skip_sid, callback=callback, **kwargs)
+        for room, data in self._split(namespace, room, data):
+            await self._emit_local(event, data, namespace, room, skip_sid, **kwargs)
+
+    async def _emit_local(self, event, data, namespace, room, skip_sid, **kwargs):
+        skip, slow, resync, delivered = self._plan(namespace, room, skip_sid)
+        for sid in resync:
+            await super().emit('resync', {}, namespace, room=sid)
+        await super().emit(event, data, namespace, room=room, skip_sid=skip, **kwargs)
+        for sid in self._settle(event, data, slow, delivered):
+            await self.server.disconnect(sid, namespace=namespace)
+
+    async def disconnect(self, sid, namespace, **kwargs):
+        self.behind.discard(sid)
+        return await super().disconnect(sid, namespace, **kwargs)
+
+# ===========================
+# Message Broker
+# ===========================
+# Every worker publishes state changes and Socket.IO broadcasts to the broker,
+# which delivers each message to every subscriber (the publisher included) in
+# one global order. Applying state changes in that order keeps ROOMS,
+# MESSAGES, seqs and BLOCKED_USERS identical on all workers.
+BROKER_URL = os.environ.get("E2EE_BROKER", "local")
+# Set on exactly one worker to host the tcp:// hub in-process
+BROKER_HUB = os.environ.get("E2EE_BROKER_HUB", "") not in ("", "0")
+# While the broker is unreachable, publishes are queued (up to this many) and
+# sent once it reconnects; past that they fail and /healthz reports 503
+BROKER_PENDING_MAX = max(1, int(os.environ.get("E2EE_BROKER_PENDING_MAX", 10000)))
+BROKER_RETRY_MAX = 5.0   # cap on the reconnect backoff, seconds
+# A worker starting next to running ones copies the store from one of them
+# before it serves; it waits this long for an answer (none: it is the first)
+BOOTSTRAP_TIMEOUT = max(0.0, float(os.environ.get("E2EE_BOOTSTRAP_TIMEOUT", 10)))
+WORKER_ID = uuid.uuid4().hex
+
+class BrokerUnavailable(ConnectionError):
+    """The broker is down and this worker's outbound queue is full."""
+
+def _json_default(value):
+    if isinstance(value, (bytes, bytearray)):
+        return {'$b64': base64.b64encode(value).decode('ascii')}
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+def _json_object(obj):
+    if len(obj) == 1 and '$b64' in obj:
+        return base64.b64decode(obj['$b64'])
+    return obj
+
+def broker_dumps(message):
+    """JSON-encode a broker message; binary ciphertext travels as {'$b64': ...}."""
+    return json.dumps(message, separators=(',', ':'), default=_json_default)
+
+def broker_loads(data):
+    return json.loads(data, object_hook=_json_object)
+
+class LocalBroker:
+    """Single-process broker: publish() runs the subscribers inline."""
+
+    def __init__(self):
+        self._subs = {}
+
+    def subscribe(self, channel, callback):
+        self._subs.setdefault(channel, []).append(callback)
+
+    def publish(self, channel, message):
+        for callback in self._subs.get(channel, ()):
+            callback(message)
+
+    def start(self):
+        pass
+
+    @property
+    def connected(self):
+        return True
+
+class BrokerHub:
+    """Minimal pub/sub relay on a local TCP socket for SocketBroker clients.
+
+    Frames are newline-delimited JSON. Each frame is relayed to every
+    connection, sender included, while holding one lock, which gives all
+    workers the same delivery order.
+    """
+
+    def __init__(self, host, port):
+        self._server = socket.create_server((host, port))
+        self._clients = []
+        self._lock = threading.Lock()
+
+    def serve_forever(self):
+        while True:
+            conn, _ = self._server.accept()
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with self._lock:
+                self._clients.append(conn)
+            threading.Thread(target=self._relay, args=(conn,), daemon=True).start()
+
+    def _relay(self, conn):
+        try:
+            for line in conn.makefile('rb'):
+                with self._lock:
+                    for client in list(self._clients):
+                        try:
+                            client.sendall(line)
+                        except OSError:
+                            self._clients.remove(client)
+        except OSError:
+            pass
+        with self._lock:
+            if conn in self._clients:
+                self._clients.remove(conn)
+        conn.close()
+
+class SocketBroker:
+    """Broker client for a BrokerHub reachable at tcp://host:port.
+
+    Frames carry this worker's id and a counter. A frame stays pending until
+    the hub relays it back, and pending frames are sent again after a
+    reconnect, so a publish made as the hub went down is not lost; receivers
+    skip counters they have already seen from that worker.
+    """
+
+    def __init__(self, host, port):
+        self._addr = (host, port)
+        self._subs = {}
+        self._sock = None
+        self._write_lock = threading.Lock()
+        self._pending = deque()   # (counter, frame) published but not yet relayed back
+        self._counter = 0
+        self._seen = {}           # origin worker: highest counter applied
+        self.stats = {'reconnects': 0, 'resent': 0, 'duplicates': 0}
+        try:
+            self._connect()
+        except OSError:
+            pass   # the reader keeps retrying once started
+
+    @property
+    def connected(self):
+        return self._sock is not None
+
+    def _connect(self):
+        sock = socket.create_connection(self._addr)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with self._write_lock:
+            for _, frame in self._pending:
+                sock.sendall(frame)
+            self.stats['resent'] += len(self._pending)
+            self._sock = sock
+        return sock
+
+    def _disconnect(self, sock):
+        with self._write_lock:
+            if self._sock is sock:
+                self._sock = None
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        sock.close()
+
+    def subscribe(self, channel, callback):
+        self._subs.setdefault(channel, []).append(callback)
+
+    def publish(self, channel, message):
+        with self._write_lock:
+            if self._sock is None and len(self._pending) >= BROKER_PENDING_MAX:
+                raise BrokerUnavailable(f"broker at {self._addr[0]}:{self._addr[1]} is unreachable")
+            self._counter += 1
+            frame = broker_dumps({'c': channel, 'm': message, 'o': WORKER_ID, 'n': self._counter}).encode() + b'\n'
+            self._pending.append((self._counter, frame))
+            sock = self._sock
+            if sock is None:
+                return   # sent on reconnect
+            try:
+                sock.sendall(frame)
+                return
+            except OSError:
+                pass
+        self._disconnect(sock)
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        delay = 0.1
+        while True:
+            sock = self._sock
+            if sock is None:
+                try:
+                    sock = self._connect()
+                except OSError:
+                    time.sleep(delay)
+                    delay = min(BROKER_RETRY_MAX, delay * 2)
+                    continue
+                self.stats['reconnects'] += 1
+                print("[*] Reconnected to broker.")
+            delay = 0.1
+            self._read(sock)
+            self._disconnect(sock)
+            print("[!] Lost connection to broker; reconnecting.")
+
+    def _read(self, sock):
+        try:
+            for line in sock.makefile('rb'):
+                frame = broker_loads(line)
+                origin, n = frame.get('o'), frame.get('n', 0)
+                if origin == WORKER_ID:
+                    with self._write_lock:
+                        while self._pending and self._pending[0][0] <= n:
+                            self._pending.popleft()
+                if n <= self._seen.get(origin, 0):
+                    self.stats['duplicates'] += 1
+                    continue
+                self._seen[origin] = n
+                for callback in self._subs.get(frame['c'], ()):
+                    try:
+                        callback(frame['m'])
+                    except Exception as e:
+                        print(f"[!] Broker handler failed on {frame['c']}: {e!r}")
+        except (OSError, ValueError):
+            pass
+
+class RedisBroker:
+    """Broker over Redis pub/sub (optional `redis` dependency)."""
+
+    def __init__(self, url):
+        import redis  # type: ignore
+        self._redis = redis.Redis.from_url(url)
+        self._subs = {}
+        self.connected = True
+
+    def subscribe(self, channel, callback):
+        self._subs.setdefault(channel, []).append(callback)
+
+    def publish(self, channel, message):
+        try:
+            self._redis.publish(f"e2ee:{channel}", broker_dumps(message))
+        except Exception as e:
+            self.connected = False
+            raise BrokerUnavailable(str(e)) from e
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        delay = 0.1
+        while True:
+            try:
+                pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(*(f"e2ee:{channel}" for channel in self._subs))
+                self.connected = True
+                delay = 0.1
+                self._read(pubsub)
+            except Exception as e:
+                self.connected = False
+                print(f"[!] Lost connection to broker ({e!r}); reconnecting.")
+                time.sleep(delay)
+                delay = min(BROKER_RETRY_MAX, delay * 2)
+
+    def _read(self, pubsub):
+        for item in pubsub.listen():
+            channel = item['channel'].decode().split(':', 1)[1]
+            message = broker_loads(item['data'])
+            for callback in self._subs.get(channel, ()):
+                try:
+                    callback(message)
+                except Exception as e:
+                    print(f"[!] Broker handler failed on {channel}: {e!r}")
+
+class BrokerManager(PubSubManager, FlowControlManager):
+    """python-socketio client manager that fans room broadcasts out through BROKER.
+
+    Local delivery (PubSubManager's super().emit) goes through FlowControlManager.
+    """
+
+    name = 'e2ee-broker'
+
+    def __init__(self, broker, channel='socketio'):
+        super().__init__(channel=channel)
+        self.broker = broker
+        self._inbox = queue.Queue()
+        broker.subscribe(channel, self._inbox.put)
+
+    def _publish(self, data):
+        try:
+            self.broker.publish(self.channel, data)
+        except BrokerUnavailable as e:
+            print(f"[!] Broadcast dropped: {e}")
+
+    def _listen(self):
+        while True:
+            yield self._inbox.get()
+
+class AsyncBrokerManager(AsyncPubSubManager, AsyncFlowControlManager):
+    """BrokerManager for the asgi engine; broker threads hand messages to the loop.
+
+    The channel is subscribed here, before BROKER.start() (a Redis broker only
+    subscribes to the channels it has then). Until _listen() runs, on the
+    first connection, nobody here could receive a broadcast, so they are dropped.
+    """
+
+    name = 'e2ee-broker'
+
+    def __init__(self, broker, channel='socketio'):
+        super().__init__(channel=channel)
+        self.broker = broker
+        self._loop = None
+        self._inbox = None
+        broker.subscribe(channel, self._deliver)
+
+    def _deliver(self, message):
+        loop, inbox = self._loop, self._inbox
+        if loop is not None:
+            loop.call_soon_threadsafe(inbox.put_nowait, message)
+
+    async def _publish(self, data):
+        try:
+            self.broker.publish(self.channel, data)
+        except BrokerUnavailable as e:
+            print(f"[!] Broadcast dropped: {e}")
+
+    async def _listen(self):
+        self._inbox = asyncio.Queue()
+        self._loop = asyncio.get_running_loop()
+        while True:
+            yield await self._inbox.get()
+
+def make_broker(url):
+    if url in ("", "local"):
+        return LocalBroker()
+    if url.startswith("tcp://"):
+        host, _, port = url[len("tcp://"):].rpartition(':')
+        if BROKER_HUB:
+            hub = BrokerHub(host, int(port))
+            threading.Thread(target=hub.serve_forever, daemon=True).start()
+        return SocketBroker(host, int(port))
+    if url.startswith(("redis://", "rediss://")):
+        return RedisBroker(url)
+    raise ValueError(f"Unsupported E2EE_BROKER: {url}")
+
+BROKER = make_broker(BROKER_URL)
+
+# ===========================
+# Flask App & SocketIO Setup
+# ===========================
+app = Flask(__name__)
+# Workers behind one broker must share the session key
+app.secret_key = os.environ.get("E2EE_SECRET_KEY", "").encode() or os.urandom(32)
+
+# Largest accepted ciphertext, in bytes; Engine.IO rejects bigger packets before buffering them
+MAX_PAYLOAD_BYTES = max(1, int(os.environ.get("E2EE_MAX_PAYLOAD_BYTES", 64 * 1024)))
+
+# Largest inbound WebSocket message / polling body: the payload plus room for
+# the event name and JSON framing. Enforced by every engine before buffering.
+MAX_MESSAGE_BYTES = MAX_PAYLOAD_BYTES + 4096
+
+# Compression: permessage-deflate on WebSockets (when the client offers it, as
+# browsers do) and gzip on long-polling responses. Messages shorter than the
+# threshold (pings, acks, short lines) are sent as they are. Window bits
+# (9-15) and memLevel (1-9) bound the zlib state each connection keeps, about
+# 2**(bits+2) + 2**(mem_level+9) bytes to compress plus 2**bits to inflate;
+# zlib's defaults (15, 8) cost over 256 KiB per connection.
+COMPRESSION = os.environ.get("E2EE_COMPRESSION", "1") not in ("", "0")
+COMPRESSION_THRESHOLD = max(0, int(os.environ.get("E2EE_COMPRESSION_THRESHOLD", 256)))
+COMPRESSION_LEVEL = min(9, max(1, int(os.environ.get("E2EE_COMPRESSION_LEVEL", 6))))
+WS_WINDOW_BITS = min(15, max(9, int(os.environ.get("E2EE_WS_WINDOW_BITS", 11))))
+WS_MEM_LEVEL = min(9, max(1, int(os.environ.get("E2EE_WS_MEM_LEVEL", 4))))
+
+# Heartbeat: clients are told PING_INTERVAL and PING_TIMEOUT at handshake. A
+# connection that sent nothing since its last ping is pinged PING_BACKOFF
+# times less often each round, up to PING_IDLE_INTERVAL; that is kept under
+# PING_INTERVAL + PING_TIMEOUT, after which the client gives up on the server.
+PING_INTERVAL = max(1.0, float(os.environ.get("E2EE_PING_INTERVAL", 25)))
+PING_TIMEOUT = max(1.0, float(os.environ.get("E2EE_PING_TIMEOUT", 60)))
+PING_IDLE_INTERVAL = min(PING_INTERVAL + 0.75 * PING_TIMEOUT,
+                         max(PING_INTERVAL, float(os.environ.get("E2EE_PING_IDLE_INTERVAL", PING_INTERVAL + PING_TIMEOUT / 2))))
+PING_BACKOFF = 1.5
+
+SOCKETIO_OPTIONS = dict(
+    cors_allowed_origins="*",
+    ping_interval=PING_INTERVAL,
+    ping_timeout=PING_TIMEOUT,
+    max_http_buffer_size=MAX_MESSAGE_BYTES,
+    http_compression=COMPRESSION,
+    compression_threshold=COMPRESSION_THRESHOLD,
+)
+LOOP = None   # event loop serving SIO under the asgi engine
+
+if ASYNC_MODE == "asgi":
+    from asgiref.wsgi import WsgiToAsgi  # type: ignore
+
+    socketio = None
+    SIO = AsyncServer(
+        async_mode="asgi",
+        client_manager=AsyncFlowControlManager() if isinstance(BROKER, LocalBroker) else AsyncBrokerManager(BROKER),
+        **SOCKETIO_OPTIONS,
+    )
+
+    async def _bind_loop():
+        global LOOP
+        LOOP = asyncio.get_running_loop()
+
+    # Socket.IO on asyncio; the Flask pages run in asgiref's thread pool
+    asgi_app = ASGIApp(SIO, other_asgi_app=WsgiToAsgi(app), on_startup=_bind_loop)
+else:
+    socketio = SocketIO(
+        app,
+        async_mode=ASYNC_MODE,
+        client_manager=FlowControlManager() if isinstance(BROKER, LocalBroker) else BrokerManager(BROKER),
+        **SOCKETIO_OPTIONS,
+    )
+    SIO = socketio.server
+
+# Engine-neutral socket operations, callable from handlers and background threads
+def _on_loop(coro):
+    if LOOP is None:
+        coro.close()   # not serving yet, so nobody to send to
+        return
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if running is LOOP:
+        LOOP.create_task(coro)
+    else:
+        asyncio.run_coroutine_threadsafe(coro, LOOP)
+
+def push(event, data, to):
+    """Emit `event` to a room or sid."""
+    if socketio is not None:
+        socketio.emit(event, data, to=to)
+    else:
+        _on_loop(SIO.emit(event, data, to=to))
+
+def drop(sid):
+    """Disconnect a socket held by this worker."""
+    if socketio is not None:
+        SIO.disconnect(sid)
+    else:
+        _on_loop(SIO.disconnect(sid))
+
+def enter(sid, room):
+    SIO.manager.basic_enter_room(sid, '/', room)
+
+def leave(sid, room):
+    SIO.manager.basic_leave_room(sid, '/', room)
+
+# ===========================
+# Transport Tuning
+# ===========================
+# Compression and frame limits are applied where each engine builds its
+# WebSockets: eventlet's RFC6455WebSocket, and wsproto's PerMessageDeflate
+# under simple-websocket (threading) and uvicorn (asgi, run with ws="wsproto").
+# Pings are paced per connection by taking over each Engine.IO socket's ping
+# task when it connects.
+# These hooks reach into private parts of python-engineio, eventlet,
+# simple-websocket and wsproto (versions tested are pinned in
+# requirements.txt). Each is installed only if the names it relies on are
+# there; otherwise that library's stock behaviour is kept.
+TRANSPORT_STATS = {'compressed': 0, 'uncompressed': 0, 'raw_bytes': 0, 'wire_bytes': 0,
+                   'pings': 0, 'idle_pings': 0}
+TRANSPORT_HOOKS = set()   # hooks installed: 'compression', 'frame_limit', 'pings'
+
+def _has(obj, *names):
+    return all(hasattr(obj, name) for name in names)
+
+def _untuned(what, hook):
+    print(f"[!] {what} does not look like the tested version; {hook} tuning is off")
+
+def _deflater(bits):
+    return zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, -min(WS_WINDOW_BITS, bits), WS_MEM_LEVEL)
+
+def _count_frame(compressed, raw, wire):
+    TRANSPORT_STATS['compressed' if compressed else 'uncompressed'] += 1
+    TRANSPORT_STATS['raw_bytes'] += raw
+    TRANSPORT_STATS['wire_bytes'] += wire
+
+class TunedPerMessageDeflate(PerMessageDeflate):
+    """wsproto permessage-deflate with the size threshold, small zlib state and capped inflation."""
+
+    def __init__(self):
+        # Asks clients that allow it to compress with a small window too
+        super().__init__(client_max_window_bits=WS_WINDOW_BITS)
+        self._raw_message = False
+
+    def accept(self, offer):
+        return super().accept(offer) if COMPRESSION else None
+
+    def frame_outbound(self, proto, opcode, rsv, data, fin):
+        if not self._compressible_opcode(opcode):
+            return rsv, data
+        if opcode is not Opcode.CONTINUATION:
+            self._raw_message = len(data) < COMPRESSION_THRESHOLD
+        if self._raw_message:
+            _count_frame(False, len(data), len(data))
+            return rsv, data
+        if self._compressor is None:
+            self._compressor = _deflater(self.server_max_window_bits)
+        out = super().frame_outbound(proto, opcode, rsv, data, fin)
+        _count_frame(True, len(data), len(out[1]))
+        return out
+
+    def frame_inbound_payload_data(self, proto, data):
+        if not self._inbound_compressed or not self._inbound_is_compressible:
+            return data
+        # A few KiB can inflate to gigabytes; stop one byte past the limit
+        try:
+            out = self._decompressor.decompress(bytes(data), MAX_MESSAGE_BYTES + 1)
+        except zlib.error:
+            return CloseReason.INVALID_FRAME_PAYLOAD_DATA
+        if self._decompressor.unconsumed_tail:
+            return CloseReason.MESSAGE_TOO_BIG
+        return out
+
+WSPROTO_TUNABLE = _has(PerMessageDeflate(), '_compressor', '_decompressor', '_inbound_compressed',
+                       '_inbound_is_compressible', '_compressible_opcode')
+# Engine.IO picks its WebSocket class from this per-server table
+EIO_WEBSOCKET = isinstance(getattr(SIO.eio, '_async', None), dict) and 'websocket' in SIO.eio._async
+
+if ASYNC_MODE == "eventlet":
+    from eventlet.websocket import RFC6455WebSocket
+    from engineio.async_drivers.eventlet import WebSocketWSGI as EventletWebSocketWSGI
+
+    class TunedRFC6455WebSocket(RFC6455WebSocket):
+        _raw_message = False
+
+        def _pack_message(self, message, masked=False, continuation=False, final=True, control_code=None):
+            self._raw_message = (control_code is not None or len(message) < COMPRESSION_THRESHOLD
+                                 or "permessage-deflate" not in self.extensions)
+            frame = super()._pack_message(message, masked, continuation, final, control_code)
+            if control_code is None:
+                _count_frame(not self._raw_message, len(message), len(frame))
+            return frame
+
+        def _get_permessage_deflate_enc(self):
+            options = self.extensions.get("permessage-deflate")
+            if options is None or self._raw_message:
+                return None
+            bits = options.get("server_max_window_bits", 15)
+            if options.get("server_no_context_takeover"):
+                return _deflater(bits)
+            if self._deflate_enc is None:
+                self._deflate_enc = _deflater(bits)
+            return self._deflate_enc
+
+    class TunedWebSocketWSGI(EventletWebSocketWSGI):
+        def _negotiate_permessage_deflate(self, extensions):
+            if not COMPRESSION:
+                return None
+            config = super()._negotiate_permessage_deflate(extensions)
+            # The server may lower the client's window when the client names one
+            if config is not None and "client_max_window_bits" in config:
+                config["client_max_window_bits"] = min(config["client_max_window_bits"], WS_WINDOW_BITS)
+            return config
+
+        def _handle_hybi_request(self, environ):
+            ws = super()._handle_hybi_request(environ)
+            ws.__class__ = TunedRFC6455WebSocket
+            return ws
+
+    if (EIO_WEBSOCKET and _has(RFC6455WebSocket, '_pack_message', '_get_permessage_deflate_enc')
+            and _has(EventletWebSocketWSGI, '_negotiate_permessage_deflate', '_handle_hybi_request')):
+        SIO.eio._async = dict(SIO.eio._async, websocket=TunedWebSocketWSGI)
+        TRANSPORT_HOOKS.add('compression')
+    else:
+        _untuned("eventlet.websocket", "compression")
+elif ASYNC_MODE == "threading":
+    import simple_websocket.ws
+    from engineio.async_drivers._websocket_wsgi import SimpleWebSocketWSGI
+
+    class LimitedSimpleWebSocketWSGI(SimpleWebSocketWSGI):
+        def __init__(self, handler, server):
+            super().__init__(handler, server, max_message_size=MAX_MESSAGE_BYTES)
+
+    # simple-websocket builds a PerMessageDeflate() for every handshake
+    if WSPROTO_TUNABLE and hasattr(simple_websocket.ws, 'PerMessageDeflate'):
+        simple_websocket.ws.PerMessageDeflate = TunedPerMessageDeflate
+        TRANSPORT_HOOKS.add('compression')
+    else:
+        _untuned("simple-websocket/wsproto", "compression")
+    if EIO_WEBSOCKET:
+        SIO.eio._async = dict(SIO.eio._async, websocket=LimitedSimpleWebSocketWSGI)
+        TRANSPORT_HOOKS.add('frame_limit')
+    else:
+        _untuned("python-engineio", "frame limit")
+else:
+    try:
+        import uvicorn.protocols.websockets.wsproto_impl as uvicorn_wsproto  # type: ignore
+    except ImportError:
+        uvicorn_wsproto = None
+    if uvicorn_wsproto is not None:
+        if WSPROTO_TUNABLE and hasattr(uvicorn_wsproto, 'PerMessageDeflate'):
+            uvicorn_wsproto.PerMessageDeflate = TunedPerMessageDeflate
+            TRANSPORT_HOOKS.add('compression')
+        else:
+            _untuned("uvicorn/wsproto", "compression")
+
+def _ping_delay(sock):
+    """PING_INTERVAL after a round with client traffic, else back off toward PING_IDLE_INTERVAL."""
+    if sock.e2ee_active:
+        sock.e2ee_active = False
+        sock.e2ee_delay = PING_INTERVAL
+    else:
+        sock.e2ee_delay = min(PING_IDLE_INTERVAL, sock.e2ee_delay * PING_BACKOFF)
+        TRANSPORT_STATS['idle_pings'] += 1
+    TRANSPORT_STATS['pings'] += 1
+    return sock.e2ee_delay
+
+# Stand-ins for Engine.IO's Socket._send_ping with a per-connection delay
+def _paced_ping(sock):
+    sock.server.sleep(_ping_delay(sock))
+    if not sock.closing and not sock.closed:
+        sock.last_ping = time.time()
+        sock.send(EioPacket(EIO_PING))
+
+async def _paced_ping_async(sock):
+    await asyncio.sleep(_ping_delay(sock))
+    if not sock.closing and not sock.closed:
+        sock.last_ping = time.time()
+        await sock.send(EioPacket(EIO_PING))
+
+if _has(EioAsyncSocket if socketio is None else EioSocket, '_send_ping'):
+    TRANSPORT_HOOKS.add('pings')
+else:
+    _untuned("python-engineio", "ping")
+
+def _eio_socket(sid):
+    return SIO.eio.sockets.get(SIO.manager.eio_sid_from_sid(sid, '/'))
+
+def pace_pings(sid):
+    """Take over the ping task of the Engine.IO socket behind `sid` (from its next round)."""
+    sock = _eio_socket(sid)
+    if sock is None or 'pings' not in TRANSPORT_HOOKS:
+        return
+    sock.e2ee_active = True
+    sock.e2ee_delay = PING_INTERVAL
+    sock._send_ping = functools.partial(_paced_ping_async if socketio is None else _paced_ping, sock)
+
+def mark_active(sid):
+    sock = _eio_socket(sid)
+    if sock is not None:
+        sock.e2ee_active = True
+
+# ===========================
+# In-memory storage
+# ===========================
+ROOMS = {}          # room_code: {username: open sockets in the room}
+MESSAGES = {}       # room_code: RoomLog (columnar, oldest first)
+ACKS = {}           # room_code: {username: highest seq the user acknowledged}
+LAST_ACTIVE = {}    # room_code: time of the last open/join/leave/message
+USER_ROOMS = {}     # username: {room_code, ...} where the user has an open socket
+SIDS = {}           # socket sid on this worker: (username, room_code)
+USER_SIDS = {}      # username: {sid, ...} on this worker
+PRESENCE_LOCK = threading.Lock()   # guards USER_ROOMS, SIDS, USER_SIDS; taken after a room lock
+BLOCKED_USERS = frozenset()   # swapped wholesale on change; readers never lock
+BLOCK_LOCK = threading.Lock()  # serialises writers of BLOCKED_USERS
+
+# Per-room state is guarded by one of LOCK_STRIPES locks picked by hash(room),
+# so unrelated rooms rarely contend. Never hold two stripe locks at once.
+LOCK_STRIPES = max(1, int(os.environ.get("E2EE_LOCK_STRIPES", 64)))
+ROOM_LOCKS = [TimedLock() if METRICS_ENABLED else threading.Lock() for _ in range(LOCK_STRIPES)]
+
+# Messages older than this many seconds are purged (precise to the sweep, not to a fixed tick)
+MESSAGE_TTL = float(os.environ.get("E2EE_MESSAGE_TTL", 600))
+# Upper bound on how long the expiry thread sleeps when nothing is due
+EXPIRY_MAX_SLEEP = float(os.environ.get("E2EE_EXPIRY_MAX_SLEEP", 60))
+# Print one line per sweep that expired something (off by default)
+EXPIRY_LOG = os.environ.get("E2EE_EXPIRY_LOG", "") not in ("", "0")
+# Broadcasts to a room arriving within this window are sent as one 'messages'
+# event by a dispatcher thread; 0 emits every message inline from on_message
+BATCH_WINDOW_MS = max(0.0, float(os.environ.get("E2EE_BATCH_WINDOW_MS", 0)))
+# Optional persistence: directory for the append-only message log (empty keeps
+# everything in memory). Each worker needs its own directory.
+DATA_DIR = os.environ.get("E2EE_DATA_DIR", "")
+LOG_SHARDS = max(1, int(os.environ.get("E2EE_LOG_SHARDS", 4)))
+# A segment is closed when full or this old, and deleted once its newest record passes the TTL
+SEGMENT_BYTES = max(1 << 16, int(os.environ.get("E2EE_SEGMENT_BYTES", 16 << 20)))
+SEGMENT_SECONDS = max(1.0, float(os.environ.get("E2EE_SEGMENT_SECONDS", 60)))
+# Group commit: dirty segments are msync'ed together at most this often
+FSYNC_INTERVAL_MS = max(1.0, float(os.environ.get("E2EE_FSYNC_INTERVAL_MS", 50)))
+# Rooms with no members are deleted (with their messages) after this many idle seconds
+ROOM_IDLE_SECONDS = max(1.0, float(os.environ.get("E2EE_ROOM_IDLE_SECONDS", 600)))
+# Cap on stored ciphertext across all rooms; least-recently-active rooms are evicted past it
+MEMORY_BUDGET_BYTES = max(1 << 20, int(os.environ.get("E2EE_MEMORY_BUDGET_BYTES", 256 << 20)))
+# Cap per room; a room over it loses its oldest messages
+ROOM_MAX_BYTES = max(1 << 16, min(MEMORY_BUDGET_BYTES, int(os.environ.get("E2EE_ROOM_MAX_BYTES", 16 << 20))))
+# Maximum number of stored messages returned per 'history' page
+HISTORY_PAGE_SIZE = max(1, int(os.environ.get("E2EE_HISTORY_PAGE_SIZE", 100)))
+# Room codes: length and alphabet (ASCII). A guess hits a live room with odds
+# live rooms / len(alphabet) ** length, so lengthen codes as rooms grow
+ROOM_ID_LENGTH = max(4, int(os.environ.get("E2EE_ROOM_ID_LENGTH", 6)))
+ROOM_ID_ALPHABET = os.environ.get("E2EE_ROOM_ID_ALPHABET", string.ascii_uppercase + string.digits)
+# Codes kept pre-generated so allocation never waits on generation
+ROOM_ID_POOL = max(16, int(os.environ.get("E2EE_ROOM_ID_POOL", 4096)))
+# Attachments: spool directory (shared by workers on one host; kept under
+# E2EE_DATA_DIR when that is set), upload chunk size, and size caps per file
+# and for everything spooled at once
+ATTACH_DIR = os.environ.get("E2EE_ATTACH_DIR", "") or os.path.join(DATA_DIR or tempfile.gettempdir(), "e2ee-attachments")
+ATTACH_CHUNK_BYTES = max(1 << 12, int(os.environ.get("E2EE_ATTACH_CHUNK_BYTES", 1 << 20)))
+ATTACH_MAX_BYTES = max(1, int(os.environ.get("E2EE_ATTACH_MAX_BYTES", 100 << 20)))
+ATTACH_DISK_BYTES = max(ATTACH_MAX_BYTES, int(os.environ.get("E2EE_ATTACH_DISK_BYTES", 2 << 30)))
+# ...and per user and per room (declared sizes, counted from the upload's start),
+# so one sender cannot take the whole spool; an upload that gets no chunk for
+# ATTACH_STALL_SECONDS is dropped and its space freed
+ATTACH_USER_BYTES = max(ATTACH_MAX_BYTES, int(os.environ.get("E2EE_ATTACH_USER_BYTES", 2 * ATTACH_MAX_BYTES)))
+ATTACH_ROOM_BYTES = max(ATTACH_MAX_BYTES, int(os.environ.get("E2EE_ATTACH_ROOM_BYTES", ATTACH_DISK_BYTES // 4)))
+ATTACH_STALL_SECONDS = max(1.0, float(os.environ.get("E2EE_ATTACH_STALL_SECONDS", 60)))
+# Redeploys: on SIGTERM joined clients are told to reconnect after a delay
+# spread over DRAIN_JITTER_SECONDS, the process waits up to DRAIN_TIMEOUT
+# seconds for them to leave, then writes rooms, messages, acks and the block
+# list to SNAPSHOT_PATH for the next process to load at startup (empty: no
+# snapshot; unused with E2EE_DATA_DIR, whose log already survives restarts).
+# Each worker needs its own path.
+SNAPSHOT_PATH = os.environ.get("E2EE_SNAPSHOT_PATH", "")
+DRAIN_JITTER_SECONDS = max(0.0, float(os.environ.get("E2EE_DRAIN_JITTER_SECONDS", 10)))
+DRAIN_TIMEOUT = max(0.0, float(os.environ.get("E2EE_DRAIN_TIMEOUT", 5)))
+
+# ===========================
+# HTML Templates
+# ===========================
+LOGIN_HTML = """
+<!DOCTYPE html>
+<html>
+<head>
+<title>Secure Chat Login</title>
+<meta name="viewport" content="width=device-width, initial-scale=1" />
+<link rel="stylesheet" href="{{ asset('login.css') }}">
+</head>
+<body>
+<div class="login">
+  <h2>🔒 Secure Chat Portal 🔒</h2>
+  <form method="POST">
+    <input type="text" name="username" placeholder="Enter your name" autocomplete="username" required>
+    <input type="text" name="room" placeholder="Paste Room/Friend ID (optional)">
+    <button type="submit">Enter Chat</button>
+  </form>
+  <div class="small">Leave Room ID blank to create a new room.</div>
+</div>
+</body>
+</html>
+"""
+
+CHAT_HTML = """
+<!DOCTYPE html>
+<html>
+<head>
+<title>Secure Chat</title>
+<meta name="viewport" content="width=device-width, initial-scale=1" />
+<link rel="stylesheet" href="{{ asset('chat.css') }}">
+<script src="https://cdnjs.cloudflare.com/ajax/libs/socket.io/4.6.1/socket.io.min.js" integrity="sha512-R0L9f7rYpPoa6b5xPL7aHiM2YjP1YGrwWQITn08b6+mLllm0k3nSP0Q8nM7Hk8U8B9z7bE+0g1tZ2zUqhSItZw==" crossorigin="anonymous" referrerpolicy="no-referrer"></script>
+<script defer src="{{ asset('chat.js') }}"></script>
+</head>
+<body data-user="{{ username }}" data-room="{{ room }}" data-logout="{{ url_for('logout') }}" data-attachments="{{ url_for('attachment_create') }}">
+  <header>🔒 Room: {{ room }} | User: {{ username }} 🔒
+    <a href="{{ url_for('logout') }}" class="logout">Logout</a>
+  </header>
+  <div class="container">
+    <div id="chat-box"></div>
+    <div class="controls">
+      <input type="text" id="msg-input" placeholder="Type message...">
+      <button class="send" onclick="sendMessage()">Send</button>
+      <button class="send" title="Send a file" onclick="document.getElementById('file-input').click()">📎</button>
+      <input type="file" id="file-input" hidden onchange="uploadFiles(this)">
+    </div>
+  </div>
+</body>
+</html>
+"""
+
+LOGIN_CSS = """
+body { background:#000; color:#0f0; font-family:'Courier New', monospace; display:flex; justify-content:center; align-items:center; height:100vh; margin:0;}
+.login { border:2px solid #0f0; padding:30px; border-radius:10px; text-align:center; box-shadow:0 0 15px #0f0; width:320px; max-width:92vw;}
+input { background:#000; border:1px solid #0f0; color:#0f0; padding:10px; margin:10px 0; width:100%; border-radius:6px;}
+button { background:#0f0; color:#000; padding:12px; border:none; cursor:pointer; width:100%; border-radius:8px; font-weight:bold;}
+button:hover { background:#050; color:#0f0; }
+.small { color:#8f8; font-size:12px; margin-top:8px; }
+"""
+
+# Chat page script: Morse "encryption", history sync and rendering
+CHAT_JS = """
+const socket = io();
+// Page parameters come from data-* attributes on <body>, so this file is the same for every user
+const params = document.body.dataset;
+const username = params.user;
+const room = params.room;
+
+// "Toy" encryption: Base64(Morse). Do not use in real-world.
+const MORSE = {'A':'.-','B':'-...','C':'-.-.','D':'-..','E':'.','F':'..-.','G':'--.','H':'....','I':'..','J':'.---','K':'-.-','L':'.-..','M':'--','N':'-.','O':'---','P':'.--.','Q':'--.-','R':'.-.','S':'...','T':'-','U':'..-','V':'...-','W':'.--','X':'-..-','Y':'-.--','Z':'--..',' ':'/','0':'-----','1':'.----','2':'..---','3':'...--','4':'....-','5':'.....','6':'-....','7':'--...','8':'---..','9':'----.'};
+// Reverse table, built once rather than per decoded message
+const MORSE_DECODE = new Map(Object.entries(MORSE).map(([k,v])=>[v,k]));
+function toMorse(text){ return text.toUpperCase().split('').map(c=>MORSE[c]||c).join(' '); }
+function fromMorse(code){
+    const codes = code.split(' ');
+    let out = '';
+    for(let i = 0; i < codes.length; i++){ const c = codes[i]; out += MORSE_DECODE.get(c) || c; }
+    return out;
+}
+function encryptMessage(msg){ return btoa(unescape(encodeURIComponent(toMorse(msg)))); }
+function decryptMessage(msg){ try{ return fromMorse(decodeURIComponent(escape(atob(msg)))); }catch(e){ return "✖ Unable to decrypt"; } }
+
+// Compact mode: the same Morse ciphertext as raw UTF-8 bytes in a binary
+// attachment, without the base64 string. Used once the server confirms it.
+const BINARY_OK = typeof TextEncoder !== 'undefined' && typeof TextDecoder !== 'undefined';
+const utf8Enc = BINARY_OK ? new TextEncoder() : null;
+const utf8Dec = BINARY_OK ? new TextDecoder() : null;
+let binaryMode = false;
+function encryptBinary(msg){ return utf8Enc.encode(toMorse(msg)); }
+function decryptBinary(buf){ try{ return fromMorse(utf8Dec.decode(buf)); }catch(e){ return "✖ Unable to decrypt"; } }
+
+function sendMessage(){
+    const input = document.getElementById('msg-input');
+    let msg = input.value;
+    if(msg.trim()==="") return;
+    if(binaryMode){
+        socket.emit('message', {'user':username,'room':room,'bin':encryptBinary(msg)});
+    } else {
+        socket.emit('message', {'user':username,'room':room,'msg':encryptMessage(msg)});
+    }
+    input.value = '';
+}
+
+// Highest message seq rendered so far; survives reloads within the tab.
+const SEQ_KEY = 'seq_' + room;
+let lastSeq = parseInt(sessionStorage.getItem(SEQ_KEY) || '0', 10);
+let syncing = true;      // live messages are held back until history catches up
+let pending = [];
+let ackTimer = null;
+
+function scheduleAck(){
+    if(ackTimer) return;
+    ackTimer = setTimeout(function(){
+        ackTimer = null;
+        sessionStorage.setItem(SEQ_KEY, String(lastSeq));
+        socket.emit('ack', {'room': room, 'user': username, 'seq': lastSeq});
+    }, 1000);
+}
+
+// Rendering: messages are queued and drawn once per animation frame, and
+// #chat-box is virtualized in blocks of BLOCK_ROWS rows. Blocks far from the
+// viewport keep only their measured height; their rows are rebuilt when they
+// scroll back into range, so the DOM holds a few screens of rows at most.
+const BLOCK_ROWS = 50;
+const chatBox = document.getElementById('chat-box');
+const blocks = [];       // {rows: [[className, text, href?], ...], el, live}
+let drawQueue = [];
+let frameQueued = false;
+
+function requestFrame(){
+    if(frameQueued) return;
+    frameQueued = true;
+    requestAnimationFrame(drawFrame);
+}
+
+function rowElement(row){
+    const el = document.createElement('div');
+    el.className = row[0];
+    if(row[2]){
+        // Attachment: the text is a download link
+        const a = document.createElement('a');
+        a.href = row[2];
+        a.download = '';
+        a.textContent = row[1];
+        el.appendChild(a);
+    } else {
+        el.textContent = row[1];
+    }
+    return el;
+}
+
+function formatSize(n){
+    if(n < 1024) return n + ' B';
+    if(n < 1048576) return (n / 1024).toFixed(1) + ' KiB';
+    return (n / 1048576).toFixed(1) + ' MiB';
+}
+
+function messageRow(data){
+    if(data.system) return ['system', "[SYSTEM] " + data.text];
+    const cls = 'message ' + (data.user===username ? 'sent' : 'received');
+    if(data.att){
+        return [cls, data.user + ": 📎 " + decryptMessage(data.att.meta) + " (" + formatSize(data.att.size) + ")",
+                params.attachments + '/' + encodeURIComponent(data.att.id)];
+    }
+    return [cls, data.user + ": " + (data.bin ? decryptBinary(data.bin) : decryptMessage(data.msg))];
+}
+
+function drawFrame(){
+    frameQueued = false;
+    const atBottom = chatBox.scrollTop + chatBox.clientHeight >= chatBox.scrollHeight - 40;
+    const queue = drawQueue;
+    drawQueue = [];
+    let block = blocks[blocks.length - 1];
+    let frag = null;
+    for(let i = 0; i < queue.length; i++){
+        const row = messageRow(queue[i]);
+        if(!block || block.rows.length >= BLOCK_ROWS){
+            if(frag) block.el.appendChild(frag);
+            block = {rows: [], el: document.createElement('div'), live: true};
+            blocks.push(block);
+            chatBox.appendChild(block.el);
+            frag = null;
+        }
+        if(!block.live){
+            // Culled to a fixed height that the new rows would not count in:
+            // show it again, and cullBlocks() below measures it afresh
+            showBlock(block);
+        }
+        block.rows.push(row);
+        if(block.live){
+            if(!frag) frag = document.createDocumentFragment();
+            frag.appendChild(rowElement(row));
+        }
+    }
+    if(frag) block.el.appendChild(frag);
+    if(atBottom) chatBox.scrollTop = chatBox.scrollHeight;   // one forced layout per frame
+    cullBlocks();
+}
+
+function cullBlocks(){
+    // Read every position first, then write, so layout is computed once
+    const margin = chatBox.clientHeight;
+    const top = chatBox.scrollTop - margin, bottom = chatBox.scrollTop + chatBox.clientHeight + margin;
+    const changes = [];
+    for(let i = 0; i < blocks.length; i++){
+        const b = blocks[i];
+        const y = b.el.offsetTop, h = b.el.offsetHeight;
+        const near = y + h >= top && y <= bottom;
+        if(near !== b.live) changes.push([b, h]);
+    }
+    for(let i = 0; i < changes.length; i++){
+        const b = changes[i][0];
+        if(b.live){
+            b.el.style.height = changes[i][1] + 'px';
+            b.el.textContent = '';
+            b.live = false;
+        } else {
+            showBlock(b);
+        }
+    }
+}
+
+function showBlock(b){
+    const frag = document.createDocumentFragment();
+    b.rows.forEach(row => frag.appendChild(rowElement(row)));
+    b.el.style.height = '';
+    b.el.appendChild(frag);
+    b.live = true;
+}
+
+let cullQueued = false;
+chatBox.addEventListener('scroll', function(){
+    if(cullQueued) return;
+    cullQueued = true;
+    requestAnimationFrame(function(){ cullQueued = false; cullBlocks(); });
+}, {passive: true});
+
+function renderMessage(data){
+    if(!data.system && data.seq){
+        if(data.seq <= lastSeq) return;   // already shown (replayed or duplicate)
+        lastSeq = data.seq;
+        scheduleAck();
+    }
+    drawQueue.push(data);
+    requestFrame();
+}
+
+// (Re)join on every connect, resuming from the last seq we rendered.
+socket.on('connect', function(){
+    syncing = true;
+    socket.emit('join', {'username': username, 'room': room, 'since': lastSeq, 'binary': BINARY_OK});
+});
+
+socket.on('history', function(page){
+    binaryMode = page.binary === true;
+    // Server lost its history (restart without persistence): start over
+    if(page.head < lastSeq){ lastSeq = 0; page.last = page.head; }
+    page.messages.forEach(renderMessage);
+    if(page.last > lastSeq) lastSeq = page.last;
+    if(page.more){
+        socket.emit('sync', {'room': room, 'since': page.last, 'binary': binaryMode});
+        return;
+    }
+    syncing = false;
+    pending.forEach(renderMessage);
+    pending = [];
+});
+
+// Fetch everything after lastSeq; live messages queue up meanwhile.
+function requestSync(){
+    if(syncing) return;
+    syncing = true;
+    socket.emit('sync', {'room': room, 'since': lastSeq, 'binary': binaryMode});
+}
+
+function receiveLive(data){
+    if(syncing){ pending.push(data); return; }
+    if(data.seq > lastSeq + 1){ pending.push(data); requestSync(); return; }   // missed some
+    renderMessage(data);
+}
+
+socket.on('message', function(data){
+    if(data.system){ renderMessage(data); return; }
+    receiveLive(data);
+});
+
+// Attachments: uploaded in server-sized chunks with the byte offset in a
+// header; after a failed chunk the client asks where the upload stands and
+// resumes from there. The file name goes through the toy cipher like a
+// message; the file bytes are sent as they are.
+function sleep(ms){ return new Promise(resolve => setTimeout(resolve, ms)); }
+
+async function uploadFile(file){
+    let r = await fetch(params.attachments, {method: 'POST', headers: {'Content-Type': 'application/json'},
+                                             body: JSON.stringify({'size': file.size, 'meta': encryptMessage(file.name)})});
+    if(!r.ok){ renderMessage({'system': true, 'text': 'Upload refused: ' + file.name}); return; }
+    const upload = await r.json();
+    let offset = upload.offset, failures = 0;
+    while(offset < file.size){
+        try {
+            r = await fetch(upload.url, {method: 'PATCH', headers: {'Upload-Offset': String(offset)},
+                                         body: file.slice(offset, offset + upload.chunk)});
+        } catch(e){ r = null; }
+        if(r && r.ok){ offset = parseInt(r.headers.get('Upload-Offset'), 10); failures = 0; continue; }
+        if(r && r.status !== 409 && r.status < 500){ break; }
+        if(++failures > 10){ break; }
+        await sleep(Math.min(30000, 500 * 2 ** failures));
+        try {
+            r = await fetch(upload.url, {method: 'HEAD'});
+            if(r.ok) offset = parseInt(r.headers.get('Upload-Offset'), 10);
+            else if(r.status === 404) break;
+        } catch(e){}
+    }
+    if(offset < file.size) renderMessage({'system': true, 'text': 'Upload failed: ' + file.name});
+}
+
+async function uploadFiles(input){
+    const files = Array.from(input.files);
+    input.value = '';
+    for(const file of files) await uploadFile(file);
+}
+
+// Batched broadcasts (server-side E2EE_BATCH_WINDOW_MS), in seq order
+socket.on('messages', function(batch){ batch.messages.forEach(receiveLive); });
+
+// The server is shutting down for a redeploy: leave now and come back after
+// the delay it picked, so clients return to the new process a few at a time.
+socket.on('restart', function(notice){
+    socket.disconnect();
+    setTimeout(function(){ socket.connect(); }, notice.delay_ms);
+});
+
+socket.on('kicked', function(){
+    socket.disconnect();
+    window.location = params.logout;
+});
+
+// Server skipped messages while this connection was backed up
+socket.on('resync', requestSync);
+
+socket.on('rate_limited', function(){
+    renderMessage({'system': true, 'text': 'Slow down: message not sent.'});
+});
+
+document.addEventListener('keydown', (e) => {
+  if (e.key === 'Enter') { sendMessage(); }
+});
+"""
+
+# ===========================
+# Static Assets
+# ===========================
+# CSS/JS are served from content-hashed URLs with a one-year immutable cache,
+# ETag/304 and gzip (plus brotli when the `brotli` package is installed),
+# all compressed once here instead of per request.
+try:
+    import brotli  # type: ignore
+except ImportError:
+    brotli = None
+
+class StaticAsset:
+    """One static file: its hashed URL and pre-compressed variants."""
+
+    def __init__(self, name, body, content_type):
+        data = body.encode('utf-8')
+        self.digest = hashlib.sha256(data).hexdigest()[:16]
+        stem, _, ext = name.rpartition('.')
+        self.filename = f"{stem}.{self.digest}.{ext}"
+        self.content_type = content_type
+        self.variants = {'identity': data}
+        packed = gzip.compress(data, 9, mtime=0)
+        if len(packed) < len(data):
+            self.variants['gzip'] = packed
+        if brotli is not None:
+            packed = brotli.compress(data, quality=11)
+            if len(packed) < len(data):
+                self.variants['br'] = packed
+
+    def negotiate(self, accept_encodings):
+        """Pick the smallest variant the client accepts; returns (encoding, body)."""
+        for encoding in ('br', 'gzip'):
+            if encoding in self.variants and accept_encodings[encoding] > 0:
+                return encoding, self.variants[encoding]
+        return 'identity', self.variants['identity']
+
+    def etag(self, encoding):
+        return self.digest if encoding == 'identity' else f"{self.digest}-{encoding}"
+
+def _read_asset(filename):
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), filename), encoding='utf-8') as f:
+        return f.read()
+
+ASSETS = {
+    'login.css': StaticAsset('login.css', LOGIN_CSS, 'text/css; charset=utf-8'),
+    'chat.css': StaticAsset('chat.css', _read_asset('chat_style.css'), 'text/css; charset=utf-8'),
+    'chat.js': StaticAsset('chat.js', CHAT_JS, 'application/javascript; charset=utf-8'),
+}
+ASSET_FILES = {a.filename: a for a in ASSETS.values()}
+
+def asset_url(name):
+    return f"/assets/{ASSETS[name].filename}"
+
+# Templates are parsed and compiled once, not on every request
+app.jinja_env.globals['asset'] = asset_url
+LOGIN_TEMPLATE = app.jinja_env.from_string(LOGIN_HTML)
+CHAT_TEMPLATE = app.jinja_env.from_string(CHAT_HTML)
+
+# ===========================
+# Utility Functions
+# ===========================
+class RoomIdAllocator:
+    """Unique room codes from a CSPRNG, handed out from a pre-generated pool.
+
+    Random bytes become codes with one bytes.translate() per refill (bytes
+    that would bias the modulo are deleted rather than wrapped). A candidate
+    is pooled only if it is not a live room, not already pooled and not
+    issued recently (a remote broker applies the 'open' op a round trip
+    later), so allocate() is a deque pop and a lookup in `live`, without
+    taking a lock; it only loops on a room opened by another worker since
+    the code was pooled. A background thread tops the pool up below half.
+    """
+
+    def __init__(self, length, alphabet, pool_size, live):
+        chars = alphabet.encode('ascii')
+        if len(set(chars)) != len(chars) or len(chars) < 2:
+            raise ValueError("room ID alphabet needs at least 2 distinct ASCII characters")
+        self._table = bytes(chars[b % len(chars)] for b in range(256))
+        self._biased = bytes(range(256 - 256 % len(chars), 256))
+        self._accept = (256 - len(self._biased)) / 256
+        self.length = length
+        self.space = len(chars) ** length
+        self.pool_size = pool_size
+        self.live = live
+        self._pool = deque()
+        self._pooled = set()
+        self._recent = OrderedDict()
+        self._fill_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self.stats = {'allocated': 0, 'collisions': 0, 'refills': 0, 'inline_refills': 0}
+        with self._fill_lock:
+            self._fill(pool_size)
+
+    def __len__(self):
+        return len(self._pool)
+
+    def _fill(self, want):
+        """Pool up to `want` fresh codes; returns how many. Call with _fill_lock held."""
+        n, added = self.length, 0
+        for _ in range(8):   # a crowded space yields fewer codes per round
+            chars = secrets.token_bytes(int((want - added) * n / self._accept) + n).translate(self._table, self._biased)
+            for i in range(0, len(chars) - n + 1, n):
+                code = chars[i:i + n].decode('ascii')
+                if code in self.live or code in self._pooled or code in self._recent:
+                    self.stats['collisions'] += 1
+                    continue
+                self._pooled.add(code)
+                self._pool.append(code)
+                added += 1
+                if added == want:
+                    return added
+        return added
+
+    def allocate(self):
+        while True:
+            try:
+                code = self._pool.popleft()
+            except IndexError:
+                # Drained faster than the refill thread keeps up: refill inline
+                with self._fill_lock:
+                    if not self._pool:
+                        self.stats['inline_refills'] += 1
+                        if not self._fill(self.pool_size // 2):
+                            raise RuntimeError("room ID space exhausted; raise E2EE_ROOM_ID_LENGTH")
+                continue
+            self._pooled.discard(code)
+            if len(self._pool) < self.pool_size // 2:
+                self._wakeup.set()
+            if code in self.live:
+                self.stats['collisions'] += 1
+                continue
+            self._recent[code] = None
+            if len(self._recent) > self.pool_size:
+                self._recent.popitem(last=False)
+            self.stats['allocated'] += 1
+            return code
+
+    def run(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            with self._fill_lock:
+                self._fill(self.pool_size - len(self._pool))
+            self.stats['refills'] += 1
+
+ROOM_IDS = RoomIdAllocator(ROOM_ID_LENGTH, ROOM_ID_ALPHABET, ROOM_ID_POOL, ROOMS)
+threading.Thread(target=ROOM_IDS.run, daemon=True).start()
+
+def find_free_port():
+    s = socket.socket()
+    s.bind(('', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def get_local_ip():
+    try:
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.connect(("8.8.8.8", 80))
+        ip = s.getsockname()[0]
+        s.close()
+        return ip
+    except Exception:
+        return "127.0.0.1"
+
+def open_browser_links(port, local_ip):
+    time.sleep(1)  # wait for server to start
+    try:
+        webbrowser.open(f"http://localhost:{port}")
+        webbrowser.open(f"http://{local_ip}:{port}")
+    except Exception:
+        print("[!] Unable to auto-launch browser, open manually.")
+
+# ===========================
+# Store
+# ===========================
+def room_lock(room):
+    return ROOM_LOCKS[hash(room) % LOCK_STRIPES]
+
+def is_blocked(user):
+    return user in BLOCKED_USERS
+
+def block_users(users):
+    global BLOCKED_USERS
+    with BLOCK_LOCK:
+        BLOCKED_USERS = BLOCKED_USERS.union(users)
+        if DURABLE is not None:
+            DURABLE.save_blocked(BLOCKED_USERS)
+
+def unblock_users(users):
+    global BLOCKED_USERS
+    with BLOCK_LOCK:
+        BLOCKED_USERS = BLOCKED_USERS.difference(users)
+        if DURABLE is not None:
+            DURABLE.save_blocked(BLOCKED_USERS)
+
+# Payload kinds: how the ciphertext arrived and how it is stored
+KIND_TEXT = 0     # legacy base64 string, stored as its UTF-8 bytes
+KIND_BINARY = 1   # raw bytes from a Socket.IO binary attachment, stored as-is
+KIND_ATTACHMENT = 2   # JSON {"id", "size", "meta"} announcing an uploaded file
+
+def payload_text(payload, kind):
+    """Render a stored payload in the legacy base64-string form."""
+    if kind == KIND_BINARY:
+        return base64.b64encode(payload).decode('ascii')
+    return payload.decode('utf-8')
+
+def payload_field(payload, kind, binary):
+    """Return the ('msg'|'bin'|'att', value) pair to send a client in the given mode."""
+    if kind == KIND_ATTACHMENT:
+        return 'att', json.loads(payload)
+    if kind == KIND_BINARY and binary:
+        return 'bin', payload
+    return 'msg', payload_text(payload, kind)
+
+# Column storage per message besides the payload: 8-byte time, 4-byte user id,
+# 1-byte kind and an 8-byte slot in the payload list
+RECORD_OVERHEAD = 21
+
+class RoomLog:
+    """Columnar message store for one room, oldest first.
+
+    Timestamps live in an array('d'), senders in an array('I') of indexes
+    into the room's own table of (interned) names, payload kinds in an
+    array('B') and ciphertext as bytes, instead of one dict per message.
+    Being per room, the name table needs no lock beyond the room's.
+    Expired messages are dropped by advancing `head`; the dead prefix is
+    compacted away (names only it used with it) once it outgrows the live
+    part, or as soon as nothing is left. Sequence numbers are
+    contiguous, so the message with seq n sits at head + n - first_seq.
+    `nbytes` counts live payload bytes plus RECORD_OVERHEAD per message.
+    """
+
+    __slots__ = ('times', 'users', 'names', 'ids', 'kinds', 'payloads', 'head', 'first_seq', 'last_seq', 'nbytes')
+
+    def __init__(self):
+        self.times = array('d')
+        self.users = array('I')
+        self.names = []         # sender id: name
+        self.ids = {}           # name: sender id
+        self.kinds = array('B')
+        self.payloads = []
+        self.head = 0
+        self.first_seq = 1      # seq of the message at `head`
+        self.last_seq = 0       # last seq handed out; survives clears and expiry
+        self.nbytes = 0
+
+    def __len__(self):
+        return len(self.times) - self.head
+
+    def append(self, user, payload, timestamp, kind=KIND_TEXT):
+        uid = self.ids.get(user)
+        if uid is None:
+            uid = self.ids[user] = len(self.names)
+            self.names.append(sys.intern(user))
+        self.times.append(timestamp)
+        self.users.append(uid)
+        self.kinds.append(kind)
+        self.payloads.append(payload)
+        self.nbytes += len(payload) + RECORD_OVERHEAD
+        self.last_seq += 1
+        return self.last_seq
+
+    def oldest(self):
+        return self.times[self.head] if len(self) else None
+
+    def expire(self, cutoff):
+        """Drop messages with timestamp <= cutoff; returns how many were dropped."""
+        times, start = self.times, self.head
+        end = len(times)
+        i = start
+        while i < end and times[i] <= cutoff:
+            i += 1
+        return self._drop_head(i)
+
+    def trim(self, max_bytes):
+        """Drop the oldest messages until `nbytes` <= max_bytes; returns how many were dropped."""
+        payloads, i, end = self.payloads, self.head, len(self.times)
+        excess = self.nbytes - max_bytes
+        while excess > 0 and i < end:
+            excess -= len(payloads[i]) + RECORD_OVERHEAD
+            i += 1
+        return self._drop_head(i)
+
+    def _drop_head(self, stop):
+        payloads, start = self.payloads, self.head
+        freed = 0
+        for i in range(start, stop):
+            freed += len(payloads[i]) + RECORD_OVERHEAD
+            payloads[i] = None
+        self.nbytes -= freed
+        self.head = stop
+        self.first_seq += stop - start
+        if stop == len(self.times) or (stop > 1024 and stop * 2 > len(self.times)):
+            self._compact()
+        return stop - start
+
+    def clear(self):
+        self.first_seq = self.last_seq + 1
+        self.times = array('d')
+        self.users = array('I')
+        self.names = []
+        self.ids = {}
+        self.kinds = array('B')
+        self.payloads = []
+        self.head = 0
+        self.nbytes = 0
+
+    def restore(self, seq, user, payload, timestamp, kind):
+        """Append a message recovered from disk under its original seq."""
+        if seq != self.last_seq + 1:
+            # Earlier messages aged out (or were cleared) before the restart
+            self.clear()
+            self.last_seq = seq - 1
+            self.first_seq = seq
+        self.append(user, payload, timestamp, kind)
+
+    def _compact(self):
+        del self.times[:self.head]
+        del self.users[:self.head]
+        del self.kinds[:self.head]
+        del self.payloads[:self.head]
+        self.head = 0
+        self._renumber()
+
+    def _renumber(self):
+        """Rebuild the name table from the live messages, dropping names none of them use."""
+        old, remap, names = self.names, {}, []
+        for uid in set(self.users):
+            remap[uid] = len(names)
+            names.append(old[uid])
+        if any(uid != new for uid, new in remap.items()):
+            self.users = array('I', [remap[uid] for uid in self.users])
+        self.names = names
+        self.ids = {name: uid for uid, name in enumerate(names)}
+
+    def since(self, seq, limit):
+        """Yield (seq, user, payload, kind, timestamp) for up to `limit` messages after `seq`."""
+        start = self.head + max(0, seq + 1 - self.first_seq)
+        stop = min(len(self.times), start + limit)
+        names, users, kinds, payloads, times = self.names, self.users, self.kinds, self.payloads, self.times
+        base = self.first_seq - self.head
+        for i in range(start, stop):
+            yield base + i, names[users[i]], payloads[i], kinds[i], times[i]
+
+    def records(self):
+        return self.since(self.first_seq - 1, len(self))
+
+def open_room(room, timestamp=None):
+    """Make sure `room` exists; new rooms are reclaimed if nobody joins them."""
+    now = timestamp or time.time()
+    with room_lock(room):
+        created = room not in ROOMS
+        if created:
+            ROOMS[room] = {}
+            MESSAGES.setdefault(room, RoomLog())
+            if DURABLE is not None:
+                DURABLE.append(room, OP_OPEN, timestamp=now)
+        LAST_ACTIVE[room] = now
+    if created:
+        REAPER.schedule(room, now)
+
+def join_member(room, user):
+    with room_lock(room):
+        members = ROOMS.get(room)
+        if members is None:
+            members = ROOMS[room] = {}
+            MESSAGES.setdefault(room, RoomLog())
+        members[user] = members.get(user, 0) + 1
+        LAST_ACTIVE[room] = time.time()
+        BUDGET.touch(room)
+        with PRESENCE_LOCK:
+            USER_ROOMS.setdefault(user, set()).add(room)
+
+def leave_member(room, user, sockets=1):
+    """Drop `sockets` of `user`'s connections from `room` (all of them if None)."""
+    now = time.time()
+    with room_lock(room):
+        members = ROOMS.get(room)
+        if members is None or user not in members:
+            return
+        left = 0 if sockets is None else members[user] - sockets
+        if left > 0:
+            members[user] = left
+        else:
+            del members[user]
+            with PRESENCE_LOCK:
+                rooms = USER_ROOMS.get(user)
+                if rooms is not None:
+                    rooms.discard(room)
+                    if not rooms:
+                        del USER_ROOMS[user]
+        LAST_ACTIVE[room] = now
+        empty = not members
+    if empty:
+        REAPER.schedule(room, now)
+
+def is_member(room, user):
+    members = ROOMS.get(room)
+    return members is not None and user in members
+
+def user_rooms(user):
+    with PRESENCE_LOCK:
+        return list(USER_ROOMS.get(user, ()))
+
+def bind_sid(sid, user, room):
+    """Record which user/room a local socket belongs to; returns the previous binding."""
+    with PRESENCE_LOCK:
+        previous = SIDS.get(sid)
+        if previous is not None:
+            sids = USER_SIDS.get(previous[0])
+            if sids is not None:
+                sids.discard(sid)
+                if not sids:
+                    del USER_SIDS[previous[0]]
+        SIDS[sid] = (user, room)
+        USER_SIDS.setdefault(user, set()).add(sid)
+    return previous
+
+def unbind_sid(sid):
+    with PRESENCE_LOCK:
+        binding = SIDS.pop(sid, None)
+        if binding is not None:
+            sids = USER_SIDS.get(binding[0])
+            if sids is not None:
+                sids.discard(sid)
+                if not sids:
+                    # Last socket of the user on this worker: its rate bucket goes too
+                    del USER_SIDS[binding[0]]
+                    USER_BUCKETS.pop(binding[0], None)
+    return binding
+
+def unbind_user(user):
+    """Forget every local socket of `user`; returns their sids."""
+    with PRESENCE_LOCK:
+        sids = USER_SIDS.pop(user, set())
+        USER_BUCKETS.pop(user, None)
+        for sid in sids:
+            SIDS.pop(sid, None)
+    return sids
+
+def reclaim_room(room):
+    """Delete an empty room and everything stored for it; False if it has members."""
+    with room_lock(room):
+        if ROOMS.get(room):
+            return False
+        ROOMS.pop(room, None)
+        log = MESSAGES.pop(room, None)
+        BUDGET.charge(room, -log.nbytes if log is not None else 0, forget=True)
+        ACKS.pop(room, None)
+        LAST_ACTIVE.pop(room, None)
+        if DURABLE is not None:
+            DURABLE.append(room, OP_RECLAIM, timestamp=time.time())
+    return True
+
+def reset_store():
+    """Forget every room, e.g. before taking a peer's copy of the store."""
+    for room in list(ROOMS) + list(MESSAGES):
+        with room_lock(room):
+            ROOMS.pop(room, None)
+            log = MESSAGES.pop(room, None)
+            if log is not None:
+                BUDGET.charge(room, -log.nbytes, forget=True)
+            ACKS.pop(room, None)
+            LAST_ACTIVE.pop(room, None)
+    with PRESENCE_LOCK:
+        USER_ROOMS.clear()
+
+def store_message(room, user, payload, kind, timestamp, announce=False):
+    """Append a message (payload as bytes) to `room` and return its seq.
+
+    With `announce` and batching on, the message is also queued on
+    BROADCASTER, under the room lock so each room's queue is in seq order.
+    """
+    with room_lock(room):
+        log = MESSAGES.get(room)
+        if log is None:
+            log = MESSAGES[room] = RoomLog()
+        before = log.nbytes
+        seq = log.append(user, payload, timestamp, kind)
+        if log.nbytes > BUDGET.room_limit:
+            BUDGET.stats['trimmed_messages'] += log.trim(BUDGET.room_limit)
+        BUDGET.charge(room, log.nbytes - before, touch=True)
+        EXPIRY.track(room, timestamp)
+        LAST_ACTIVE[room] = timestamp
+        # Written under the room lock so the log keeps each room's seq order
+        if DURABLE is not None:
+            DURABLE.append(room, OP_MESSAGE, user, payload, kind, seq, timestamp)
+        if announce and BROADCASTER.window:
+            BROADCASTER.submit(room, (user, payload, kind, seq))
+    if BUDGET.over():
+        BUDGET.evict(keep=room)
+    return seq
+
+def clear_room(room):
+    with room_lock(room):
+        log = MESSAGES.get(room)
+        if log is not None:
+            BUDGET.charge(room, -log.nbytes)
+            log.clear()
+            if DURABLE is not None:
+                DURABLE.append(room, OP_CLEAR, seq=log.last_seq, timestamp=time.time())
+
+def kick_users(users):
+    """Remove each user from every room; returns {room: [users removed from it]}."""
+    kicked = {}
+    for user in users:
+        for r in user_rooms(user):
+            leave_member(r, user, sockets=None)
+            kicked.setdefault(r, []).append(user)
+    return kicked
+
+def messages_since(room, since, limit=HISTORY_PAGE_SIZE, binary=False):
+    """Return up to `limit` stored messages with seq > since, plus the room's latest seq."""
+    with room_lock(room):
+        log = MESSAGES.get(room)
+        if log is None:
+            return [], 0
+        rows = list(log.since(since, limit))
+        head = log.last_seq
+    page = []
+    for seq, user, payload, kind, _ in rows:
+        field, value = payload_field(payload, kind, binary)
+        page.append({'seq': seq, 'user': user, field: value})
+    return page, head
+
+def ack_messages(room, user, seq):
+    with room_lock(room):
+        log = MESSAGES.get(room)
+        if log is None:
+            return
+        # Nobody can have read past the last stored message
+        seq = min(seq, log.last_seq)
+        acked = ACKS.setdefault(room, {})
+        if seq > acked.get(user, 0):
+            acked[user] = seq
+
+def acked_seq(room, user):
+    with room_lock(room):
+        return ACKS.get(room, {}).get(user, 0)
+
+def snapshot_rooms():
+    """Copy ROOMS room by room, holding each stripe only for its own copy."""
+    out = {}
+    for r in list(ROOMS):
+        with room_lock(r):
+            members = ROOMS.get(r)
+            if members is not None:
+                out[r] = sorted(members)
+    return out
+
+def snapshot_messages():
+    out = {}
+    for r in list(MESSAGES):
+        with room_lock(r):
+            log = MESSAGES.get(r)
+            if log is not None:
+                out[r] = [{'seq': seq, 'user': user, 'msg': payload_text(payload, kind), 'timestamp': ts}
+                          for seq, user, payload, kind, ts in log.records()]
+    return out
+
+# ===========================
+# Replicated State
+# ===========================
+# Mutations are published as ops on the broker's "state" channel and applied
+# by every worker as they arrive; only the originating worker emits to clients
+# (its emit is itself fanned out by the client manager). With LocalBroker the
+# op is applied before replicate() returns.
+STATE_HANDLERS = {}
+
+def state_op(name):
+    def register(fn):
+        STATE_HANDLERS[name] = fn
+        return fn
+    return register
+
+def replicate(op, **fields):
+    """Publish a state op; False (and nothing applied) when the broker cannot take it."""
+    fields['op'] = op
+    fields['origin'] = WORKER_ID
+    try:
+        BROKER.publish('state', fields)
+    except BrokerUnavailable as e:
+        print(f"[!] State op '{op}' dropped: {e}")
+        return False
+    return True
+
+def apply_state(message):
+    if BOOTSTRAP.hold(message):
+        return
+    handler = STATE_HANDLERS.get(message.get('op'))
+    if handler is not None:
+        handler(message, message.get('origin') == WORKER_ID)
+
+@state_op('open')
+def _apply_open(op, local):
+    open_room(op['room'], op['ts'])
+
+@state_op('join')
+def _apply_join(op, local):
+    join_member(op['room'], op['user'])
+
+@state_op('leave')
+def _apply_leave(op, local):
+    leave_member(op['room'], op['user'])
+
+@state_op('reclaim')
+def _apply_reclaim(op, local):
+    reclaim_room(op['room'])
+
+def binary_room(room):
+    """Socket.IO room holding the members of `room` that negotiated binary payloads."""
+    return f"bin:{room}"
+
+def text_room(room):
+    return f"txt:{room}"
+
+MIXED_PREFIX = "mix:"
+
+def mixed_room(room):
+    """Target for a binary-form broadcast to all of `room`: each worker's manager hands it to
+    binary_room and a text_copy to text_room, skipping the one it has no members in."""
+    return MIXED_PREFIX + room
+
+def text_copy(data):
+    """A 'message'/'messages' event as legacy clients get it: 'bin' payloads as base64 'msg'."""
+    if 'messages' in data:
+        return {'messages': [text_copy(item) for item in data['messages']]}
+    if 'bin' not in data:
+        return data
+    data = dict(data)
+    data['msg'] = payload_text(data.pop('bin'), KIND_BINARY)
+    return data
+
+def broadcast_message(room, user, payload, kind, seq):
+    """Push one message now (BATCH_WINDOW_MS=0); batched ones are queued by store_message."""
+    if kind != KIND_BINARY:
+        # Legacy payloads and attachment notices read the same for both kinds of client
+        field, value = payload_field(payload, kind, False)
+        push('message', {'user': user, field: value, 'seq': seq}, to=room)
+        return
+    push('message', {'user': user, 'bin': payload, 'seq': seq}, to=mixed_room(room))
+
+@state_op('message')
+def _apply_message(op, local):
+    seq = store_message(op['room'], op['user'], op['payload'], op['kind'], op['ts'], announce=local)
+    if op['kind'] == KIND_ATTACHMENT:
+        ATTACHMENTS.adopt(op['room'], op['user'], op['payload'], op['ts'])
+    if local and not BROADCASTER.window:
+        broadcast_message(op['room'], op['user'], op['payload'], op['kind'], seq)
+
+# Admin ops carry lists so a bulk action is one broker message and one pass
+
+@state_op('clear')
+def _apply_clear(op, local):
+    for room in op['rooms']:
+        clear_room(room)
+        if local:
+            push('message', {'system': True, 'text': "All messages cleared by admin"}, to=room)
+
+@state_op('kick')
+def _apply_kick(op, local):
+    for r, users in kick_users(op['users']).items():
+        if local:
+            push('message', {'system': True, 'text': f"{', '.join(users)} {'was' if len(users) == 1 else 'were'} kicked by admin"}, to=r)
+    # Every worker closes the sockets it holds for the users
+    for user in op['users']:
+        for sid in unbind_user(user):
+            push('kicked', {}, to=sid)
+            drop(sid)
+
+@state_op('block')
+def _apply_block(op, local):
+    block_users(op['users'])
+
+@state_op('unblock')
+def _apply_unblock(op, local):
+    unblock_users(op['users'])
+
+BROKER.subscribe('state', apply_state)
+
+# ===========================
+# Deadlines
+# ===========================
+class DeadlineHeap:
+    """Min-heap of (deadline, key) and a loop that sweeps it as entries fall due.
+
+    Subclasses define sweep(now), taking due keys with pop_due(). run()
+    sleeps until the earliest deadline (at most EXPIRY_MAX_SLEEP), and wakes
+    early when push() adds an entry ahead of it.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+
+    def push(self, deadline, key, wake=True):
+        """Add an entry; sweep() re-queueing a key passes wake=False."""
+        with self._lock:
+            wake = wake and (not self._heap or deadline < self._heap[0][0])
+            heapq.heappush(self._heap, (deadline, key))
+        if wake:
+            self._wakeup.set()
+
+    def pop_due(self, now):
+        """Remove and return the earliest key if its deadline is <= now, else None."""
+        with self._lock:
+            if not self._heap or self._heap[0][0] > now:
+                return None
+            return heapq.heappop(self._heap)[1]
+
+    def next_deadline(self):
+        with self._lock:
+            return self._heap[0][0] if self._heap else None
+
+    def sweep(self, now=None):
+        raise NotImplementedError
+
+    def run(self):
+        """Background loop: sleep until the earliest deadline, then sweep."""
+        while True:
+            deadline = self.next_deadline()
+            timeout = EXPIRY_MAX_SLEEP if deadline is None else min(EXPIRY_MAX_SLEEP, max(0.0, deadline - time.time()))
+            self._wakeup.wait(timeout)
+            self._wakeup.clear()
+            self.sweep()
+
+# ===========================
+# Message Expiry
+# ===========================
+class ExpiryIndex(DeadlineHeap):
+    """Min-heap of (deadline, room) keyed on each room's oldest message.
+
+    Messages in a room are appended in timestamp order, so only the head of
+    each RoomLog can be due. A sweep pops the rooms whose head deadline has
+    passed, trims just the expired prefix and re-queues the room under its
+    new head, so the cost tracks the number of expired messages rather than
+    the number of stored ones.
+
+    Lock order is room_lock(room) -> self._lock; the heap lock is never held
+    while waiting on a room lock.
+    """
+
+    def __init__(self, ttl):
+        super().__init__()
+        self.ttl = ttl
+        self._scheduled = set()   # rooms with an entry in the heap
+        self.stats = {
+            'sweeps': 0,
+            'expired': 0,
+            'last_sweep_ms': 0.0,
+            'max_sweep_ms': 0.0,
+            'total_sweep_ms': 0.0,
+        }
+
+    def track(self, room, timestamp):
+        """Schedule `room` after a message was appended. Call with room_lock(room) held."""
+        with self._lock:
+            if room in self._scheduled:
+                return
+            self._scheduled.add(room)
+        self.push(timestamp + self.ttl, room)
+
+    def sweep(self, now=None):
+        """Drop every message older than the TTL; returns how many were removed."""
+        if now is None:
+            now = time.time()
+        started = time.perf_counter()
+        cutoff = now - self.ttl
+        expired = 0
+        while True:
+            room = self.pop_due(now)
+            if room is None:
+                break
+            with room_lock(room):
+                log = MESSAGES.get(room)
+                oldest = None
+                if log is not None:
+                    before = log.nbytes
+                    expired += log.expire(cutoff)
+                    BUDGET.charge(room, log.nbytes - before)
+                    oldest = log.oldest()
+                if oldest is not None:
+                    self.push(oldest + self.ttl, room, wake=False)
+                else:
+                    with self._lock:
+                        self._scheduled.discard(room)
+
+        elapsed = time.perf_counter() - started
+        elapsed_ms = elapsed * 1000.0
+        SWEEP_SECONDS.observe(elapsed)
+        st = self.stats
+        st['sweeps'] += 1
+        st['expired'] += expired
+        st['last_sweep_ms'] = elapsed_ms
+        st['total_sweep_ms'] += elapsed_ms
+        if elapsed_ms > st['max_sweep_ms']:
+            st['max_sweep_ms'] = elapsed_ms
+        if EXPIRY_LOG and expired:
+            print(f"[expiry] removed {expired} message(s) in {elapsed_ms:.3f} ms")
+        return expired
+
+EXPIRY = ExpiryIndex(MESSAGE_TTL)
+threading.Thread(target=EXPIRY.run, daemon=True).start()
+
+# ===========================
+# Idle Room Reclamation
+# ===========================
+class RoomReaper(DeadlineHeap):
+    """Min-heap of (deadline, room) for rooms that became empty.
+
+    A due room is reclaimed (via the replicated 'reclaim' op) only if it is
+    still empty and has been idle for ROOM_IDLE_SECONDS; a room that saw
+    activity since it was scheduled is pushed back to its new deadline.
+    """
+
+    def __init__(self, idle):
+        super().__init__()
+        self.idle = idle
+        self.stats = {'reclaimed': 0}
+
+    def schedule(self, room, since):
+        self.push(since + self.idle, room)
+
+    def sweep(self, now=None):
+        if now is None:
+            now = time.time()
+        while True:
+            room = self.pop_due(now)
+            if room is None:
+                return
+            if ROOMS.get(room) or room not in ROOMS:
+                continue   # someone joined (a later leave reschedules it), or already gone
+            deadline = LAST_ACTIVE.get(room, 0.0) + self.idle
+            if deadline > now:
+                self.push(deadline, room, wake=False)
+                continue
+            self.stats['reclaimed'] += 1
+            replicate('reclaim', room=room)
+
+REAPER = RoomReaper(ROOM_IDLE_SECONDS)
+threading.Thread(target=REAPER.run, daemon=True).start()
+
+# ===========================
+# Memory Budget
+# ===========================
+class MemoryBudget:
+    """Byte accounting for every RoomLog plus LRU eviction past the budget.
+
+    Rooms are kept in an OrderedDict in activity order (messages and joins
+    move a room to the end). When the stored total goes over `limit`, the
+    least-recently-active rooms have their logs cleared - not deleted, so
+    their seq counters keep going and clients see a gap rather than reused
+    seqs - until the total fits again.
+
+    Lock order is room_lock(room) -> self._lock, as for ExpiryIndex.
+    """
+
+    def __init__(self, limit, room_limit):
+        self.limit = limit
+        self.room_limit = room_limit
+        self.used = 0
+        self._recent = OrderedDict()   # room -> None, least recently active first
+        self._lock = threading.Lock()
+        self.stats = {
+            'evictions': 0,
+            'evicted_messages': 0,
+            'evicted_bytes': 0,
+            'trimmed_messages': 0,
+            'peak_bytes': 0,
+        }
+
+    def charge(self, room, delta, touch=False, forget=False):
+        """Add `delta` bytes stored for `room`. Call with room_lock(room) held."""
+        with self._lock:
+            self.used += delta
+            if self.used > self.stats['peak_bytes']:
+                self.stats['peak_bytes'] = self.used
+            if forget:
+                self._recent.pop(room, None)
+            elif touch:
+                self._recent[room] = None
+                self._recent.move_to_end(room)
+
+    def touch(self, room):
+        with self._lock:
+            if room in self._recent:
+                self._recent.move_to_end(room)
+
+    def over(self):
+        return self.used > self.limit
+
+    def _victim(self, keep):
+        with self._lock:
+            for room in self._recent:
+                if room != keep:
+                    return room
+        return None
+
+    def evict(self, keep=None):
+        """Clear least-recently-active rooms (never `keep`) until under the limit."""
+        while self.used > self.limit:
+            room = self._victim(keep)
+            if room is None:
+                break
+            with room_lock(room):
+                log = MESSAGES.get(room)
+                if log is None or not len(log):
+                    self.charge(room, -log.nbytes if log is not None else 0, forget=True)
+                    continue
+                st = self.stats
+                st['evictions'] += 1
+                st['evicted_messages'] += len(log)
+                st['evicted_bytes'] += log.nbytes
+                self.charge(room, -log.nbytes, forget=True)
+                log.clear()
+                if DURABLE is not None:
+                    DURABLE.append(room, OP_CLEAR, seq=log.last_seq, timestamp=time.time())
+            if EXPIRY_LOG:
+                print(f"[budget] evicted room {room}, {self.used:,} of {self.limit:,} bytes in use")
+        if self.used > self.limit and keep is not None:
+            # Only the room being written to is left: shed its oldest messages
+            with room_lock(keep):
+                log = MESSAGES.get(keep)
+                if log is not None:
+                    before = log.nbytes
+                    self.stats['trimmed_messages'] += log.trim(max(0, log.nbytes - (self.used - self.limit)))
+                    self.charge(keep, log.nbytes - before)
+
+BUDGET = MemoryBudget(MEMORY_BUDGET_BYTES, ROOM_MAX_BYTES)
+
+# ===========================
+# Broadcast Batching
+# ===========================
+class Broadcaster:
+    """Per-room outbound queues drained by a single dispatcher thread.
+
+    submit() only appends to the room's queue, so the receiving handler no
+    longer pays for the fan-out. The dispatcher waits `window` seconds after
+    the first pending message, then emits each room's queue, in order, as
+    one 'messages' event.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self._queues = {}   # room: [(user, payload, kind, seq), ...]
+        self._pending = 0
+        self._oldest = None  # perf_counter() of the oldest queued message
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self.stats = {
+            'batches': 0,
+            'messages': 0,
+            'queue_depth': 0,
+            'max_queue_depth': 0,
+            'last_fanout_ms': 0.0,
+            'max_fanout_ms': 0.0,
+            'total_fanout_ms': 0.0,
+        }
+
+    def submit(self, room, item):
+        with self._lock:
+            q = self._queues.get(room)
+            if q is None:
+                q = self._queues[room] = []
+            q.append(item)
+            self._pending += 1
+            if self._oldest is None:
+                self._oldest = time.perf_counter()
+            depth = self._pending
+        st = self.stats
+        st['queue_depth'] = depth
+        if depth > st['max_queue_depth']:
+            st['max_queue_depth'] = depth
+        self._wakeup.set()
+
+    def flush(self):
+        """Emit everything queued so far; returns the number of messages sent."""
+        with self._lock:
+            queues, self._queues = self._queues, {}
+            count, self._pending = self._pending, 0
+            oldest, self._oldest = self._oldest, None
+        self.stats['queue_depth'] = 0
+        if not queues:
+            return 0
+        for room, items in queues.items():
+            self._emit(room, items)
+        elapsed_ms = (time.perf_counter() - oldest) * 1000.0
+        st = self.stats
+        st['batches'] += len(queues)
+        st['messages'] += count
+        st['last_fanout_ms'] = elapsed_ms
+        st['total_fanout_ms'] += elapsed_ms
+        if elapsed_ms > st['max_fanout_ms']:
+            st['max_fanout_ms'] = elapsed_ms
+        return count
+
+    def _emit(self, room, items):
+        if all(kind == KIND_TEXT for _, _, kind, _ in items):
+            batch = [{'user': user, 'msg': payload.decode('utf-8'), 'seq': seq} for user, payload, _, seq in items]
+            push('messages', {'messages': batch}, to=room)
+            return
+        batch = []
+        for user, payload, kind, seq in items:
+            field, value = payload_field(payload, kind, True)
+            batch.append({'user': user, field: value, 'seq': seq})
+        push('messages', {'messages': batch}, to=mixed_room(room))
 
-# ===========================
-# Prefer Eventlet if available (better websockets)
-# ===========================
-ASYNC_MODE = "threading"
-try:
-    import eventlet  # type: ignore
-    eventlet.monkey_patch()
-    ASYNC_MODE = "eventlet"
-except Exception:
-    # Fall back to threading if eventlet isn't present
-    ASYNC_MODE = "threading"
+    def run(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            time.sleep(self.window)
+            self.flush()
 
-# ===========================
-# Flask / SocketIO Imports
-# ===========================
-from flask import Flask, render_template_string, request, redirect, url_for, session
-from flask_socketio import SocketIO, join_room
+BROADCASTER = Broadcaster(BATCH_WINDOW_MS / 1000.0)
+if BROADCASTER.window:
+    threading.Thread(target=BROADCASTER.run, daemon=True).start()
 
 # ===========================
-# Flask App & SocketIO Setup
+# Attachments
 # ===========================
-app = Flask(__name__)
-app.secret_key = os.urandom(32)
+# Files are opaque ciphertext uploaded in chunks of ATTACH_CHUNK_BYTES over
+# HTTP (PATCH with an Upload-Offset header; after a dropped connection the
+# client asks for the offset with HEAD and carries on from there). Chunks are
+# copied from the request stream straight to a spool file and downloads are
+# streamed from it with Range support, so memory use does not depend on file
+# size. A finished upload is announced to the room as a KIND_ATTACHMENT
+# message; every file is deleted MESSAGE_TTL after its announcement, along
+# with the message.
+ATTACH_COPY_BYTES = 64 * 1024
+ATTACH_ID_LENGTH = 22   # secrets.token_urlsafe(16)
 
-socketio = SocketIO(
-    app,
-    cors_allowed_origins="*",
-    async_mode=ASYNC_MODE,
-    ping_interval=25,
-    ping_timeout=60,
-)
+class Attachment:
+    __slots__ = ('id', 'room', 'user', 'size', 'meta', 'received', 'created', 'announced', 'expires', 'lock')
+
+    def __init__(self, att_id, room, user, size, meta, received, created):
+        self.id = att_id
+        self.room = room
+        self.user = user
+        self.size = size
+        self.meta = meta
+        self.received = received
+        self.created = created
+        self.announced = received == size
+        self.expires = created   # set by AttachmentStore
+        self.lock = threading.Lock()
+
+class AttachmentStore(DeadlineHeap):
+    """Spooled attachments by id, deleted from the deadline heap as they expire.
+
+    Upload progress is known only to the worker receiving the upload; the
+    replicated announcement tells every other worker the file's room and
+    size, so any worker sharing ATTACH_DIR can serve the download.
+    """
+
+    def __init__(self, directory, ttl, disk_limit, user_limit, room_limit, stall):
+        super().__init__()   # self._lock also guards _items and the reserved counts
+        self.dir = directory
+        self.ttl = ttl
+        self.disk_limit = disk_limit
+        self.user_limit = user_limit
+        self.room_limit = room_limit
+        self.stall = stall
+        self.reserved = 0
+        self._by_user = {}   # user: reserved bytes
+        self._by_room = {}   # room: reserved bytes
+        self._items = {}
+        self.stats = {'uploads': 0, 'completed': 0, 'expired': 0, 'stalled': 0, 'refused': 0, 'bytes_in': 0}
+        os.makedirs(directory, exist_ok=True)
+        # Files left by an earlier run (or another worker) expire by mtime
+        now = time.time()
+        for name in os.listdir(directory):
+            if name.endswith('.bin'):
+                try:
+                    self._schedule(name[:-4], os.path.getmtime(os.path.join(directory, name)) + ttl, now)
+                except OSError:
+                    pass
+
+    def path(self, att_id):
+        return os.path.join(self.dir, att_id + '.bin')
+
+    def get(self, att_id):
+        if len(att_id) != ATTACH_ID_LENGTH:
+            return None
+        return self._items.get(att_id)
+
+    def __len__(self):
+        return len(self._items)
+
+    def _schedule(self, att_id, deadline, now=None):
+        if deadline <= (time.time() if now is None else now):
+            self._remove(att_id)
+            return
+        self.push(deadline, att_id)
+
+    def _add(self, item, expires, limit=True):
+        """Track `item` until `expires`; returns the limit it would exceed ('disk', 'user', 'room') or None."""
+        with self._lock:
+            if item.id in self._items:
+                return 'disk'
+            if limit:
+                if self.reserved + item.size > self.disk_limit:
+                    return 'disk'
+                if self._by_user.get(item.user, 0) + item.size > self.user_limit:
+                    return 'user'
+                if self._by_room.get(item.room, 0) + item.size > self.room_limit:
+                    return 'room'
+            self._items[item.id] = item
+            self.reserved += item.size
+            self._by_user[item.user] = self._by_user.get(item.user, 0) + item.size
+            self._by_room[item.room] = self._by_room.get(item.room, 0) + item.size
+        item.expires = expires
+        self._schedule(item.id, expires)
+        return None
+
+    def create(self, room, user, size, meta):
+        """Start an upload; returns (item, None), or (None, the limit it would exceed)."""
+        item = Attachment(secrets.token_urlsafe(16), room, user, size, meta, 0, time.time())
+        limit = self._add(item, item.created + self.stall)
+        if limit:
+            self.stats['refused'] += 1
+            return None, limit
+        open(self.path(item.id), 'wb').close()
+        self.stats['uploads'] += 1
+        return item, None
+
+    def adopt(self, room, user, payload, ts):
+        """Learn about an attachment from its announcement (other workers, recovery)."""
+        notice = json.loads(payload)
+        att_id, size = notice.get('id'), notice.get('size')
+        if not isinstance(att_id, str) or len(att_id) != ATTACH_ID_LENGTH or not isinstance(size, int):
+            return
+        if not os.path.exists(self.path(att_id)):
+            return   # expired already, or spooled on another host
+        # The file is already on disk, so it is tracked even past disk_limit
+        self._add(Attachment(att_id, room, user, size, notice.get('meta', ''), size, ts), ts + self.ttl, limit=False)
+
+    def write(self, item, offset, stream, length):
+        """Copy `length` bytes of `stream` into the file at `offset`.
+
+        Returns False without reading if `offset` is not where the upload
+        stands or another request is writing it. A body cut short still
+        counts what arrived, so the client resumes after the last byte.
+        """
+        if not item.lock.acquire(blocking=False):
+            return False
+        try:
+            if offset != item.received:
+                return False
+            with open(self.path(item.id), 'r+b') as f:
+                f.seek(offset)
+                while length > 0:
+                    chunk = stream.read(min(ATTACH_COPY_BYTES, length))
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    length -= len(chunk)
+                    item.received += len(chunk)
+                    item.expires = time.time() + self.stall   # still arriving
+                    self.stats['bytes_in'] += len(chunk)
+            return True
+        finally:
+            item.lock.release()
+
+    def finish(self, item):
+        """True exactly once, when a complete upload should be announced."""
+        with item.lock:
+            if item.announced or item.received != item.size or item.id not in self._items:
+                return False
+            item.announced = True
+            # Kept as long as the message announcing it
+            item.expires = time.time() + self.ttl
+        self.stats['completed'] += 1
+        return True
+
+    def _remove(self, att_id):
+        with self._lock:
+            item = self._items.pop(att_id, None)
+            if item is not None:
+                self.reserved -= item.size
+                for counts, key in ((self._by_user, item.user), (self._by_room, item.room)):
+                    left = counts[key] - item.size
+                    if left:
+                        counts[key] = left
+                    else:
+                        del counts[key]
+        try:
+            os.remove(self.path(att_id))
+        except OSError:
+            return
+        self.stats['expired'] += 1
+
+    def sweep(self, now=None):
+        if now is None:
+            now = time.time()
+        while True:
+            att_id = self.pop_due(now)
+            if att_id is None:
+                return
+            item = self._items.get(att_id)
+            if item is not None and item.expires > now:
+                self.push(item.expires, att_id, wake=False)   # a chunk or the announcement since
+                continue
+            if item is not None and not item.announced:
+                self.stats['stalled'] += 1
+            self._remove(att_id)
+
+ATTACHMENTS = AttachmentStore(ATTACH_DIR, MESSAGE_TTL, ATTACH_DISK_BYTES, ATTACH_USER_BYTES, ATTACH_ROOM_BYTES,
+                              ATTACH_STALL_SECONDS)
+threading.Thread(target=ATTACHMENTS.run, daemon=True).start()
 
 # ===========================
-# In-memory storage
+# Durable Log
 # ===========================
-ROOMS = {}          # room_code: [usernames]
-MESSAGES = {}       # room_code: [{'user':user,'msg':encrypted,'timestamp':ts}]
-BLOCKED_USERS = set()
-STORE_LOCK = threading.Lock()
+# Record layout: header, then room, user and payload bytes. A zero length
+# marks the end of a segment's records; a bad CRC marks a torn tail write.
+REC_HEADER = struct.Struct('<IIBBQdHH')   # length, crc32, op, kind, seq, timestamp, room len, user len
+OP_OPEN = 1
+OP_MESSAGE = 2
+OP_CLEAR = 3
+OP_RECLAIM = 4    # the room was deleted; a later OP_OPEN starts it afresh
+
+class Segment:
+    """One preallocated, memory-mapped log file that is only ever appended to."""
+
+    __slots__ = ('path', 'file', 'mm', 'pos', 'size', 'opened', 'last_ts', 'dirty')
+
+    def __init__(self, path, size):
+        self.path = path
+        self.file = open(path, 'w+b')
+        self.file.truncate(size)
+        self.mm = mmap.mmap(self.file.fileno(), size)
+        self.pos = 0
+        self.size = size
+        self.opened = time.time()
+        self.last_ts = 0.0
+        self.dirty = False
+
+    def write(self, op, kind, seq, timestamp, room_b, user_b, payload):
+        """Append one record; returns False when it does not fit."""
+        total = REC_HEADER.size + len(room_b) + len(user_b) + len(payload)
+        if self.pos + total + 4 > self.size:   # keep a zero length after the last record
+            return False
+        crc = zlib.crc32(payload, zlib.crc32(user_b, zlib.crc32(room_b)))
+        mm, p = self.mm, self.pos
+        REC_HEADER.pack_into(mm, p, total, crc, op, kind, seq, timestamp, len(room_b), len(user_b))
+        p += REC_HEADER.size
+        for part in (room_b, user_b, payload):
+            mm[p:p + len(part)] = part
+            p += len(part)
+        self.pos = p
+        if timestamp > self.last_ts:
+            self.last_ts = timestamp
+        self.dirty = True
+        return True
+
+    def flush(self):
+        if self.dirty:
+            self.dirty = False
+            self.mm.flush()
+
+    def close(self):
+        self.mm.flush()
+        self.mm.close()
+        self.file.truncate(self.pos)
+        self.file.close()
+
+def read_segment(path):
+    """Yield (op, kind, seq, timestamp, room, user, payload) for each intact record in `path`."""
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            pos, end, hsize = 0, len(mm), REC_HEADER.size
+            while pos + hsize <= end:
+                total, crc, op, kind, seq, ts, room_len, user_len = REC_HEADER.unpack_from(mm, pos)
+                if total == 0 or pos + total > end:
+                    break
+                body = mm[pos + hsize:pos + total]
+                if zlib.crc32(body) != crc:
+                    break
+                room = body[:room_len].decode('utf-8')
+                user = body[room_len:room_len + user_len].decode('utf-8')
+                yield op, kind, seq, ts, room, user, body[room_len + user_len:]
+                pos += total
+
+class LogShard:
+    """Segments for the rooms hashed to one shard, oldest first.
+
+    Writers only append to the active segment and swap in a new one when it
+    fills up; closing, msync and deleting old segments is left to the
+    flusher thread, so writers never wait on the disk.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()
+        self.closed = []      # [(path, newest timestamp)], oldest first
+        self.retired = []     # full segments waiting for the flusher to close them
+        self.active = None
+        self.next_index = 0
+
+    def segment_paths(self):
+        return sorted(os.path.join(self.directory, n) for n in os.listdir(self.directory) if n.endswith('.seg'))
+
+    def _roll(self, need):
+        if self.active is not None:
+            self.retired.append(self.active)
+        path = os.path.join(self.directory, f"{self.next_index:010d}.seg")
+        self.next_index += 1
+        self.active = Segment(path, max(SEGMENT_BYTES, need + REC_HEADER.size + 4))
+
+    def append(self, op, kind, seq, timestamp, room_b, user_b, payload):
+        with self.lock:
+            if self.active is None or not self.active.write(op, kind, seq, timestamp, room_b, user_b, payload):
+                self._roll(len(room_b) + len(user_b) + len(payload))
+                self.active.write(op, kind, seq, timestamp, room_b, user_b, payload)
+
+    def maintain(self, now, cutoff):
+        """Flush (group commit), close full segments, roll an old one and drop expired files."""
+        with self.lock:
+            active, retired, self.retired = self.active, self.retired, []
+            if active is not None and active.pos and now - active.opened >= SEGMENT_SECONDS:
+                retired.append(active)
+                self.active = active = None
+        for seg in retired:
+            seg.close()
+            self.closed.append((seg.path, seg.last_ts))
+        if active is not None:
+            active.flush()
+        while self.closed and self.closed[0][1] <= cutoff:
+            path, _ = self.closed.pop(0)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+def settle_recovered_rooms():
+    """Schedule, trim and charge every room rebuilt at startup (log replay or snapshot)."""
+    # Rooms nobody is in (after a restart: all of them) start their idle clock
+    for room, log in list(MESSAGES.items()):
+        if not ROOMS.setdefault(room, {}):
+            REAPER.schedule(room, LAST_ACTIVE.get(room, time.time()))
+        if log.nbytes > BUDGET.room_limit:
+            BUDGET.stats['trimmed_messages'] += log.trim(BUDGET.room_limit)
+    # Charge rooms oldest-active first so the LRU order matches the log
+    for room in sorted(MESSAGES, key=lambda r: LAST_ACTIVE.get(r, 0.0)):
+        BUDGET.charge(room, MESSAGES[room].nbytes, touch=True)
+    if BUDGET.over():
+        BUDGET.evict()
+
+class DurableLog:
+    """Append-only, segmented, memory-mapped persistence for room state."""
+
+    def __init__(self, directory, shards=LOG_SHARDS):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.shards = [LogShard(os.path.join(directory, f"shard-{i:02d}")) for i in range(shards)]
+        self.blocked_path = os.path.join(directory, "blocked.json")
+        self.stats = {'records': 0, 'recovered': 0, 'recovery_ms': 0.0, 'flushes': 0}
+
+    def _shard(self, room):
+        # Stable across restarts, unlike hash()
+        return self.shards[zlib.crc32(room.encode('utf-8')) % len(self.shards)]
+
+    def append(self, room, op, user='', payload=b'', kind=0, seq=0, timestamp=0.0):
+        self._shard(room).append(op, kind, seq, timestamp, room.encode('utf-8'), user.encode('utf-8'), payload)
+        self.stats['records'] += 1
+
+    def save_blocked(self, users):
+        tmp = self.blocked_path + ".tmp"
+        with open(tmp, 'w') as f:
+            json.dump(sorted(users), f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.blocked_path)
+
+    def recover(self):
+        """Rebuild ROOMS, MESSAGES and BLOCKED_USERS from disk. Call before serving."""
+        global BLOCKED_USERS
+        started = time.perf_counter()
+        cutoff = time.time() - MESSAGE_TTL
+        if os.path.exists(self.blocked_path):
+            with open(self.blocked_path) as f:
+                BLOCKED_USERS = frozenset(json.load(f))
+        count = 0
+        for shard in self.shards:
+            for path in shard.segment_paths():
+                newest = 0.0
+                for op, kind, seq, ts, room, user, payload in read_segment(path):
+                    newest = max(newest, ts)
+                    count += 1
+                    if ts <= cutoff:
+                        continue
+                    if op == OP_RECLAIM:
+                        ROOMS.pop(room, None)
+                        MESSAGES.pop(room, None)
+                        LAST_ACTIVE.pop(room, None)
+                        continue
+                    log = MESSAGES.get(room)
+                    if log is None:
+                        log = MESSAGES[room] = RoomLog()
+                    if op == OP_MESSAGE:
+                        log.restore(seq, user, payload, ts, kind)
+                        if kind == KIND_ATTACHMENT:
+                            ATTACHMENTS.adopt(room, user, payload, ts)
+                        EXPIRY.track(room, ts)
+                        LAST_ACTIVE[room] = max(LAST_ACTIVE.get(room, 0.0), ts)
+                    elif op == OP_OPEN:
+                        ROOMS.setdefault(room, {})
+                        LAST_ACTIVE[room] = max(LAST_ACTIVE.get(room, 0.0), ts)
+                    elif op == OP_CLEAR:
+                        log.last_seq = max(log.last_seq, seq)
+                        log.clear()
+                shard.closed.append((path, newest))
+                shard.next_index = max(shard.next_index, int(os.path.basename(path)[:-4]) + 1)
+        settle_recovered_rooms()
+        self.stats['recovered'] = count
+        self.stats['recovery_ms'] = (time.perf_counter() - started) * 1000.0
+        return count
+
+    def flush(self):
+        now = time.time()
+        cutoff = now - MESSAGE_TTL
+        for shard in self.shards:
+            shard.maintain(now, cutoff)
+        self.stats['flushes'] += 1
+
+    def rebase(self):
+        """Record the whole store after it was replaced (peer bootstrap), superseding older records."""
+        now = time.time()
+        for room in list(MESSAGES):
+            with room_lock(room):
+                log = MESSAGES.get(room)
+                if log is None:
+                    continue
+                self.append(room, OP_OPEN, timestamp=now)
+                self.append(room, OP_CLEAR, seq=log.first_seq - 1, timestamp=now)
+                for seq, user, payload, kind, ts in log.records():
+                    self.append(room, OP_MESSAGE, user, payload, kind, seq, ts)
+        self.save_blocked(BLOCKED_USERS)
+
+    def seal(self):
+        """Close every active segment and sync it to disk (shutdown, tests)."""
+        for shard in self.shards:
+            with shard.lock:
+                if shard.active is not None:
+                    shard.retired.append(shard.active)
+                    shard.active = None
+        self.flush()
+
+    def run(self):
+        while True:
+            time.sleep(FSYNC_INTERVAL_MS / 1000.0)
+            self.flush()
+
+DURABLE = None
+if DATA_DIR:
+    DURABLE = DurableLog(DATA_DIR)
+    DURABLE.recover()
+    threading.Thread(target=DURABLE.run, daemon=True).start()
 
 # ===========================
-# HTML Templates
+# Drain & Snapshot
 # ===========================
-LOGIN_HTML = """
-<!DOCTYPE html>
-<html>
-<head>
-<title>Secure Chat Login</title>
-<meta name="viewport" content="width=device-width, initial-scale=1" />
-<style>
-body { background:#000; color:#0f0; font-family:'Courier New', monospace; display:flex; justify-content:center; align-items:center; height:100vh; margin:0;}
-.login { border:2px solid #0f0; padding:30px; border-radius:10px; text-align:center; box-shadow:0 0 15px #0f0; width:320px; max-width:92vw;}
-input { background:#000; border:1px solid #0f0; color:#0f0; padding:10px; margin:10px 0; width:100%; border-radius:6px;}
-button { background:#0f0; color:#000; padding:12px; border:none; cursor:pointer; width:100%; border-radius:8px; font-weight:bold;}
-button:hover { background:#050; color:#0f0; }
-.small { color:#8f8; font-size:12px; margin-top:8px; }
-</style>
-</head>
-<body>
-<div class="login">
-  <h2>🔒 Secure Chat Portal 🔒</h2>
-  <form method="POST">
-    <input type="text" name="username" placeholder="Enter your name" autocomplete="username" required>
-    <input type="text" name="room" placeholder="Paste Room/Friend ID (optional)">
-    <button type="submit">Enter Chat</button>
-  </form>
-  <div class="small">Leave Room ID blank to create a new room.</div>
-</div>
-</body>
-</html>
-"""
+# Snapshot layout: each room's live RoomLog columns as raw array bytes (times,
+# user ids, kinds, payload lengths) followed by its payloads back to back,
+# then a JSON index (rooms, seqs, acks, user names, block list) and a fixed
+# trailer. Arrays are in native byte order: a snapshot is read on the host
+# that wrote it.
+SNAP_TRAILER = struct.Struct('<QI8s')   # index offset, crc32 of everything before the trailer, magic
+SNAP_MAGIC = b'E2EESNP1'
 
-CHAT_HTML = """
-<!DOCTYPE html>
-<html>
-<head>
-<title>Secure Chat</title>
-<meta name="viewport" content="width=device-width, initial-scale=1" />
-<style>
-:root { --g:#0f0; --bg: rgba(0,0,0,0.6); }
-html, body { height:100%; }
-body {
-    background: url('https://i.imgur.com/kq3n1uR.jpg') no-repeat center center fixed;
-    background-size: cover;
-    color:var(--g);
-    font-family:'Courier New', monospace;
-    margin:0; padding:0;
-    min-height:100vh;
-    display:flex; flex-direction:column;
-}
-header { position:relative; text-align:center; font-size:1.5em; padding:16px 48px; text-shadow:0 0 10px var(--g); }
-.logout { position:absolute; top:12px; right:12px; background:var(--g); color:#000; padding:10px 14px; border:none; border-radius:8px; cursor:pointer; font-weight:bold; }
-.container { display:flex; flex-direction:column; gap:8px; padding:10px; }
-#chat-box { flex:1; overflow:auto; margin:10px; border:1px solid var(--g); padding:10px; max-height:70vh; background: var(--bg); border-radius:10px; }
-.message { padding:8px 10px; margin:6px 0; border-radius:10px; max-width:80%; word-break:break-word; display:inline-block; }
-.sent { background:var(--g); color:#000; align-self:flex-end; text-align:right; }
-.received { background:#063; color:var(--g); align-self:flex-start; text-align:left; }
-.system { color:#9c9; font-style:italic; }
-.controls { display:flex; gap:8px; align-items:center; padding:10px; }
-#msg-input { flex:1; padding:10px; background:#000; color:var(--g); border:1px solid var(--g); border-radius:8px; }
-button.send { padding:10px 14px; border-radius:8px; border:1px solid var(--g); background:#001900; color:var(--g); cursor:pointer; font-weight:bold; }
-button.send:hover { background:#052; }
-</style>
-<script src="https://cdnjs.cloudflare.com/ajax/libs/socket.io/4.6.1/socket.io.min.js" integrity="sha512-R0L9f7rYpPoa6b5xPL7aHiM2YjP1YGrwWQITn08b6+mLllm0k3nSP0Q8nM7Hk8U8B9z7bE+0g1tZ2zUqhSItZw==" crossorigin="anonymous" referrerpolicy="no-referrer"></script>
-<script>
-const socket = io();
-const username = "{{ username }}";
-const room = "{{ room }}";
+def dump_snapshot(f, members=False):
+    """Write the store to the binary file `f`; returns (rooms, messages, bytes).
 
-// "Toy" encryption: Base64(Morse). Do not use in real-world.
-const MORSE = {'A':'.-','B':'-...','C':'-.-.','D':'-..','E':'.','F':'..-.','G':'--.','H':'....','I':'..','J':'.---','K':'-.-','L':'.-..','M':'--','N':'-.','O':'---','P':'.--.','Q':'--.-','R':'.-.','S':'...','T':'-','U':'..-','V':'...-','W':'.--','X':'-..-','Y':'-.--','Z':'--..',' ':'/','0':'-----','1':'.----','2':'..---','3':'...--','4':'....-','5':'.....','6':'-....','7':'--...','8':'---..','9':'----.'};
-function toMorse(text){ return text.toUpperCase().split('').map(c=>MORSE[c]||c).join(' '); }
-function fromMorse(code){ const rev = Object.fromEntries(Object.entries(MORSE).map(([k,v])=>[v,k])); return code.split(' ').map(c=>rev[c]||c).join(''); }
-function encryptMessage(msg){ return btoa(unescape(encodeURIComponent(toMorse(msg)))); }
-function decryptMessage(msg){ try{ return fromMorse(decodeURIComponent(escape(atob(msg)))); }catch(e){ return "✖ Unable to decrypt"; } }
+    With `members`, each room's member counts go in too (a copy for a peer;
+    after a restart nobody is connected, so the drain snapshot leaves them out).
+    """
+    entries, crc, size, messages = [], 0, 0, 0
+    table = {}   # username: id in the file
 
-function sendMessage(){
-    const input = document.getElementById('msg-input');
-    let msg = input.value;
-    if(msg.trim()==="") return;
-    let encrypted = encryptMessage(msg);
-    socket.emit('message', {'user':username,'room':room,'msg':encrypted});
-    input.value = '';
-}
+    def put(data):
+        nonlocal crc, size
+        f.write(data)
+        crc = zlib.crc32(data, crc)
+        size += len(data)
 
-socket.emit('join', {'username': username, 'room': room});
+    for room in list(ROOMS) + [r for r in list(MESSAGES) if r not in ROOMS]:
+        # Copy the live columns under the room's lock, write them without it
+        with room_lock(room):
+            if room not in ROOMS and room not in MESSAGES:
+                continue
+            log = MESSAGES.get(room)
+            if log is None:
+                log = RoomLog()
+            h = log.head
+            users = log.users[h:]
+            names = log.names[:]
+            columns = (log.times[h:], users, log.kinds[h:])
+            payloads = log.payloads[h:]
+            seqs = (log.first_seq, log.last_seq)
+            acks = dict(ACKS.get(room, ()))
+            last_active = LAST_ACTIVE.get(room, 0.0)
+            extra = [dict(ROOMS.get(room) or ())] if members else []
+        # Ids in the file index one user table shared by all rooms
+        remap = {uid: table.setdefault(names[uid], len(table)) for uid in set(users)}
+        if any(uid != sid for uid, sid in remap.items()):
+            columns = (columns[0], array('I', [remap[u] for u in users]), columns[2])
+        for column in columns + (array('I', map(len, payloads)),):
+            put(column.tobytes())
+        blob = b''.join(payloads)
+        put(blob)
+        messages += len(payloads)
+        entries.append([room, *seqs, last_active, len(payloads), len(blob), acks, *extra])
+    index = {'version': 1, 'created': time.time(), 'users': list(table),
+             'blocked': sorted(BLOCKED_USERS), 'rooms': entries}
+    offset = size
+    put(json.dumps(index, separators=(',', ':')).encode('utf-8'))
+    f.write(SNAP_TRAILER.pack(offset, crc, SNAP_MAGIC))
+    return len(entries), messages, size + SNAP_TRAILER.size
 
-socket.on('message', function(data){
-    let chatBox = document.getElementById('chat-box');
-    let wrapper = document.createElement('div');
-    if(data.system){
-        wrapper.className = 'system';
-        wrapper.textContent = "[SYSTEM] " + data.text;
-    } else {
-        wrapper.className = 'message ' + (data.user===username ? 'sent' : 'received');
-        wrapper.textContent = data.user + ": " + decryptMessage(data.msg);
-    }
-    chatBox.appendChild(wrapper);
-    chatBox.scrollTop = chatBox.scrollHeight;
-});
+def write_snapshot(path):
+    """Write the store to `path` (atomically); returns (rooms, messages, bytes)."""
+    tmp = path + ".tmp"
+    with open(tmp, 'wb') as f:
+        written = dump_snapshot(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return written
 
-document.addEventListener('keydown', (e) => {
-  if (e.key === 'Enter') { sendMessage(); }
-});
-</script>
-</head>
-<body>
-  <header>🔒 Room: {{ room }} | User: {{ username }} 🔒
-    <a href="{{ url_for('logout') }}" class="logout">Logout</a>
-  </header>
-  <div class="container">
-    <div id="chat-box"></div>
-    <div class="controls">
-      <input type="text" id="msg-input" placeholder="Type message...">
-      <button class="send" onclick="sendMessage()">Send</button>
-    </div>
-  </div>
-</body>
-</html>
-"""
+def load_snapshot(path):
+    """Rebuild ROOMS, MESSAGES, ACKS and BLOCKED_USERS from `path`. Call before serving."""
+    with open(path, 'rb') as f:
+        return restore_snapshot(f.read(), path)
+
+def restore_snapshot(data, source="snapshot", members=False):
+    """Rebuild the store from snapshot bytes into an empty store; returns (rooms, messages).
+
+    With `members`, rooms get the member counts saved in the snapshot (if any)
+    and USER_ROOMS is rebuilt from them; otherwise every room starts empty.
+    """
+    global BLOCKED_USERS
+    end = len(data) - SNAP_TRAILER.size
+    offset, crc, magic = SNAP_TRAILER.unpack_from(data, end) if end >= 0 else (0, 0, b'')
+    view = memoryview(data)
+    if magic != SNAP_MAGIC or offset > end or zlib.crc32(view[:end]) != crc:
+        raise ValueError(f"{source} is not a complete snapshot")
+    index = json.loads(view[offset:end].tobytes())
+    users = [sys.intern(name) for name in index['users']]
+    BLOCKED_USERS = frozenset(index['blocked'])
+    cutoff = time.time() - MESSAGE_TTL
+    pos = messages = 0
+    for room, first_seq, last_seq, last_active, count, blob_size, acks, *extra in index['rooms']:
+        log = RoomLog()
+        lengths = array('I')
+        for column in (log.times, log.users, log.kinds, lengths):
+            n = column.itemsize * count
+            column.frombytes(view[pos:pos + n])
+            pos += n
+        # The file's user ids become the room's own
+        log.names = users
+        log._renumber()
+        payloads = log.payloads
+        for n in lengths:
+            payloads.append(data[pos:pos + n])
+            pos += n
+        log.first_seq, log.last_seq = first_seq, last_seq
+        log.nbytes = blob_size + RECORD_OVERHEAD * count
+        log.expire(cutoff)
+        ROOMS[room] = dict(extra[0]) if members and extra else {}
+        if ROOMS[room]:
+            with PRESENCE_LOCK:
+                for user in ROOMS[room]:
+                    USER_ROOMS.setdefault(user, set()).add(room)
+        MESSAGES[room] = log
+        LAST_ACTIVE[room] = last_active
+        if acks:
+            ACKS[room] = acks
+        if len(log):
+            EXPIRY.track(room, log.oldest())
+            if KIND_ATTACHMENT in log.kinds:
+                for _, user, payload, kind, ts in log.records():
+                    if kind == KIND_ATTACHMENT:
+                        ATTACHMENTS.adopt(room, user, payload, ts)
+        messages += len(log)
+    settle_recovered_rooms()
+    return len(index['rooms']), messages
+
+class Drainer:
+    """SIGTERM: hand every client over to the next process, save the state, exit.
+
+    From the start of a drain joins are refused (the socket is told to come
+    back later), queued broadcasts go out and each joined socket gets a
+    'restart' with its own reconnect delay. The delays are spread evenly over
+    `jitter` seconds in random order, so the new process sees a steady trickle
+    of reconnects rather than all of them at once. Once the sockets have left
+    (or `timeout` passed) messages are refused and the snapshot is written
+    (with E2EE_DATA_DIR, the log is sealed instead).
+    """
+
+    def __init__(self, path, jitter, timeout):
+        self.path = path
+        self.jitter = jitter
+        self.timeout = timeout
+        self.signalled = False
+        self.draining = False
+        self.closed = False
+        self.stats = {
+            'notified': 0,
+            'drain_ms': 0.0,
+            'snapshot_ms': 0.0,
+            'snapshot_bytes': 0,
+            'restored_rooms': 0,
+            'restored_messages': 0,
+            'restore_ms': 0.0,
+        }
+
+    def restore(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        started = time.perf_counter()
+        try:
+            rooms, messages = load_snapshot(self.path)
+        except (OSError, ValueError) as e:
+            print(f"[!] Snapshot not loaded: {e}")
+            return
+        # Loaded once: a later crash must not bring back this older state
+        os.remove(self.path)
+        self.stats['restored_rooms'] = rooms
+        self.stats['restored_messages'] = messages
+        self.stats['restore_ms'] = (time.perf_counter() - started) * 1000.0
+
+    def reconnect_delay(self):
+        return int(random.random() * self.jitter * 1000)
+
+    def begin(self):
+        """Start draining in the background; False if already draining."""
+        if self.draining:
+            return False
+        self.draining = True
+        threading.Thread(target=self.run, daemon=True).start()
+        return True
+
+    def watch(self):
+        """Drain on SIGTERM under the WSGI engines (uvicorn's handler calls begin()).
+
+        The handler only writes to a socket pair: it runs on eventlet's hub,
+        which cannot start threads and would not wake up for a new task, so a
+        background task reading the other end starts the drain.
+        """
+        reader, writer = socket.socketpair()
+        writer.setblocking(False)
+
+        def on_signal(signum, frame):
+            # A second SIGTERM stops at once
+            if self.signalled:
+                os._exit(1)
+            self.signalled = True
+            writer.send(b'\0')
+
+        def wait():
+            reader.recv(1)
+            self.begin()
+
+        socketio.start_background_task(wait)
+        signal.signal(signal.SIGTERM, on_signal)
+
+    def notify(self):
+        sids = list(SIDS)
+        slots = random.sample(range(len(sids)), len(sids))
+        window = self.jitter * 1000 / max(1, len(sids))
+        for sid, slot in zip(sids, slots):
+            push('restart', {'delay_ms': int((slot + random.random()) * window)}, to=sid)
+        self.stats['notified'] = len(sids)
+
+    def run(self):
+        started = time.perf_counter()
+        BROADCASTER.flush()
+        self.notify()
+        deadline = time.time() + self.timeout
+        while SIDS and time.time() < deadline:
+            time.sleep(0.05)
+        self.closed = True
+        BROADCASTER.flush()
+        snapshot = ""
+        if DURABLE is not None:
+            DURABLE.seal()
+        elif self.path:
+            t0 = time.perf_counter()
+            rooms, messages, size = write_snapshot(self.path)
+            self.stats['snapshot_ms'] = (time.perf_counter() - t0) * 1000.0
+            self.stats['snapshot_bytes'] = size
+            snapshot = (f"; snapshot {rooms} rooms, {messages} messages, {size / 2**20:.1f} MiB "
+                        f"in {self.stats['snapshot_ms']:.0f} ms")
+        self.stats['drain_ms'] = (time.perf_counter() - started) * 1000.0
+        print(f"[*] Drained {self.stats['notified']} sockets in {self.stats['drain_ms']:.0f} ms{snapshot}", flush=True)
+        os._exit(0)
+
+DRAIN = Drainer(SNAPSHOT_PATH, DRAIN_JITTER_SECONDS, DRAIN_TIMEOUT)
+if DURABLE is None:
+    DRAIN.restore()
 
 # ===========================
-# Utility Functions
+# Peer Bootstrap
 # ===========================
-def generate_room_code(length=6):
-    return ''.join(random.choices(string.ascii_uppercase + string.digits, k=length))
+class PeerBootstrap:
+    """Copy the store from a running worker before this one serves.
 
-def find_free_port():
-    s = socket.socket()
-    s.bind(('', 0))
-    port = s.getsockname()[1]
-    s.close()
-    return port
+    Running workers offer to answer our 'state_request' with a 'state_claim'
+    after a short random delay (skipped once another claim has been seen).
+    Every worker applies state ops in the broker's order, so the first claim
+    is the same cut everywhere: its sender copies the store (with member
+    counts) when the claim comes back, holding exactly the ops before it, and
+    only that worker serializes anything. Ops arriving here after the claim
+    are held and applied on top of the copy; ops before it are already in it
+    (and are only applied if no peer answers, i.e. this is the first worker).
+    """
 
-def get_local_ip():
-    try:
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.connect(("8.8.8.8", 80))
-        ip = s.getsockname()[0]
-        s.close()
-        return ip
-    except Exception:
-        return "127.0.0.1"
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.request = None
+        self.phase = None      # None (serving), 'early' or 'held' while bootstrapping
+        self._early = []       # ops before our request: already in a peer's copy
+        self._held = []        # ops after it: applied on top of the copy
+        self._claimed = set()  # requests whose first claim was seen
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self.stats = {'source': None, 'rooms': 0, 'messages': 0, 'bytes': 0, 'ms': 0.0, 'served': 0}
 
-def clean_old_messages():
-    while True:
-        now = time.time()
-        with STORE_LOCK:
-            for room, msgs in list(MESSAGES.items()):
-                MESSAGES[room] = [m for m in msgs if now - m['timestamp'] < 600]
-        time.sleep(60)
+    def run(self):
+        started = time.perf_counter()
+        with self._lock:
+            self.request = uuid.uuid4().hex
+            self.phase = 'early'
+        if replicate('state_request', request=self.request):
+            self._done.wait(self.timeout)
+        with self._lock:
+            if self.phase is not None:
+                # Nobody answered: whatever arrived meanwhile applies to the local state
+                self._finish(self._early + self._held)
+        self.stats['ms'] = (time.perf_counter() - started) * 1000.0
+        if self.stats['source']:
+            print(f"[*] Bootstrap: copied {self.stats['rooms']} rooms, {self.stats['messages']} messages "
+                  f"from worker {self.stats['source']} in {self.stats['ms']:.0f} ms")
+        else:
+            print("[*] Bootstrap: no running worker answered; starting from local state")
 
-def open_browser_links(port, local_ip):
-    time.sleep(1)  # wait for server to start
-    try:
-        webbrowser.open(f"http://localhost:{port}")
-        webbrowser.open(f"http://{local_ip}:{port}")
-    except Exception:
-        print("[!] Unable to auto-launch browser, open manually.")
+    def hold(self, message):
+        """True if `message` was taken here rather than applied normally."""
+        if self.phase is None:
+            return False
+        with self._lock:
+            if self.phase is None:
+                return False
+            op = message.get('op')
+            if op == 'state_claim' and message.get('request') == self.request:
+                self.phase = 'held'
+            elif op == 'state_reply' and message.get('to') == WORKER_ID and self.phase == 'held':
+                self._adopt(message)
+            elif op in ('state_request', 'state_claim', 'state_reply'):
+                pass
+            else:
+                (self._early if self.phase == 'early' else self._held).append(message)
+            return True
 
-threading.Thread(target=clean_old_messages, daemon=True).start()
+    def _adopt(self, message):
+        data = message['data']
+        try:
+            reset_store()
+            rooms, messages = restore_snapshot(data, f"copy from worker {message['origin'][:8]}", members=True)
+        except ValueError as e:
+            print(f"[!] Peer copy not loaded: {e}")
+            return
+        if DURABLE is not None:
+            DURABLE.rebase()
+        self.stats.update(source=message['origin'][:8], rooms=rooms, messages=messages, bytes=len(data))
+        self._finish(self._held)
+
+    def _finish(self, ops):
+        """Apply `ops` in order and start serving. Call with self._lock held."""
+        self.phase = None
+        self._early = self._held = []
+        for message in ops:
+            handler = STATE_HANDLERS.get(message.get('op'))
+            if handler is not None:
+                handler(message, message.get('origin') == WORKER_ID)
+        self._done.set()
+
+    def offer(self, op):
+        """Claim `op`'s request after a random delay unless another worker already has."""
+        def claim():
+            time.sleep(random.random() * 0.3)
+            if op['request'] not in self._claimed:
+                replicate('state_claim', request=op['request'], to=op['origin'])
+        threading.Thread(target=claim, daemon=True).start()
+
+    def claimed(self, op, local):
+        if op['request'] in self._claimed:
+            return
+        self._claimed.add(op['request'])
+        if not local:
+            return
+        # Ours was first: the copy is taken here, in broker order, and sent from a thread
+        buf = io.BytesIO()
+        dump_snapshot(buf, members=True)
+        data = buf.getvalue()
+        self.stats['served'] += 1
+        threading.Thread(target=replicate, args=('state_reply',),
+                         kwargs={'request': op['request'], 'to': op['to'], 'data': data}, daemon=True).start()
+
+@state_op('state_request')
+def _apply_state_request(op, local):
+    if not local:
+        BOOTSTRAP.offer(op)
+
+@state_op('state_claim')
+def _apply_state_claim(op, local):
+    BOOTSTRAP.claimed(op, local)
+
+BOOTSTRAP = PeerBootstrap(BOOTSTRAP_TIMEOUT)
+
+BROKER.start()
+if not isinstance(BROKER, LocalBroker):
+    BOOTSTRAP.run()
 
 # ===========================
 # Routes
@@ -224,24 +3267,112 @@ def login():
         username = request.form["username"].strip()
         room_code = request.form.get("room", "").strip()
 
-        with STORE_LOCK:
-            if room_code and room_code in ROOMS:
-                ROOMS[room_code].append(username)
-            else:
-                room_code = generate_room_code()
-                ROOMS[room_code] = [username]
-                MESSAGES.setdefault(room_code, [])
+        if not room_code or room_code not in ROOMS:
+            room_code = ROOM_IDS.allocate()
+        if not replicate('open', room=room_code, ts=time.time()):
+            return "Service unavailable, try again shortly", 503
 
         session["username"] = username
         session["room"] = room_code
         return redirect(url_for("chat"))
-    return render_template_string(LOGIN_HTML)
+    return LOGIN_TEMPLATE.render()
 
 @app.route("/chat")
 def chat():
     if "username" not in session or "room" not in session:
         return redirect(url_for("login"))
-    return render_template_string(CHAT_HTML, username=session["username"], room=session["room"])
+    return CHAT_TEMPLATE.render(username=session["username"], room=session["room"])
+
+@app.route("/assets/<filename>")
+def static_asset(filename):
+    asset = ASSET_FILES.get(filename)
+    if asset is None:
+        return "Not found", 404
+    encoding, body = asset.negotiate(request.accept_encodings)
+    tag = asset.etag(encoding)
+    headers = {
+        "Content-Type": asset.content_type,
+        "Cache-Control": "public, max-age=31536000, immutable",
+        "ETag": f'"{tag}"',
+        "Vary": "Accept-Encoding",
+    }
+    if encoding != 'identity':
+        headers["Content-Encoding"] = encoding
+    if request.if_none_match.contains(tag) or request.if_none_match.star_tag:
+        return "", 304, headers
+    return body, 200, headers
+
+@app.route("/attachments", methods=["POST"])
+def attachment_create():
+    user, room = session.get("username"), session.get("room")
+    if not user or not room or room not in ROOMS or is_blocked(user):
+        return {"error": "not in a room"}, 403
+    data = request.get_json(silent=True) or {}
+    size, meta = data.get("size"), data.get("meta", "")
+    if type(size) is not int or not 0 < size <= ATTACH_MAX_BYTES:
+        return {"error": "size must be 1..%d bytes" % ATTACH_MAX_BYTES}, 413
+    # Encrypted file name etc., stored and relayed like a message payload
+    if not isinstance(meta, str) or len(meta) > MAX_PAYLOAD_BYTES:
+        return {"error": "meta too large"}, 413
+    item, limit = ATTACHMENTS.create(room, user, size, meta)
+    if limit == 'disk':
+        return {"error": "attachment storage full"}, 507
+    if limit:
+        return {"error": f"too many attachment bytes pending for this {limit}"}, 429
+    return {"id": item.id, "url": url_for("attachment_upload", att_id=item.id),
+            "chunk": ATTACH_CHUNK_BYTES, "offset": 0}, 201
+
+def _upload_refused(user):
+    """Status refusing an upload chunk from `user` right now, or None."""
+    if is_blocked(user):
+        return 403
+    if DRAIN.closed:
+        return 503
+    return None
+
+@app.route("/attachments/<att_id>/upload", methods=["HEAD", "PATCH"])
+def attachment_upload(att_id):
+    item = ATTACHMENTS.get(att_id)
+    if item is None or item.user != session.get("username") or item.room != session.get("room"):
+        return "", 404
+    headers = {"Upload-Length": str(item.size), "Cache-Control": "no-store"}
+    if request.method == "PATCH":
+        offset = request.headers.get("Upload-Offset", "")
+        length = request.content_length
+        if not offset.isdigit() or length is None:
+            return "", 400, headers
+        if length > ATTACH_CHUNK_BYTES or int(offset) + length > item.size:
+            return "", 413, headers
+        # The user may have been blocked, or the drain begun, since the upload was created
+        status = _upload_refused(item.user)
+        if status:
+            return "", status, headers
+        if not ATTACHMENTS.write(item, int(offset), request.stream, length):
+            headers["Upload-Offset"] = str(item.received)
+            return "", 409, headers
+        # ...or while this chunk was being written
+        status = _upload_refused(item.user)
+        if status:
+            return "", status, headers
+        if ATTACHMENTS.finish(item):
+            notice = json.dumps({'id': item.id, 'size': item.size, 'meta': item.meta}).encode('utf-8')
+            replicate('message', room=item.room, user=item.user, payload=notice, kind=KIND_ATTACHMENT, ts=time.time())
+    headers["Upload-Offset"] = str(item.received)
+    return "", 204 if request.method == "PATCH" else 200, headers
+
+@app.route("/attachments/<att_id>")
+def attachment_download(att_id):
+    item = ATTACHMENTS.get(att_id)
+    if item is None or item.received != item.size or item.room != session.get("room"):
+        return "Not found", 404
+    # conditional=True answers Range (206) and If-None-Match from the file on disk
+    try:
+        response = send_file(ATTACHMENTS.path(att_id), mimetype="application/octet-stream", conditional=True,
+                             etag=att_id, max_age=0, download_name=att_id + ".bin")
+    except FileNotFoundError:
+        return "Not found", 404   # expired, or deleted by another worker sharing the spool
+    response.headers["Cache-Control"] = "private, max-age=%d" % MESSAGE_TTL
+    return response
 
 @app.route("/logout")
 def logout():
@@ -250,37 +3381,367 @@ def logout():
 
 @app.route("/healthz")
 def healthz():
+    # Failing while draining takes this process out of the load balancer
+    if DRAIN.draining:
+        return "draining", 503
+    if not BROKER.connected:
+        return "broker unavailable", 503
     return "ok", 200
 
+def _gauge(out, name, help, value):
+    out.append(f"# HELP {name} {help}")
+    out.append(f"# TYPE {name} gauge")
+    out.append(f"{name} {value}")
+
+def render_metrics():
+    """Prometheus text exposition (format 0.0.4) of all instruments and live gauges."""
+    out = []
+    for h in (ON_MESSAGE_SECONDS, ON_JOIN_SECONDS, LOCK_WAIT_SECONDS, LOCK_HOLD_SECONDS, SWEEP_SECONDS):
+        h.render(out)
+    for c in (MESSAGES_IN, BYTES_IN, MESSAGES_OUT, BYTES_OUT):
+        out.append(f"# HELP {c.name} {c.help}")
+        out.append(f"# TYPE {c.name} counter")
+        out.append(f"{c.name} {c.value}")
+    out.append("# HELP e2ee_expired_messages_total Messages removed by the expiry sweeper.")
+    out.append("# TYPE e2ee_expired_messages_total counter")
+    out.append(f"e2ee_expired_messages_total {EXPIRY.stats['expired']}")
+    out.append("# HELP e2ee_flow_control_total Rate-limit and slow-consumer policy actions.")
+    out.append("# TYPE e2ee_flow_control_total counter")
+    for action, n in FLOW_STATS.items():
+        out.append(f'e2ee_flow_control_total{{action="{action}"}} {n}')
+    out.append("# HELP e2ee_ws_frames_total Outbound WebSocket data frames, by whether they were deflated.")
+    out.append("# TYPE e2ee_ws_frames_total counter")
+    for what in ('compressed', 'uncompressed'):
+        out.append(f'e2ee_ws_frames_total{{deflate="{"yes" if what == "compressed" else "no"}"}} {TRANSPORT_STATS[what]}')
+    out.append("# HELP e2ee_ws_bytes_total Outbound WebSocket payload bytes before and after compression.")
+    out.append("# TYPE e2ee_ws_bytes_total counter")
+    out.append(f'e2ee_ws_bytes_total{{stage="raw"}} {TRANSPORT_STATS["raw_bytes"]}')
+    out.append(f'e2ee_ws_bytes_total{{stage="wire"}} {TRANSPORT_STATS["wire_bytes"]}')
+    out.append("# HELP e2ee_pings_total Engine.IO pings scheduled, and how many were backed off for idle connections.")
+    out.append("# TYPE e2ee_pings_total counter")
+    out.append(f'e2ee_pings_total{{pace="all"}} {TRANSPORT_STATS["pings"]}')
+    out.append(f'e2ee_pings_total{{pace="idle"}} {TRANSPORT_STATS["idle_pings"]}')
+    _gauge(out, "e2ee_rooms", "Live rooms.", len(ROOMS))
+    _gauge(out, "e2ee_connections", "Open Engine.IO connections on this worker.", len(SIO.eio.sockets))
+    _gauge(out, "e2ee_stored_messages", "Messages currently stored.", sum(len(log) for log in list(MESSAGES.values())))
+    _gauge(out, "e2ee_stored_bytes", "Stored ciphertext plus per-message overhead, in bytes.", BUDGET.used)
+    _gauge(out, "e2ee_memory_budget_bytes", "Configured E2EE_MEMORY_BUDGET_BYTES.", BUDGET.limit)
+    out.append("# HELP e2ee_budget_evictions_total Rooms emptied to stay under the memory budget.")
+    out.append("# TYPE e2ee_budget_evictions_total counter")
+    out.append(f"e2ee_budget_evictions_total {BUDGET.stats['evictions']}")
+    out.append("# HELP e2ee_budget_evicted_messages_total Messages dropped to stay under the memory budget: whole-room evictions and trims.")
+    out.append("# TYPE e2ee_budget_evicted_messages_total counter")
+    out.append(f'e2ee_budget_evicted_messages_total{{reason="evict"}} {BUDGET.stats["evicted_messages"]}')
+    out.append(f'e2ee_budget_evicted_messages_total{{reason="trim"}} {BUDGET.stats["trimmed_messages"]}')
+    out.append("# HELP e2ee_budget_evicted_bytes_total Stored bytes freed by budget evictions.")
+    out.append("# TYPE e2ee_budget_evicted_bytes_total counter")
+    out.append(f"e2ee_budget_evicted_bytes_total {BUDGET.stats['evicted_bytes']}")
+    _gauge(out, "e2ee_attachments", "Attachments spooled or uploading.", len(ATTACHMENTS))
+    _gauge(out, "e2ee_attachment_reserved_bytes", "Declared size of all spooled attachments.", ATTACHMENTS.reserved)
+    out.append("# HELP e2ee_attachment_bytes_received_total Attachment bytes written to the spool.")
+    out.append("# TYPE e2ee_attachment_bytes_received_total counter")
+    out.append(f"e2ee_attachment_bytes_received_total {ATTACHMENTS.stats['bytes_in']}")
+    _gauge(out, "e2ee_broadcast_queue_depth", "Messages waiting in the batching dispatcher.", BROADCASTER.stats['queue_depth'])
+    _gauge(out, "e2ee_draining", "1 while this process drains for a shutdown.", int(DRAIN.draining))
+    out.append("")
+    return "\n".join(out)
+
+@app.route("/metrics")
+def metrics():
+    return render_metrics(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
 # ===========================
 # SocketIO Events
 # ===========================
-@socketio.on('join')
-def on_join(data):
+def _cursor(value):
+    try:
+        return max(0, int(value))
+    except (TypeError, ValueError):
+        return None
+
+def send_history(sid, room, since, binary=False):
+    page, head = messages_since(room, since, binary=binary)
+    last = page[-1]['seq'] if page else max(since, head)
+    push('history', {'room': room, 'messages': page, 'last': last, 'head': head, 'more': last < head, 'binary': binary}, to=sid)
+
+# Handlers take the sender's sid explicitly and are registered with whichever
+# engine is running at the bottom of this section.
+SOCKET_EVENTS = {}
+
+def socket_event(name):
+    def register(handler):
+        SOCKET_EVENTS[name] = handler
+        return handler
+    return register
+
+@socket_event('connect')
+def on_connect(sid, *args):
+    pace_pings(sid)
+
+@socket_event('join')
+@timed(ON_JOIN_SECONDS)
+def on_join(sid, data):
     room = data.get('room')
     username = data.get('username', 'user')
-    join_room(room)
-    socketio.emit('message', {'system': True, 'text': f"{username} joined {room}"}, room=room)
+    # Clients that send binary=True get and may send raw-bytes payloads ('bin');
+    # the 'binary' flag in the history reply confirms the mode.
+    binary = data.get('binary') is True
+    if not room or not isinstance(room, str) or not isinstance(username, str):
+        return
+    if DRAIN.draining:
+        push('restart', {'delay_ms': DRAIN.reconnect_delay()}, to=sid)
+        return
+    previous = bind_sid(sid, username, room)
+    if previous is not None:
+        # Same socket joining again (or switching rooms): drop the old membership
+        replicate('leave', room=previous[1], user=previous[0])
+        for r in (previous[1], binary_room(previous[1]), text_room(previous[1])):
+            leave(sid, r)
+    replicate('join', room=room, user=username)
+    enter(sid, room)
+    enter(sid, binary_room(room) if binary else text_room(room))
+    push('message', {'system': True, 'text': f"{username} joined {room}"}, to=room)
+    # Replay what the client missed: its own cursor if it sent one, else its last ack
+    since = _cursor(data.get('since'))
+    if since is None:
+        since = acked_seq(room, username)
+    send_history(sid, room, since, binary)
+
+@socket_event('sync')
+def on_sync(sid, data):
+    room = data.get('room')
+    since = _cursor(data.get('since'))
+    # Only the room this socket joined
+    if not room or since is None or SIDS.get(sid, (None, None))[1] != room:
+        return
+    send_history(sid, room, since, data.get('binary') is True)
 
-@socketio.on('message')
-def on_message(data):
+@socket_event('ack')
+def on_ack(sid, data):
     room = data.get('room')
     user = data.get('user')
-    encrypted = data.get('msg', '')
+    seq = _cursor(data.get('seq'))
+    # Acks count only for the user and room this socket joined, as in on_message
+    if not room or not user or not seq or SIDS.get(sid) != (user, room):
+        return
+    ack_messages(room, user, seq)
+
+@socket_event('disconnect')
+def on_disconnect(sid, reason=None):
+    SID_BUCKETS.pop(sid, None)
+    binding = unbind_sid(sid)
+    if binding is not None:
+        replicate('leave', room=binding[1], user=binding[0])
+
+@socket_event('message')
+@timed(ON_MESSAGE_SECONDS)
+def on_message(sid, data):
+    room = data.get('room')
+    user = data.get('user')
+    # Only as the user, and into the room, this socket joined
+    if not room or not user or SIDS.get(sid) != (user, room) or DRAIN.closed:
+        return
 
-    if not room or not user:
+    # Binary attachments are stored and forwarded byte-for-byte
+    if isinstance(data.get('bin'), bytes):
+        payload, kind = data['bin'], KIND_BINARY
+    elif isinstance(data.get('msg'), str):
+        payload, kind = data['msg'].encode('utf-8'), KIND_TEXT
+    else:
         return
 
-    with STORE_LOCK:
-        if user in BLOCKED_USERS:
-            return
-        MESSAGES.setdefault(room, []).append({'user': user, 'msg': encrypted, 'timestamp': time.time()})
+    if not payload or len(payload) > MAX_PAYLOAD_BYTES or is_blocked(user):
+        return
+
+    if not allow_message(sid, user):
+        if RATE_LIMIT_POLICY == "disconnect":
+            FLOW_STATS['rate_disconnect'] += 1
+            drop(sid)
+        else:
+            FLOW_STATS['rate_drop'] += 1
+            push('rate_limited', {'room': room}, to=sid)
+        return
+
+    MESSAGES_IN.inc()
+    BYTES_IN.inc(len(payload))
+    replicate('message', room=room, user=user, payload=payload, kind=kind, ts=time.time())
+
+def _flask_handler(handler):
+    def on_event(*args):
+        mark_active(request.sid)
+        return handler(request.sid, *args)
+    return on_event
+
+def _async_handler(handler):
+    # The store never waits on I/O, so handlers run inline on the event loop
+    async def on_event(sid, *args):
+        mark_active(sid)
+        return handler(sid, *args)
+    return on_event
+
+for _name, _handler in SOCKET_EVENTS.items():
+    if socketio is not None:
+        socketio.on_event(_name, _flask_handler(_handler))
+    else:
+        SIO.on(_name, _async_handler(_handler))
+
+# ===========================
+# Admin API (local only)
+# ===========================
+# JSON over HTTP on 127.0.0.1:E2EE_ADMIN_PORT (off when unset), for hosts and
+# containers without the interactive CLI, e.g. `docker exec <id> curl ...`:
+#   GET  /rooms?after=ROOM&limit=N            rooms, members, message counts
+#   GET  /users?after=USER&limit=N            connected users and their rooms
+#   GET  /rooms/ROOM/messages?since=SEQ&limit=N
+#   GET  /blocked, GET /stats
+#   POST /kick, /block, /unblock {"users": [...]}; POST /clear {"rooms": [...]}
+# Listings are paginated by cursor ("next" in each reply) and streamed. Each
+# entry is copied under its own room lock, which is released before the entry
+# is written out, so a slow reader never stalls chat traffic. Bulk actions are
+# one replicated op each, applied in a single pass on every worker.
+ADMIN_PORT = int(os.environ.get("E2EE_ADMIN_PORT", "") or 0)
+# Optional bearer token, for hosts where other local users could reach the port
+ADMIN_TOKEN = os.environ.get("E2EE_ADMIN_TOKEN", "")
+ADMIN_PAGE_SIZE = 100
+ADMIN_MAX_PAGE_SIZE = 1000
+ADMIN_ACTIONS = {'kick': 'users', 'block': 'users', 'unblock': 'users', 'clear': 'rooms'}
+
+admin_app = Flask("e2ee_admin")
+
+@admin_app.before_request
+def _admin_auth():
+    if ADMIN_TOKEN and not secrets.compare_digest(request.headers.get("Authorization", ""), f"Bearer {ADMIN_TOKEN}"):
+        return {"error": "unauthorized"}, 401
+
+def _page_limit():
+    try:
+        return max(1, min(ADMIN_MAX_PAGE_SIZE, int(request.args.get("limit", ADMIN_PAGE_SIZE))))
+    except ValueError:
+        return ADMIN_PAGE_SIZE
+
+def _name_page(names):
+    """Sort a snapshot of keys and return (page after the cursor, next cursor)."""
+    names.sort()
+    start = bisect.bisect_right(names, request.args.get("after", ""))
+    limit = _page_limit()
+    page = names[start:start + limit]
+    return page, (page[-1] if start + limit < len(names) else None)
+
+def _stream_page(key, entries, cursor):
+    def body():
+        yield '{"%s":[' % key
+        sep = ''
+        for entry in entries:
+            if entry is not None:   # gone since the page was cut
+                yield sep + json.dumps(entry, separators=(',', ':'))
+                sep = ','
+        yield '],"next":%s}\n' % json.dumps(cursor)
+    return Response(body(), mimetype="application/json")
+
+def _room_entry(room):
+    with room_lock(room):
+        members = ROOMS.get(room)
+        if members is None:
+            return None
+        log = MESSAGES.get(room)
+        return {'room': room, 'members': dict(members), 'messages': len(log) if log is not None else 0,
+                'bytes': log.nbytes if log is not None else 0, 'last_seq': log.last_seq if log is not None else 0,
+                'last_active': LAST_ACTIVE.get(room)}
+
+def _user_entry(user):
+    with PRESENCE_LOCK:
+        rooms = USER_ROOMS.get(user)
+        if not rooms:
+            return None
+        rooms = sorted(rooms)
+        sockets = len(USER_SIDS.get(user, ()))
+    return {'user': user, 'rooms': rooms, 'blocked': is_blocked(user), 'worker_sockets': sockets}
+
+@admin_app.route("/rooms")
+def admin_rooms():
+    page, cursor = _name_page(list(ROOMS))
+    return _stream_page('rooms', map(_room_entry, page), cursor)
+
+@admin_app.route("/users")
+def admin_users():
+    page, cursor = _name_page(list(USER_ROOMS))
+    return _stream_page('users', map(_user_entry, page), cursor)
+
+@admin_app.route("/rooms/<room>/messages")
+def admin_messages(room):
+    since = request.args.get("since", "0")
+    if not since.isdigit():
+        return {"error": "since must be a seq"}, 400
+    with room_lock(room):
+        log = MESSAGES.get(room)
+        if log is None:
+            return {"error": "no such room"}, 404
+        rows = list(log.since(int(since), _page_limit()))
+        head = log.last_seq
+    cursor = rows[-1][0] if rows and rows[-1][0] < head else None
+
+    def entry(row):
+        seq, user, payload, kind, ts = row
+        field, value = payload_field(payload, kind, False)
+        return {'seq': seq, 'user': user, 'ts': ts, field: value}
+    return _stream_page('messages', map(entry, rows), cursor)
 
-    socketio.emit('message', {'user': user, 'msg': encrypted}, room=room)
+@admin_app.route("/blocked")
+def admin_blocked():
+    return {"blocked": sorted(BLOCKED_USERS)}
+
+@admin_app.route("/stats")
+def admin_stats():
+    return {
+        "worker": WORKER_ID, "engine": ASYNC_MODE, "rooms": len(ROOMS), "worker_sockets": len(SIDS),
+        "expiry": dict(EXPIRY.stats, ttl=MESSAGE_TTL), "flow_control": dict(FLOW_STATS),
+        "memory": dict(BUDGET.stats, used=BUDGET.used, limit=BUDGET.limit),
+        "broadcast": dict(BROADCASTER.stats), "reaper": dict(REAPER.stats), "transport": dict(TRANSPORT_STATS, hooks=sorted(TRANSPORT_HOOKS)),
+        "room_ids": dict(ROOM_IDS.stats, pooled=len(ROOM_IDS), space=ROOM_IDS.space),
+        "attachments": dict(ATTACHMENTS.stats, live=len(ATTACHMENTS), reserved=ATTACHMENTS.reserved),
+        "durable": dict(DURABLE.stats) if DURABLE is not None else None,
+        "drain": dict(DRAIN.stats, draining=DRAIN.draining),
+        "bootstrap": BOOTSTRAP.stats,
+        "broker": dict(getattr(BROKER, 'stats', {}), url=BROKER_URL, connected=BROKER.connected),
+    }
+
+@admin_app.route("/<action>", methods=["POST"])
+def admin_action(action):
+    key = ADMIN_ACTIONS.get(action)
+    if key is None:
+        return {"error": "unknown action"}, 404
+    names = (request.get_json(silent=True) or {}).get(key)
+    if not isinstance(names, list) or not all(isinstance(n, str) and n for n in names):
+        return {"error": f'expected {{"{key}": ["...", ...]}}'}, 400
+    names = list(dict.fromkeys(names))
+    if names and not replicate(action, **{key: names}):
+        return {"error": "broker unavailable, nothing was applied"}, 503
+    return {"ok": True, key: len(names)}
+
+def serve_admin(port):
+    from werkzeug.serving import make_server
+    server = make_server("127.0.0.1", port, admin_app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+ADMIN_SERVER = serve_admin(ADMIN_PORT) if ADMIN_PORT else None
 
 # ===========================
 # Admin CLI (local only)
 # ===========================
+def _cli_names(prompt):
+    return [n for n in (part.strip() for part in input(f"{prompt}, comma-separated: ").split(",")) if n]
+
+def _cli_action(action, prompt):
+    key = ADMIN_ACTIONS[action]
+    names = _cli_names(prompt)
+    if names:
+        if replicate(action, **{key: names}):
+            print(f"{action}: {', '.join(names)}")
+        else:
+            print("Broker unavailable: nothing was applied, try again.")
+    input("Press Enter...")
+
 def admin_cli(port, local_ip):
     while True:
         os.system('clear' if os.name == 'posix' else 'cls')
@@ -290,45 +3751,34 @@ def admin_cli(port, local_ip):
         print(f"3. Kick User\n4. Delete Messages in Room\n5. Block User\n6. Unblock User\n7. Exit CLI")
         choice = input("Enter choice: ").strip()
         if choice == "1":
-            with STORE_LOCK:
-                for r, u in ROOMS.items():
-                    print(f"Room {r}: {', '.join(u) if u else '(empty)'}")
+            for r, u in snapshot_rooms().items():
+                print(f"Room {r}: {', '.join(u) if u else '(empty)'}")
+            print(f"\n{len(SIDS)} socket(s) on this worker, {REAPER.stats['reclaimed']} idle room(s) reclaimed")
             input("Press Enter...")
         elif choice == "2":
-            with STORE_LOCK:
-                for r, m in MESSAGES.items():
-                    print(f"\nRoom {r}:")
-                    for msg in m:
-                        print(f"[{time.ctime(msg['timestamp'])}] {msg['user']}: {msg['msg']}")
+            for r, m in snapshot_messages().items():
+                print(f"\nRoom {r}:")
+                for msg in m:
+                    print(f"[{time.ctime(msg['timestamp'])}] {msg['user']}: {msg['msg']}")
+            st = EXPIRY.stats
+            print(f"\nExpiry: TTL {MESSAGE_TTL:g}s, {st['expired']} expired over {st['sweeps']} sweeps, "
+                  f"last {st['last_sweep_ms']:.3f} ms, max {st['max_sweep_ms']:.3f} ms")
+            print("Flow control: " + ", ".join(f"{k} {v}" for k, v in FLOW_STATS.items()))
+            print(f"Memory: {BUDGET.used:,} of {BUDGET.limit:,} bytes, "
+                  + ", ".join(f"{k} {v:,}" for k, v in BUDGET.stats.items()))
+            if BROADCASTER.window:
+                bt = BROADCASTER.stats
+                print(f"Broadcast: {bt['messages']} messages in {bt['batches']} batches, queue {bt['queue_depth']} "
+                      f"(max {bt['max_queue_depth']}), fan-out last {bt['last_fanout_ms']:.1f} ms, max {bt['max_fanout_ms']:.1f} ms")
             input("Press Enter...")
         elif choice == "3":
-            user = input("Username to kick: ").strip()
-            kicked_rooms = []
-            with STORE_LOCK:
-                for r, u in ROOMS.items():
-                    if user in u:
-                        u.remove(user)
-                        kicked_rooms.append(r)
-            for r in kicked_rooms:
-                socketio.emit('message', {'system': True, 'text': f"{user} was kicked by admin"}, room=r)
-            input("Press Enter...")
+            _cli_action('kick', "Username(s) to kick")
         elif choice == "4":
-            room = input("Room code: ").strip()
-            with STORE_LOCK:
-                if room in MESSAGES:
-                    MESSAGES[room] = []
-            socketio.emit('message', {'system': True, 'text': f"All messages cleared by admin"}, room=room)
-            input("Press Enter...")
+            _cli_action('clear', "Room code(s)")
         elif choice == "5":
-            user = input("Username to block: ").strip()
-            with STORE_LOCK:
-                BLOCKED_USERS.add(user)
-            input("Press Enter...")
+            _cli_action('block', "Username(s) to block")
         elif choice == "6":
-            user = input("Username to unblock: ").strip()
-            with STORE_LOCK:
-                BLOCKED_USERS.discard(user)
-            input("Press Enter...")
+            _cli_action('unblock', "Username(s) to unblock")
         elif choice == "7":
             print("Exiting Admin CLI...")
             break
@@ -345,6 +3795,16 @@ if __name__ == "__main__":
     local_ip = get_local_ip()
 
     print(f"[*] Async mode: {ASYNC_MODE}")
+    print(f"[*] Broker: {BROKER_URL} (worker {WORKER_ID[:8]}{', hub' if BROKER_HUB else ''})")
+    if DURABLE is not None:
+        print(f"[*] Persistence: {DATA_DIR} ({DURABLE.stats['recovered']} records replayed "
+              f"in {DURABLE.stats['recovery_ms']:.0f} ms)")
+    elif SNAPSHOT_PATH:
+        restored = (f"{DRAIN.stats['restored_rooms']} rooms, {DRAIN.stats['restored_messages']} messages "
+                    f"restored in {DRAIN.stats['restore_ms']:.0f} ms" if DRAIN.stats['restore_ms'] else "nothing to restore")
+        print(f"[*] Snapshot: {SNAPSHOT_PATH} ({restored})")
+    if ADMIN_SERVER is not None:
+        print(f"[*] Admin API: http://127.0.0.1:{ADMIN_PORT}{' (token required)' if ADMIN_TOKEN else ''}")
     print(f"[*] Running Secure Chat on port {port}")
     print(f"Open in browser (localhost): http://localhost:{port}")
     print(f"Open in browser (LAN): http://{local_ip}:{port}")
@@ -355,11 +3815,24 @@ if __name__ == "__main__":
     if not sys.stdout.isatty():
         IS_PROD = True
 
-    if IS_PROD:
-        # Production on Railway: no auto-browser, no interactive CLI
-        socketio.run(app, host="0.0.0.0", port=port, debug=False)
-    else:
+    if not IS_PROD:
         # Local dev: auto-browser + admin CLI
         threading.Thread(target=open_browser_links, args=(port, local_ip), daemon=True).start()
         threading.Thread(target=admin_cli, args=(port, local_ip), daemon=True).start()
-        socketio.run(app, host="0.0.0.0", port=port, debug=False)
+    if ASYNC_MODE == "asgi":
+        import uvicorn  # type: ignore
+
+        class DrainingServer(uvicorn.Server):
+            # uvicorn takes over SIGTERM while serving; route it to the drain
+            def handle_exit(self, sig, frame):
+                if sig != signal.SIGTERM or not DRAIN.begin():
+                    super().handle_exit(sig, frame)
+
+        # wsproto carries the compression settings and frame limit; Engine.IO pings replace uvicorn's
+        DrainingServer(uvicorn.Config(asgi_app, host="0.0.0.0", port=port, log_level="warning", ws="wsproto",
+                                      ws_max_size=MAX_MESSAGE_BYTES, ws_per_message_deflate=COMPRESSION,
+                                      ws_ping_interval=None)).run()
+    else:
+        DRAIN.watch()
+        # An explicit E2EE_ENGINE=threading means Werkzeug is wanted even without a TTY
+        socketio.run(app, host="0.0.0.0", port=port, debug=False, allow_unsafe_werkzeug=ENGINE == "threading")
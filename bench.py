@@ -0,0 +1,1511 @@
+# bench.py - Micro-benchmarks for the Secure Chat server (E2EE.py)
+#
+# Usage:  python bench.py <scenario> [options]
+#         python bench.py --help
+
+# ===========================
+# Standard Library Imports
+# ===========================
+import os
+import sys
+import time
+import json
+import base64
+import random
+import string
+import argparse
+import threading
+import shutil
+import tempfile
+import socket
+import signal
+import subprocess
+import tracemalloc
+
+# Keep the server module quiet and short-lived while benchmarking
+os.environ.setdefault("E2EE_EXPIRY_MAX_SLEEP", "3600")
+
+import E2EE
+from socketio.packet import Packet, EVENT
+
+
+def report(title, rows, headers):
+    print(f"\n=== {title} ===")
+    widths = [max(len(str(h)), *(len(str(r[i])) for r in rows)) for i, h in enumerate(headers)]
+    print("  ".join(str(h).rjust(w) for h, w in zip(headers, widths)))
+    for r in rows:
+        print("  ".join(str(c).rjust(w) for c, w in zip(r, widths)))
+
+
+# ===========================
+# Lock contention
+# ===========================
+def _run_contention(rooms, ops, hold):
+    """One writer thread per room; returns appends/sec across all threads."""
+    E2EE.MESSAGES.clear()
+    start = threading.Barrier(rooms + 1)
+
+    def writer(room):
+        start.wait()
+        for _ in range(ops):
+            with E2EE.room_lock(room):
+                log = E2EE.MESSAGES.get(room)
+                if log is None:
+                    log = E2EE.MESSAGES[room] = E2EE.RoomLog()
+                log.append('u', b'x', 0.0)
+                if hold:
+                    # Stand-in for a holder that yields mid-section (I/O, greenlet switch)
+                    time.sleep(hold)
+
+    threads = [threading.Thread(target=writer, args=(f"ROOM{i:04d}",)) for i in range(rooms)]
+    for t in threads:
+        t.start()
+    start.wait()
+    t0 = time.perf_counter()
+    for t in threads:
+        t.join()
+    return rooms * ops / (time.perf_counter() - t0)
+
+
+def bench_contention(args):
+    saved = (E2EE.LOCK_STRIPES, E2EE.ROOM_LOCKS)
+    rows = []
+    try:
+        for rooms in args.rooms:
+            result = [rooms]
+            for stripes in (1, args.stripes):
+                E2EE.LOCK_STRIPES = stripes
+                E2EE.ROOM_LOCKS = [threading.Lock() for _ in range(stripes)]
+                result.append(f"{_run_contention(rooms, args.ops, args.hold):,.0f}")
+            rows.append(result)
+    finally:
+        E2EE.LOCK_STRIPES, E2EE.ROOM_LOCKS = saved
+        E2EE.MESSAGES.clear()
+    report(f"appends/sec, {args.ops} ops per room, hold {args.hold * 1e6:.0f}us",
+           rows, ["rooms", "global lock", f"{args.stripes} stripes"])
+
+
+# ===========================
+# Message store memory
+# ===========================
+def _fake_ciphertext(rng, length):
+    return ''.join(rng.choices(string.ascii_letters + string.digits + '+/', k=length))
+
+
+def _measure(build):
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    keep = build()
+    used = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    return keep, used
+
+
+def bench_memory(args):
+    rng = random.Random(1)
+    users = [f"user{i}" for i in range(args.users)]
+    per_room = args.messages // args.rooms
+    # Pre-generate wire frames so the measurement only counts what the store keeps.
+    # Each message is decoded from its own JSON frame, as on_message receives it,
+    # so usernames arrive as fresh string objects every time.
+    frames = [json.dumps({'user': rng.choice(users), 'msg': _fake_ciphertext(rng, args.length)})
+              for _ in range(min(per_room, 10000))]
+
+    def incoming():
+        for i in range(per_room):
+            yield json.loads(frames[i % len(frames)])
+
+    def legacy():
+        store = {}
+        for r in range(args.rooms):
+            store[f"R{r:05d}"] = [{'user': d['user'], 'msg': d['msg'], 'timestamp': time.time()} for d in incoming()]
+        return store
+
+    def columnar():
+        store = {}
+        for r in range(args.rooms):
+            log = store[f"R{r:05d}"] = E2EE.RoomLog()
+            for d in incoming():
+                log.append(d['user'], d['msg'].encode('utf-8'), time.time())
+        return store
+
+    total = per_room * args.rooms
+    rows = []
+    for name, build in (("list of dicts", legacy), ("RoomLog", columnar)):
+        keep, used = _measure(build)
+        rows.append([name, f"{used / 2**20:,.1f}", f"{used / total:,.1f}", f"{(used / total) - args.length:,.1f}"])
+        del keep
+    report(f"{total:,} messages in {args.rooms:,} rooms, {args.length}-byte ciphertext",
+           rows, ["layout", "MiB", "bytes/msg", "overhead/msg"])
+
+
+# ===========================
+# Cross-worker broadcast latency
+# ===========================
+def _percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    k = min(len(sorted_values) - 1, int(round(pct / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[k]
+
+
+def _broker_latency(brokers, count, interval):
+    """Publish from brokers[0]; every other broker records publish->receive delay."""
+    samples = []
+    done = threading.Event()
+    expected = count * (len(brokers) - 1)
+    lock = threading.Lock()
+
+    def receiver(message):
+        delay = time.perf_counter() - message['t']
+        with lock:
+            samples.append(delay)
+            if len(samples) >= expected:
+                done.set()
+
+    for broker in brokers[1:]:
+        broker.subscribe('bench', receiver)
+    for broker in brokers:
+        broker.start()
+    for _ in range(count):
+        brokers[0].publish('bench', {'t': time.perf_counter(), 'data': {'user': 'u', 'msg': 'x' * 64}})
+        if interval:
+            time.sleep(interval)
+    done.wait(30)
+    return sorted(samples)
+
+
+def bench_broker(args):
+    rows = []
+
+    shared = E2EE.LocalBroker()
+    samples = _broker_latency([shared, shared], args.count, args.interval)
+    rows.append(["local (in-process)", 1, len(samples)] + [f"{_percentile(samples, p) * 1e6:,.0f}" for p in (50, 99, 99.9)])
+
+    port = E2EE.find_free_port()
+    hub = E2EE.BrokerHub("127.0.0.1", port)
+    threading.Thread(target=hub.serve_forever, daemon=True).start()
+    for workers in args.workers:
+        brokers = [E2EE.SocketBroker("127.0.0.1", port) for _ in range(workers)]
+        samples = _broker_latency(brokers, args.count, args.interval)
+        rows.append(["tcp hub", workers, len(samples)] + [f"{_percentile(samples, p) * 1e6:,.0f}" for p in (50, 99, 99.9)])
+        for broker in brokers:
+            broker._sock.close()
+
+    report(f"publish -> remote delivery latency (us), {args.count} broadcasts",
+           rows, ["broker", "workers", "samples", "p50", "p99", "p99.9"])
+
+
+# ===========================
+# Wire format: base64 string vs binary attachment
+# ===========================
+# Same table as the chat page's toMorse(); the "ciphertext" is UTF-8 Morse
+MORSE = {'A': '.-', 'B': '-...', 'C': '-.-.', 'D': '-..', 'E': '.', 'F': '..-.', 'G': '--.', 'H': '....',
+         'I': '..', 'J': '.---', 'K': '-.-', 'L': '.-..', 'M': '--', 'N': '-.', 'O': '---', 'P': '.--.',
+         'Q': '--.-', 'R': '.-.', 'S': '...', 'T': '-', 'U': '..-', 'V': '...-', 'W': '.--', 'X': '-..-',
+         'Y': '-.--', 'Z': '--..', ' ': '/', '0': '-----', '1': '.----', '2': '..---', '3': '...--',
+         '4': '....-', '5': '.....', '6': '-....', '7': '--...', '8': '---..', '9': '----.'}
+
+
+def to_morse(text):
+    return ' '.join(MORSE.get(c, c) for c in text.upper())
+
+
+def _wire_size(encoded):
+    if isinstance(encoded, list):
+        return sum(len(part) if isinstance(part, bytes) else len(part.encode()) for part in encoded)
+    return len(encoded.encode())
+
+
+def _decode_packet(encoded):
+    if isinstance(encoded, list):
+        pkt = Packet(encoded_packet=encoded[0])
+        for attachment in encoded[1:]:
+            pkt.add_attachment(attachment)
+        return pkt
+    return Packet(encoded_packet=encoded)
+
+
+def bench_wire(args):
+    rng = random.Random(3)
+    words = "the quick brown fox jumps over a lazy dog meet me at noon bring 2 keys".split()
+    modes = {
+        "base64 string": lambda m: {'user': 'alice', 'room': 'ABC123', 'msg': base64.b64encode(m).decode()},
+        "binary attachment": lambda m: {'user': 'alice', 'room': 'ABC123', 'bin': m},
+    }
+    rows = []
+    for size in args.words:
+        texts = [' '.join(rng.choice(words) for _ in range(size)) for _ in range(200)]
+        morse = [to_morse(t).encode('utf-8') for t in texts]
+        plain = sum(len(t) for t in texts) / len(texts)
+        for name, make in modes.items():
+            inbound = [Packet(EVENT, data=['message', make(m)]).encode() for m in morse]
+            in_bytes = sum(_wire_size(e) for e in inbound) / len(inbound)
+
+            # Server side per message: decode the inbound packet, take the payload
+            # as stored, encode the outbound 'message' broadcast once.
+            t0 = time.perf_counter()
+            out_bytes = stored = 0
+            for i in range(args.count):
+                pkt = _decode_packet(inbound[i % len(inbound)])
+                data = pkt.data[1]
+                field = 'bin' if 'bin' in data else 'msg'
+                payload = data[field] if field == 'bin' else data[field].encode('utf-8')
+                stored += len(payload)
+                out = Packet(EVENT, data=['message', {'user': data['user'], field: data[field], 'seq': i}]).encode()
+                out_bytes += _wire_size(out)
+            cpu_us = (time.perf_counter() - t0) / args.count * 1e6
+            rows.append([size, name, f"{plain:.0f}", f"{in_bytes:.0f}", f"{out_bytes / args.count:.0f}",
+                         f"{stored / args.count:.0f}", f"{in_bytes / plain:.2f}x", f"{cpu_us:.2f}"])
+    report(f"Socket.IO packet bytes and server CPU per message ({args.count:,} messages per row)",
+           rows, ["words", "mode", "plaintext", "inbound", "outbound", "stored", "inflation", "server us/msg"])
+    print("Binary attachments also cost one extra websocket frame header (2-6 bytes) each.")
+
+
+# ===========================
+# Metrics overhead
+# ===========================
+def _micro(fn, n):
+    t0 = time.perf_counter()
+    for _ in range(n):
+        fn()
+    return (time.perf_counter() - t0) / n * 1e9
+
+
+def bench_metrics_worker(args):
+    """Runs in a subprocess so E2EE_METRICS applies from import time."""
+    payload = 'LS0tIC4uLiAtLi0gLi4gLS4tLiAtLS0g' * 2
+    data = {'room': 'BENCH', 'user': 'u', 'msg': payload}
+    E2EE.bind_sid('bench', 'u', 'BENCH')
+    for _ in range(1000):   # warm up
+        E2EE.on_message('bench', data)
+    t0 = time.perf_counter()
+    for _ in range(args.count):
+        E2EE.on_message('bench', data)
+    elapsed = time.perf_counter() - t0
+    print(json.dumps({'ns_per_msg': elapsed / args.count * 1e9}))
+
+
+def bench_metrics(args):
+    rows = []
+    h = E2EE.Histogram("x", "x", E2EE.LATENCY_BUCKETS)
+    rows.append(["Histogram.observe", f"{_micro(lambda: h.observe(0.0003), args.count):.0f}"])
+    c = E2EE.Counter("x", "x")
+    rows.append(["Counter.inc", f"{_micro(c.inc, args.count):.0f}"])
+    plain, timed = threading.Lock(), E2EE.TimedLock()
+
+    def use(lock):
+        with lock:
+            pass
+    rows.append(["threading.Lock enter/exit", f"{_micro(lambda: use(plain), args.count):.0f}"])
+    rows.append(["TimedLock enter/exit", f"{_micro(lambda: use(timed), args.count):.0f}"])
+    report("instrument cost (ns per call)", rows, ["operation", "ns"])
+
+    # The real on_message path (store + broadcast), fresh process per run;
+    # best of `repeat` alternating runs to keep scheduler noise out
+    results = {"0": [], "1": []}
+    for _ in range(args.repeat):
+        for mode in ("0", "1"):
+            env = dict(os.environ, E2EE_METRICS=mode, E2EE_RATE_PER_SID="0", E2EE_RATE_PER_USER="0")
+            out = subprocess.run([sys.executable, "-W", "ignore", os.path.abspath(__file__), "metrics-worker",
+                                  "--count", str(args.e2e_count)], env=env, capture_output=True, text=True, check=True)
+            results[mode].append(json.loads(out.stdout.strip().splitlines()[-1])['ns_per_msg'])
+    off, on = min(results["0"]), min(results["1"])
+    rows = [["off", f"{off:,.0f}"], ["on", f"{on:,.0f}"],
+            ["overhead", f"{on - off:,.0f} ({(on / off - 1) * 100:.1f}%)"]]
+    report(f"on_message, {args.e2e_count:,} messages, best of {args.repeat} (ns per message)", rows, ["metrics", "ns/msg"])
+
+
+# ===========================
+# Durable log
+# ===========================
+def _write_messages(count, rooms, payload):
+    now = time.time()
+    t0 = time.perf_counter()
+    for i in range(count):
+        E2EE.store_message(f"R{i % rooms:05d}", f"user{i % 50}", payload, E2EE.KIND_TEXT, now)
+    return count / (time.perf_counter() - t0)
+
+
+def _reset_store():
+    E2EE.MESSAGES.clear()
+    E2EE.ROOMS.clear()
+    E2EE.BUDGET = E2EE.MemoryBudget(E2EE.MEMORY_BUDGET_BYTES, E2EE.ROOM_MAX_BYTES)
+
+
+def bench_durable(args):
+    payload = b'LS0tIC4uLiAtLi0gLi4gLS4tLiAtLS0g' * 2
+    directory = tempfile.mkdtemp(prefix="e2ee-bench-")
+    saved = E2EE.DURABLE
+    try:
+        rows = []
+        _reset_store()
+        E2EE.DURABLE = None
+        rows.append(["off", f"{_write_messages(args.count, args.rooms, payload):,.0f}"])
+
+        _reset_store()
+        E2EE.DURABLE = log = E2EE.DurableLog(os.path.join(directory, "throughput"))
+        stop = threading.Event()
+
+        def flusher():
+            while not stop.wait(E2EE.FSYNC_INTERVAL_MS / 1000.0):
+                log.flush()
+        t = threading.Thread(target=flusher, daemon=True)
+        t.start()
+        rows.append([f"on (group commit every {E2EE.FSYNC_INTERVAL_MS:g} ms)",
+                     f"{_write_messages(args.count, args.rooms, payload):,.0f}"])
+        stop.set()
+        t.join()
+        log.flush()
+        report(f"store_message throughput, {args.count:,} messages over {args.rooms:,} rooms",
+               rows, ["persistence", "messages/sec"])
+
+        # Recovery: write N messages through a log, then replay them into an empty store
+        _reset_store()
+        E2EE.DURABLE = log = E2EE.DurableLog(os.path.join(directory, "recovery"))
+        _write_messages(args.recover, args.rooms, payload)
+        log.seal()
+        size = sum(os.path.getsize(p) for s in log.shards for p in s.segment_paths())
+        _reset_store()
+        E2EE.DURABLE = None
+        fresh = E2EE.DurableLog(os.path.join(directory, "recovery"))
+        records = fresh.recover()
+        stored = sum(len(l) for l in E2EE.MESSAGES.values())
+        report("recovery", [[f"{records:,}", f"{stored:,}", f"{size / 2**20:,.1f}",
+                             f"{fresh.stats['recovery_ms'] / 1000:.2f}", f"{records / (fresh.stats['recovery_ms'] / 1000):,.0f}"]],
+               ["records", "messages restored", "log MiB", "seconds", "records/sec"])
+    finally:
+        E2EE.DURABLE = saved
+        _reset_store()
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+# ===========================
+# Memory budget under a flood
+# ===========================
+def _flood(args, limit):
+    """Spray messages over many throwaway rooms plus a few busy ones under `limit` bytes."""
+    _reset_store()
+    E2EE.BUDGET = budget = E2EE.MemoryBudget(limit, min(limit, args.room_cap << 20))
+    rng = random.Random(7)
+    payloads = [os.urandom(rng.randint(args.min_size, args.max_size)) for _ in range(256)]
+    now = time.time()
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    for i in range(args.count):
+        # One in four messages goes to a busy room, the rest to throwaway rooms
+        room = f"HOT{(i >> 2) % 8}" if i % 4 == 0 else f"R{rng.randrange(args.rooms):06d}"
+        # Slicing copies, so every stored message owns its payload as in production
+        E2EE.store_message(room, "flooder", payloads[i & 255][1:], E2EE.KIND_BINARY, now)
+    elapsed = time.perf_counter() - t0
+    traced, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    actual = sum(log.nbytes for log in E2EE.MESSAGES.values())
+    live = sum(1 for log in E2EE.MESSAGES.values() if len(log))
+    hot = sum(1 for r in range(8) if len(E2EE.MESSAGES.get(f"HOT{r}", ())))
+    st = budget.stats
+    row = ["off" if limit >= 1 << 62 else f"{limit / 2**20:,.0f}",
+           f"{budget.used / 2**20:,.1f}", f"{st['peak_bytes'] / 2**20:,.1f}", f"{peak / 2**20:,.1f}",
+           f"{budget.used - actual:,}", f"{live:,}", f"{hot}/8", f"{st['evictions']:,}",
+           f"{st['evicted_messages'] + st['trimmed_messages']:,}", f"{args.count / elapsed:,.0f}"]
+    _reset_store()
+    return row
+
+
+def bench_budget(args):
+    rows = [_flood(args, 1 << 62)] + [_flood(args, mib << 20) for mib in args.budget]
+    report(f"{args.count:,} messages of {args.min_size}-{args.max_size} bytes over {args.rooms:,} rooms + 8 busy rooms",
+           rows, ["budget MiB", "stored MiB", "peak stored", "peak traced", "drift", "rooms w/ msgs",
+                  "busy kept", "evictions", "dropped msgs", "msgs/sec"])
+
+
+# ===========================
+# Engines: eventlet vs threading vs asgi
+# ===========================
+class RawClient:
+    """Bare Engine.IO 4 / Socket.IO 5 websocket client: one socket, no threads."""
+
+    def __init__(self, port):
+        import websocket  # websocket-client, already needed by python-socketio's client
+        self.ws = websocket.create_connection(f"ws://127.0.0.1:{port}/socket.io/?EIO=4&transport=websocket", timeout=30)
+        self.ws.recv()            # Engine.IO open
+        self.ws.send("40")        # Socket.IO connect to "/"
+        while not self.ws.recv().startswith("40"):
+            pass
+
+    def emit(self, event, data):
+        self.ws.send("42" + json.dumps([event, data]))
+
+    def event(self):
+        while True:
+            frame = self.ws.recv()
+            if frame == "2":
+                self.ws.send("3")
+            elif frame.startswith("42"):
+                return json.loads(frame[2:])
+
+    def close(self):
+        self.ws.close()
+
+
+def _proc_status(pid):
+    fields = {}
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            fields[key] = value.split()
+    return int(fields["VmRSS"][0]) * 1024, int(fields["Threads"][0])
+
+
+def _start_server(engine, port, **env):
+    env = dict(os.environ, E2EE_ENGINE=engine, PORT=str(port), E2EE_RATE_PER_SID="0", E2EE_RATE_PER_USER="0", **env)
+    proc = subprocess.Popen([sys.executable, "-W", "ignore", os.path.join(os.path.dirname(os.path.abspath(__file__)), "E2EE.py")],
+                            env=env, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return proc
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError(f"{engine} server did not start on port {port}")
+
+
+def _engine_run(engine, port, args):
+    proc = _start_server(engine, port)
+    clients = []
+    try:
+        warm = RawClient(port)
+        warm.emit("join", {"room": "WARM", "username": "warm"})
+        warm.event()
+        time.sleep(0.5)
+        rss0, _ = _proc_status(proc.pid)
+
+        # Idle connections, each joined to its own room
+        t0 = time.perf_counter()
+        for i in range(args.idle):
+            try:
+                c = RawClient(port)
+                c.emit("join", {"room": f"IDLE{i}", "username": f"idle{i}"})
+                clients.append(c)
+            except Exception:
+                break
+        connect_s = time.perf_counter() - t0
+        time.sleep(1.0)
+        rss1, threads = _proc_status(proc.pid)
+        per_conn = (rss1 - rss0) / max(1, len(clients))
+
+        # Broadcast latency: one sender, `listeners` members of one room
+        listeners = [RawClient(port) for _ in range(args.listeners)]
+        for i, c in enumerate(listeners):
+            c.emit("join", {"room": "FANOUT", "username": f"l{i}"})
+        sender = RawClient(port)
+        sender.emit("join", {"room": "FANOUT", "username": "sender"})
+        time.sleep(1.0)
+        samples, lock = [], threading.Lock()
+
+        def listen(c):
+            got = 0
+            while got < args.messages:
+                name, data = c.event()[:2]
+                if name == "message" and "msg" in data and data.get("user") == "sender":
+                    delay = time.time() - float(data["msg"])
+                    got += 1
+                    with lock:
+                        samples.append(delay)
+        readers = [threading.Thread(target=listen, args=(c,), daemon=True) for c in listeners]
+        for t in readers:
+            t.start()
+        for _ in range(args.messages):
+            sender.emit("message", {"room": "FANOUT", "user": "sender", "msg": repr(time.time())})
+            time.sleep(args.interval)
+        for t in readers:
+            t.join(timeout=30)
+        samples.sort()
+        for c in listeners + [sender, warm]:
+            c.close()
+        return [engine, f"{len(clients):,}", f"{len(clients) / connect_s:,.0f}", f"{per_conn / 1024:,.1f}", threads,
+                f"{rss1 / 2**20:,.1f}", f"{len(samples):,}", f"{_percentile(samples, 50) * 1e3:.2f}",
+                f"{_percentile(samples, 99) * 1e3:.2f}"]
+    finally:
+        for c in clients:
+            try:
+                c.close()
+            except Exception:
+                pass
+        proc.kill()
+        proc.wait()
+
+
+def bench_engines(args):
+    rows = []
+    for i, engine in enumerate(args.engines):
+        rows.append(_engine_run(engine, args.port + i, args))
+    report(f"{args.idle:,} idle connections; {args.messages} broadcasts to {args.listeners} listeners",
+           rows, ["engine", "connected", "conn/s", "KiB/idle conn", "threads", "RSS MiB",
+                  "deliveries", "p50 ms", "p99 ms"])
+
+
+# ===========================
+# Page views: inline vs static assets
+# ===========================
+def _inline_assets(template):
+    """Rebuild the pre-asset page: CSS/JS inlined into the template string."""
+    for name, asset in E2EE.ASSETS.items():
+        body = asset.variants['identity'].decode('utf-8')
+        if name.endswith('.css'):
+            template = template.replace(f'<link rel="stylesheet" href="{{{{ asset(\'{name}\') }}}}">', f"<style>{body}</style>")
+        else:
+            template = template.replace(f'<script defer src="{{{{ asset(\'{name}\') }}}}"></script>', f"<script>{body}</script>")
+    assert "asset(" not in template
+    return template
+
+
+def _requests_per_sec(client, path, count):
+    client.get(path)
+    t0 = time.perf_counter()
+    for _ in range(count):
+        client.get(path)
+    return count / (time.perf_counter() - t0)
+
+
+def bench_pages(args):
+    from flask import render_template_string, session
+    app = E2EE.app
+    legacy_login, legacy_chat = _inline_assets(E2EE.LOGIN_HTML), _inline_assets(E2EE.CHAT_HTML)
+    # The old routes: parse and render the whole inline string on every request
+    app.add_url_rule("/bench-legacy/", "bench_legacy_login", lambda: render_template_string(legacy_login))
+    app.add_url_rule("/bench-legacy/chat", "bench_legacy_chat",
+                     lambda: render_template_string(legacy_chat, username=session["username"], room=session["room"]))
+    client = app.test_client()
+    with client.session_transaction() as s:
+        s["username"], s["room"] = "bench", "BENCH1"
+
+    encoding = 'br' if E2EE.brotli is not None else 'gzip'
+    rows = []
+    for page, old, new, assets in (("login", "/bench-legacy/", "/", ["login.css"]),
+                                   ("chat", "/bench-legacy/chat", "/chat", ["chat.css", "chat.js"])):
+        old_html = len(client.get(old).data)
+        new_html = len(client.get(new).data)
+        # A cold cache fetches each asset once; a warm one never re-requests immutable URLs
+        packed = sum(len(client.get(E2EE.asset_url(a), headers={"Accept-Encoding": encoding}).data) for a in assets)
+        rows.append([page, "inline (before)", f"{_requests_per_sec(client, old, args.count):,.0f}",
+                     f"{old_html:,}", f"{old_html:,}"])
+        rows.append([page, f"assets + {encoding}", f"{_requests_per_sec(client, new, args.count):,.0f}",
+                     f"{new_html + packed:,}", f"{new_html:,}"])
+    report(f"page views, {args.count:,} requests each (HTML bytes exclude headers)", rows,
+           ["page", "mode", "req/s", "bytes first view", "bytes repeat view"])
+
+    # The asset route itself: full body vs conditional 304
+    url = E2EE.asset_url("chat.js")
+    tag = client.get(url, headers={"Accept-Encoding": encoding}).headers["ETag"]
+    hdr = {"Accept-Encoding": encoding}
+    t0 = time.perf_counter()
+    for _ in range(args.count):
+        client.get(url, headers=hdr)
+    full = args.count / (time.perf_counter() - t0)
+    hdr = {"Accept-Encoding": encoding, "If-None-Match": tag}
+    t0 = time.perf_counter()
+    for _ in range(args.count):
+        client.get(url, headers=hdr)
+    cond = args.count / (time.perf_counter() - t0)
+    report("chat.js", [["200 " + encoding, f"{full:,.0f}"], ["304 revalidate", f"{cond:,.0f}"]], ["response", "req/s"])
+
+
+# ===========================
+# Client rendering (headless Chromium)
+# ===========================
+# The pre-virtualization renderer: decode table rebuilt per message, one
+# node appended and a forced layout per message.
+LEGACY_RENDERER = """
+function fromMorse(code){ const rev = Object.fromEntries(Object.entries(MORSE).map(([k,v])=>[v,k])); return code.split(' ').map(c=>rev[c]||c).join(''); }
+function renderMessage(data){
+    let chatBox = document.getElementById('chat-box');
+    let wrapper = document.createElement('div');
+    if(data.system){
+        wrapper.className = 'system';
+        wrapper.textContent = "[SYSTEM] " + data.text;
+    } else {
+        if(data.seq){
+            if(data.seq <= lastSeq) return;
+            lastSeq = data.seq;
+            scheduleAck();
+        }
+        wrapper.className = 'message ' + (data.user===username ? 'sent' : 'received');
+        wrapper.textContent = data.user + ": " + (data.bin ? decryptBinary(data.bin) : decryptMessage(data.msg));
+    }
+    chatBox.appendChild(wrapper);
+    chatBox.scrollTop = chatBox.scrollHeight;
+}
+"""
+
+# Socket.IO stand-in: records handlers so the benchmark can fire events
+FAKE_SOCKET = """
+window.__handlers = {};
+window.io = function(){ return {on: function(n, f){ __handlers[n] = f; }, emit: function(){}, disconnect: function(){}}; };
+"""
+
+RENDER_RUN = """
+async ([count, chunk, text]) => {
+    const frame = () => new Promise(r => requestAnimationFrame(() => r()));
+    const idle = async () => { while (typeof drawQueue !== 'undefined' && (drawQueue.length || frameQueued)) await frame(); };
+    __handlers.history({binary: false, head: 0, last: 0, more: false, messages: []});
+    await idle();
+    const msg = encryptMessage(text);
+    const t0 = performance.now();
+    let longest = 0;
+    for (let seq = 1; seq <= count; ) {
+        const t = performance.now();
+        for (const end = Math.min(count, seq + chunk - 1); seq <= end; seq++)
+            __handlers.message({user: seq % 2 ? 'alice' : 'bob', msg: msg, seq: seq});
+        await frame();
+        longest = Math.max(longest, performance.now() - t);
+    }
+    await idle();
+    const total = performance.now() - t0;
+    const box = document.getElementById('chat-box');
+    const s0 = performance.now();
+    box.scrollTop = 0;
+    await frame(); await frame();
+    box.scrollTop = box.scrollHeight;
+    await frame(); await frame();
+    return {total: total, longest: longest, scroll: performance.now() - s0,
+            nodes: box.getElementsByTagName('*').length,
+            heap: performance.memory ? performance.memory.usedJSHeapSize : 0};
+}
+"""
+
+
+def bench_render(args):
+    try:
+        from playwright.sync_api import sync_playwright
+    except ImportError:
+        print("bench.py render needs Playwright: pip install playwright && playwright install chromium")
+        return
+    if E2EE.ASYNC_MODE == "eventlet":
+        # Playwright's sync API cannot run under eventlet's monkey-patching
+        subprocess.run([sys.executable, "-W", "ignore", os.path.abspath(__file__), "render", "--count", str(args.count),
+                        "--chunk", str(args.chunk), "--text", args.text, "--cpu-slowdown", str(args.cpu_slowdown)],
+                       env=dict(os.environ, E2EE_ENGINE="threading"), check=True)
+        return
+    body = E2EE.CHAT_HTML[E2EE.CHAT_HTML.index("<body"):E2EE.CHAT_HTML.index("</body>")]
+    body = body.replace("{{ username }}", "alice").replace("{{ room }}", "BENCH1").replace("{{ url_for('logout') }}", "/logout")
+    css = E2EE.ASSETS['chat.css'].variants['identity'].decode('utf-8')
+    rows = []
+    with sync_playwright() as p:
+        try:
+            browser = p.chromium.launch(args=["--enable-precise-memory-info"])
+        except Exception as e:
+            print(f"cannot start headless Chromium ({str(e).splitlines()[0]}); run: playwright install chromium")
+            return
+        for mode in ("before", "after"):
+            page = browser.new_page(viewport={"width": 412, "height": 915})   # phone-sized
+            if args.cpu_slowdown > 1:
+                cdp = page.context.new_cdp_session(page)
+                cdp.send("Emulation.setCPUThrottlingRate", {"rate": args.cpu_slowdown})
+            script = E2EE.CHAT_JS + (LEGACY_RENDERER if mode == "before" else "")
+            page.set_content(f"<!DOCTYPE html><html><head><style>{css}</style><script>{FAKE_SOCKET}</script></head>"
+                             f"{body}<script>{script}</script></body></html>")
+            r = page.evaluate(RENDER_RUN, [args.count, args.chunk, args.text])
+            rows.append([mode, f"{r['total']:,.0f}", f"{args.count / r['total'] * 1000:,.0f}", f"{r['longest']:,.0f}",
+                         f"{r['scroll']:,.0f}", f"{r['nodes']:,}", f"{r['heap'] / 2**20:,.1f}"])
+            page.close()
+        browser.close()
+    report(f"render {args.count:,} messages in bursts of {args.chunk}, 412x915 viewport, CPU slowdown x{args.cpu_slowdown}",
+           rows, ["renderer", "total ms", "msgs/s", "longest burst ms", "scroll top+bottom ms", "DOM nodes", "JS heap MiB"])
+
+
+# ===========================
+# Attachments: memory while uploading/downloading large files
+# ===========================
+class _RssSampler(threading.Thread):
+    def __init__(self, pid):
+        super().__init__(daemon=True)
+        self.pid, self.peak, self.running = pid, 0, True
+
+    def run(self):
+        while self.running:
+            self.peak = max(self.peak, _proc_status(self.pid)[0])
+            time.sleep(0.01)
+
+
+def _http(port, method, path, body=None, headers=None, cookie=None):
+    import http.client
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+    headers = dict(headers or {})
+    if cookie:
+        headers["Cookie"] = cookie
+    conn.request(method, path, body=body, headers=headers)
+    return conn, conn.getresponse()
+
+
+def _attachment_run(engine, port, size, args):
+    spool = tempfile.mkdtemp(prefix="bench-attach-")
+    os.environ["E2EE_ATTACH_DIR"] = spool
+    os.environ["E2EE_ATTACH_MAX_BYTES"] = str(size)
+    proc = _start_server(engine, port)
+    try:
+        conn, r = _http(port, "POST", "/", "username=bench&room=", {"Content-Type": "application/x-www-form-urlencoded"})
+        cookie = r.getheader("Set-Cookie").split(";", 1)[0]
+        conn.close()
+        conn, r = _http(port, "POST", "/attachments", json.dumps({"size": size, "meta": "bmFtZQ=="}),
+                        {"Content-Type": "application/json"}, cookie)
+        upload = json.loads(r.read())
+        conn.close()
+        if r.status != 201:
+            raise RuntimeError(f"upload refused: {r.status} {upload}")
+        chunk = os.urandom(upload["chunk"])
+        time.sleep(0.3)
+        rss0 = _proc_status(proc.pid)[0]
+        sampler = _RssSampler(proc.pid)
+        sampler.start()
+
+        # A chunk cut off halfway: the server keeps what arrived and reports it
+        conn, _ = _http(port, "HEAD", upload["url"], cookie=cookie)
+        conn.close()
+        import http.client
+        raw = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+        raw.putrequest("PATCH", upload["url"])
+        raw.putheader("Cookie", cookie)
+        raw.putheader("Upload-Offset", "0")
+        raw.putheader("Content-Length", str(min(size, len(chunk))))
+        raw.endheaders()
+        raw.send(chunk[:min(size, len(chunk)) // 2])
+        raw.close()
+        time.sleep(0.2)
+        conn, r = _http(port, "HEAD", upload["url"], cookie=cookie)
+        resumed_at = int(r.getheader("Upload-Offset"))
+        conn.close()
+
+        t0 = time.perf_counter()
+        offset = resumed_at
+        while offset < size:
+            body = chunk[:min(len(chunk), size - offset)]
+            conn, r = _http(port, "PATCH", upload["url"], body, {"Upload-Offset": str(offset)}, cookie)
+            r.read()
+            conn.close()
+            if r.status != 204:
+                raise RuntimeError(f"upload failed at {offset}: {r.status}")
+            offset = int(r.getheader("Upload-Offset"))
+        up_s = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        conn, r = _http(port, "GET", "/attachments/" + upload["id"], cookie=cookie)
+        got = 0
+        while True:
+            block = r.read(1 << 16)
+            if not block:
+                break
+            got += len(block)
+        conn.close()
+        down_s = time.perf_counter() - t0
+        conn, r = _http(port, "GET", "/attachments/" + upload["id"], headers={"Range": "bytes=-1024"}, cookie=cookie)
+        ranged = r.status, len(r.read())
+        conn.close()
+        sampler.running = False
+        sampler.join()
+        assert got == size and ranged == (206, 1024), (got, ranged)
+        mib = size / (1 << 20)
+        return [engine, f"{mib:,.0f}", f"{resumed_at:,}", f"{mib / up_s:,.0f}", f"{mib / down_s:,.0f}",
+                f"{rss0 / (1 << 20):.1f}", f"{(sampler.peak - rss0) / (1 << 20):+.1f}"]
+    finally:
+        proc.kill()
+        proc.wait()
+        shutil.rmtree(spool, ignore_errors=True)
+
+
+def bench_attachments(args):
+    rows = []
+    port = args.port
+    for engine in args.engines:
+        for mib in args.sizes:
+            rows.append(_attachment_run(engine, port, mib << 20, args))
+            port += 1
+    report("chunked upload (with one interrupted chunk) and streamed download", rows,
+           ["engine", "MiB", "resumed at", "up MiB/s", "down MiB/s", "RSS MiB", "peak ΔRSS MiB"])
+
+
+# ===========================
+# Room IDs: allocation rate and collisions with many live rooms
+# ===========================
+def _legacy_room_code(length=6):
+    return ''.join(random.choices(string.ascii_uppercase + string.digits, k=length))
+
+
+def _live_codes(count, length, alphabet):
+    """`count` distinct random codes, generated in bulk like the allocator does."""
+    seed = E2EE.RoomIdAllocator(length, alphabet, 16, set())
+    live = set()
+    while len(live) < count:
+        chars = os.urandom(min(count - len(live), 1 << 20) * length * 2).translate(seed._table, seed._biased)
+        live.update(chars[i:i + length].decode('ascii') for i in range(0, len(chars) - length + 1, length))
+    while len(live) > count:
+        live.pop()
+    return live
+
+
+def bench_roomids(args):
+    alphabet = string.ascii_uppercase + string.digits
+    rows = []
+    for length in args.lengths:
+        t0 = time.perf_counter()
+        live = _live_codes(args.live, length, alphabet)
+        build_s = time.perf_counter() - t0
+        space = len(alphabet) ** length
+
+        # Old path: random.choices and no check, so a hit silently joins a stranger's room
+        t0 = time.perf_counter()
+        merged = sum(_legacy_room_code(length) in live for _ in range(args.count))
+        legacy_rate = args.count / (time.perf_counter() - t0)
+        rows.append([length, f"{args.live:,}", f"{args.live / space:.3%}", "random.choices",
+                     f"{legacy_rate:,.0f}", "-", "-", "-", f"{merged:,}", "-"])
+
+        allocator = E2EE.RoomIdAllocator(length, alphabet, args.pool, live)
+        threading.Thread(target=allocator.run, daemon=True).start()
+        samples = []
+        duplicates = 0
+        t0 = time.perf_counter()
+        for i in range(args.count):
+            s = time.perf_counter_ns()
+            code = allocator.allocate()
+            samples.append(time.perf_counter_ns() - s)
+            duplicates += code in live
+            live.add(code)   # what 'open' does to ROOMS
+            if i % 32 == 0:
+                time.sleep(0)   # let the refill thread run, as request handling would
+        rate = args.count / (time.perf_counter() - t0)
+        samples.sort()
+        st = allocator.stats
+        rows.append([length, f"{args.live:,}", f"{args.live / space:.3%}", "RoomIdAllocator",
+                     f"{rate:,.0f}", f"{_percentile(samples, 50) / 1000:.2f}", f"{_percentile(samples, 99.9) / 1000:.2f}",
+                     f"{samples[-1] / 1000:.0f}", f"{duplicates:,}", f"{st['collisions']:,} skipped, {st['inline_refills']:,} inline refills"])
+        print(f"  (length {length}: built {args.live:,} live codes in {build_s:.1f} s)")
+        del live, allocator
+    report(f"allocating {args.count:,} room codes among live rooms", rows,
+           ["len", "live rooms", "occupancy", "allocator", "codes/s", "p50 us", "p99.9 us", "max us", "reused live", "notes"])
+
+
+# ===========================
+# Transport: WebSocket compression and heartbeats
+# ===========================
+class DeflateClient:
+    """RawClient over wsproto that offers permessage-deflate the way browsers do
+    and counts the bytes it sends and receives on the socket."""
+
+    def __init__(self, port, deflate=True):
+        from wsproto import WSConnection, ConnectionType
+        from wsproto.events import Request
+        from wsproto.extensions import PerMessageDeflate
+
+        class BrowserOffer(PerMessageDeflate):
+            def offer(self):
+                return "client_max_window_bits"
+
+        self.sock = socket.create_connection(("127.0.0.1", port), timeout=30)
+        self.ws = WSConnection(ConnectionType.CLIENT)
+        self.lock = threading.Lock()
+        self.sent = self.received = 0
+        self._frames, self._parts = [], []
+        self._send(Request(host="127.0.0.1", target="/socket.io/?EIO=4&transport=websocket",
+                           extensions=[BrowserOffer()] if deflate else []))
+        self.recv()               # Engine.IO open
+        self.send("40")           # Socket.IO connect to "/"
+        while not self.recv().startswith("40"):
+            pass
+
+    def _send(self, event):
+        with self.lock:
+            data = self.ws.send(event)
+            self.sent += len(data)
+            self.sock.sendall(data)
+
+    def send(self, text):
+        from wsproto.events import TextMessage
+        self._send(TextMessage(data=text))
+
+    def recv(self):
+        from wsproto.events import TextMessage, Ping, CloseConnection
+        while not self._frames:
+            data = self.sock.recv(65536)
+            if not data:
+                raise ConnectionError("server closed the connection")
+            self.received += len(data)
+            self.ws.receive_data(data)
+            for ev in self.ws.events():
+                if isinstance(ev, TextMessage):
+                    self._parts.append(ev.data)
+                    if ev.message_finished:
+                        self._frames.append("".join(self._parts))
+                        self._parts = []
+                elif isinstance(ev, Ping):
+                    self._send(ev.response())
+                elif isinstance(ev, CloseConnection):
+                    raise ConnectionError(f"closed: {ev.code}")
+        return self._frames.pop(0)
+
+    def emit(self, event, data):
+        self.send("42" + json.dumps([event, data]))
+
+    def event(self):
+        while True:
+            frame = self.recv()
+            if frame == "2":
+                self.send("3")
+            elif frame.startswith("42"):
+                return json.loads(frame[2:])
+
+    def close(self):
+        self.sock.close()
+
+
+def _cpu_seconds(pid):
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def _chat_texts(rng, words, count):
+    vocab = "the quick brown fox jumps over a lazy dog meet me at noon bring 2 keys".split()
+    return [base64.b64encode(to_morse(" ".join(rng.choice(vocab) for _ in range(words))).encode()).decode()
+            for _ in range(count)]
+
+
+def _frame_size(payload):
+    return payload + (2 if payload < 126 else 4 if payload < 65536 else 10)
+
+
+def _codec_run(packets, bits, mem_level, threshold):
+    """Wire bytes and CPU per message through one connection's deflate stream."""
+    import zlib
+    comp = zlib.compressobj(E2EE.COMPRESSION_LEVEL, zlib.DEFLATED, -bits, mem_level)
+    decomp = zlib.decompressobj(-bits)
+    wire = deflate_s = inflate_s = 0
+    for data in packets:
+        if len(data) < threshold:
+            wire += _frame_size(len(data))
+            continue
+        t0 = time.perf_counter()
+        out = comp.compress(data) + comp.flush(zlib.Z_SYNC_FLUSH)
+        t1 = time.perf_counter()
+        decomp.decompress(out)
+        inflate_s += time.perf_counter() - t1
+        deflate_s += t1 - t0
+        wire += _frame_size(len(out) - 4)
+    return wire, deflate_s, inflate_s
+
+
+def _codec_state(bits, mem_level, sample, count=200):
+    """Bytes of zlib state held per connection once it has sent and received one compressed message."""
+    import zlib
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    held = []
+    for _ in range(count):
+        comp = zlib.compressobj(E2EE.COMPRESSION_LEVEL, zlib.DEFLATED, -bits, mem_level)
+        decomp = zlib.decompressobj(-bits)
+        decomp.decompress(comp.compress(sample) + comp.flush(zlib.Z_SYNC_FLUSH))
+        held.append((comp, decomp))
+    size = (tracemalloc.get_traced_memory()[0] - before) / count
+    tracemalloc.stop()
+    return size
+
+
+# name: (window bits, memLevel, threshold, server environment)
+TRANSPORT_CONFIGS = {
+    "off": (15, 8, float("inf"), {"E2EE_COMPRESSION": "0"}),
+    "zlib defaults": (15, 8, 0, {"E2EE_WS_WINDOW_BITS": "15", "E2EE_WS_MEM_LEVEL": "8",
+                                 "E2EE_COMPRESSION_THRESHOLD": "0"}),
+    "tuned": (E2EE.WS_WINDOW_BITS, E2EE.WS_MEM_LEVEL, E2EE.COMPRESSION_THRESHOLD, {}),
+}
+
+
+def _transport_codec(args):
+    rng = random.Random(7)
+    rows = []
+    for words in args.words:
+        texts = _chat_texts(rng, words, 500)
+        packets = [("42" + json.dumps(["message", {"user": "alice", "msg": t, "seq": i}])).encode()
+                   for i, t in enumerate(texts)]
+        raw = sum(len(p) for p in packets) / len(packets)
+        for name, (bits, mem_level, threshold, _) in TRANSPORT_CONFIGS.items():
+            wire, deflate_s, inflate_s = _codec_run(packets, bits, mem_level, threshold)
+            rows.append([words, name, f"{raw:,.0f}", f"{wire / len(packets):,.0f}",
+                         f"{raw * len(packets) / wire:.2f}x", f"{deflate_s / len(packets) * 1e6:.1f}",
+                         f"{inflate_s / len(packets) * 1e6:.1f}"])
+    report("Socket.IO 'message' packets through one connection's deflate stream (500 per row)",
+           rows, ["words", "config", "packet B", "frame B", "ratio", "deflate us", "inflate us"])
+    sample = packets[0]
+    rows = [[name, f"{_codec_state(bits, mem_level, sample) / 1024:,.1f}" if threshold != float("inf") else "0.0"]
+            for name, (bits, mem_level, threshold, _) in TRANSPORT_CONFIGS.items()]
+    report("zlib state per connection (one deflater + one inflater)", rows, ["config", "KiB"])
+
+
+def _transport_server(engine, port, name, args):
+    proc = _start_server(engine, port, **TRANSPORT_CONFIGS[name][3])
+    clients = []
+    try:
+        rng = random.Random(11)
+        texts = _chat_texts(rng, args.message_words, args.messages)
+        warm = DeflateClient(port)
+        warm.emit("join", {"room": "WARM", "username": "warm"})
+        warm.event()
+        time.sleep(0.5)
+        rss0, _ = _proc_status(proc.pid)
+
+        # Idle connections that each chatted once, so any deflate state they keep is allocated
+        for i in range(args.idle):
+            try:
+                c = DeflateClient(port)
+                c.emit("join", {"room": f"IDLE{i}", "username": f"idle{i}"})
+                c.emit("message", {"room": f"IDLE{i}", "user": f"idle{i}", "msg": texts[i % len(texts)]})
+                while c.event()[1].get("user") != f"idle{i}":
+                    pass
+                clients.append(c)
+            except Exception:
+                break
+        time.sleep(1.0)
+        rss1, _ = _proc_status(proc.pid)
+        per_conn = (rss1 - rss0) / max(1, len(clients))
+
+        # Fan-out: every listener reads every message; bytes and server CPU per delivery
+        listeners = [DeflateClient(port) for _ in range(args.listeners)]
+        for i, c in enumerate(listeners):
+            c.emit("join", {"room": "FANOUT", "username": f"l{i}"})
+        time.sleep(1.0)
+        sender = listeners[0]
+        start = [c.received for c in listeners]
+        sent0 = sender.sent
+
+        def listen(c):
+            got = 0
+            while got < args.messages:
+                data = c.event()[1]
+                if data.get("user") == "l0":
+                    got += 1
+        readers = [threading.Thread(target=listen, args=(c,), daemon=True) for c in listeners]
+        for t in readers:
+            t.start()
+        cpu0, t0 = _cpu_seconds(proc.pid), time.perf_counter()
+        for text in texts:
+            sender.emit("message", {"room": "FANOUT", "user": "l0", "msg": text})
+            time.sleep(args.interval)
+        for t in readers:
+            t.join(timeout=60)
+        elapsed, cpu = time.perf_counter() - t0, _cpu_seconds(proc.pid) - cpu0
+        deliveries = args.messages * len(listeners)
+        down = sum(c.received - s for c, s in zip(listeners, start)) / deliveries
+        up = (sender.sent - sent0) / args.messages
+        for c in listeners + [warm]:
+            c.close()
+        return [engine, name, f"{len(clients):,}", f"{per_conn / 1024:,.1f}",
+                f"{2**30 / max(per_conn, 1):,.0f}", f"{up:,.0f}", f"{down:,.0f}",
+                f"{cpu / deliveries * 1e6:,.1f}", f"{cpu / elapsed * 100:.0f}%"]
+    finally:
+        for c in clients:
+            try:
+                c.close()
+            except Exception:
+                pass
+        proc.kill()
+        proc.wait()
+
+
+def _transport_heartbeat(engine, port, name, args):
+    env = {"E2EE_PING_INTERVAL": "1", "E2EE_PING_TIMEOUT": "4"}
+    if name == "fixed":
+        env["E2EE_PING_IDLE_INTERVAL"] = "1"
+    proc = _start_server(engine, port, **env)
+    try:
+        counts, errors = {}, []
+
+        def idle(i):
+            try:
+                c = DeflateClient(port)
+                c.emit("join", {"room": f"HB{i}", "username": f"hb{i}"})
+                c.sock.settimeout(10)
+                deadline = time.time() + args.heartbeat_seconds
+                pings = 0
+                while time.time() < deadline:
+                    c.sock.settimeout(max(0.1, deadline - time.time()))
+                    try:
+                        frame = c.recv()
+                    except socket.timeout:
+                        break
+                    if frame == "2":
+                        pings += 1
+                        c.send("3")
+                counts[i] = pings
+                c.close()
+            except Exception as e:
+                errors.append(e)
+
+        def active():
+            c = DeflateClient(port)
+            c.emit("join", {"room": "HBACTIVE", "username": "active"})
+            stop = time.time() + args.heartbeat_seconds
+            pings = 0
+            c.sock.settimeout(0.25)
+            while time.time() < stop:
+                c.emit("message", {"room": "HBACTIVE", "user": "active", "msg": "..."})
+                try:
+                    while True:
+                        if c.recv() == "2":
+                            pings += 1
+                            c.send("3")
+                except socket.timeout:
+                    pass
+            counts["active"] = pings
+            c.close()
+
+        threads = [threading.Thread(target=idle, args=(i,), daemon=True) for i in range(args.heartbeat_clients)]
+        threads.append(threading.Thread(target=active, daemon=True))
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(timeout=args.heartbeat_seconds + 30)
+        idle_counts = [v for k, v in counts.items() if k != "active"]
+        per_min = sum(idle_counts) / max(1, len(idle_counts)) * 60 / args.heartbeat_seconds
+        return [engine, name, f"{len(idle_counts)}/{args.heartbeat_clients}", len(errors),
+                f"{per_min:.1f}", f"{counts.get('active', 0) * 60 / args.heartbeat_seconds:.1f}"]
+    finally:
+        proc.kill()
+        proc.wait()
+
+
+def bench_transport(args):
+    _transport_codec(args)
+    rows = []
+    for i, engine in enumerate(args.engines):
+        for j, name in enumerate(TRANSPORT_CONFIGS):
+            rows.append(_transport_server(engine, args.port + 10 * i + j, name, args))
+    report(f"{args.idle:,} idle connections that chatted once; {args.messages} messages of "
+           f"{args.message_words} words to {args.listeners} listeners",
+           rows, ["engine", "config", "idle", "KiB/idle conn", "idle conns/GiB", "up B/msg", "down B/delivery",
+                  "server CPU us/delivery", "CPU busy"])
+    if args.heartbeat_seconds <= 0:
+        return
+    rows = []
+    for i, engine in enumerate(args.engines):
+        for j, name in enumerate(("fixed", "adaptive")):
+            rows.append(_transport_heartbeat(engine, args.port + 100 + 10 * i + j, name, args))
+    report(f"Pings over {args.heartbeat_seconds}s with ping interval 1s, timeout 4s",
+           rows, ["engine", "heartbeat", "idle alive", "errors", "pings/min idle", "pings/min active"])
+    print(f"At the configured defaults an idle connection gets one ping per {E2EE.PING_IDLE_INTERVAL:g}s "
+          f"instead of every {E2EE.PING_INTERVAL:g}s: {3600 / E2EE.PING_IDLE_INTERVAL:.0f} "
+          f"vs {3600 / E2EE.PING_INTERVAL:.0f} pings per hour.")
+
+
+# ===========================
+# Drain: snapshot/restore time and the reconnect storm after a redeploy
+# ===========================
+def _fill_store(count, rooms, rng):
+    _reset_store()
+    E2EE.ACKS.clear()
+    E2EE.LAST_ACTIVE.clear()
+    E2EE.BUDGET = E2EE.MemoryBudget(1 << 62, 1 << 62)
+    texts = _chat_texts(rng, 12, 256)
+    payloads = [t.encode() for t in texts]
+    now = time.time()
+    for i in range(count):
+        E2EE.store_message(f"R{i % rooms:06d}", f"user{i % 997}", payloads[i & 255], E2EE.KIND_TEXT, now)
+    for r in range(rooms):
+        E2EE.ROOMS.setdefault(f"R{r:06d}", {})
+
+
+def _json_snapshot(path):
+    """The obvious alternative: every message as a JSON object."""
+    rooms = {}
+    for room in list(E2EE.ROOMS):
+        log = E2EE.MESSAGES.get(room)
+        rooms[room] = {"first": log.first_seq, "last": log.last_seq,
+                       "messages": [[seq, user, E2EE.payload_text(p, kind), kind, ts] for seq, user, p, kind, ts in log.records()]}
+    with open(path, "w") as f:
+        json.dump({"rooms": rooms, "blocked": sorted(E2EE.BLOCKED_USERS)}, f)
+
+
+def _json_restore(path):
+    with open(path) as f:
+        data = json.load(f)
+    for room, entry in data["rooms"].items():
+        log = E2EE.MESSAGES[room] = E2EE.RoomLog()
+        E2EE.ROOMS[room] = {}
+        for seq, user, text, kind, ts in entry["messages"]:
+            log.restore(seq, user, base64.b64decode(text) if kind == E2EE.KIND_BINARY else text.encode(), ts, kind)
+    E2EE.settle_recovered_rooms()
+
+
+def _timed(fn, *args):
+    t0 = time.perf_counter()
+    fn(*args)
+    return (time.perf_counter() - t0) * 1000.0
+
+
+def _snapshot_rows(count, rooms, directory):
+    rng = random.Random(5)
+    rows = []
+    snap, dump = os.path.join(directory, "snap.bin"), os.path.join(directory, "snap.json")
+    methods = [("snapshot", E2EE.write_snapshot, E2EE.load_snapshot, snap),
+               ("JSON dump", _json_snapshot, _json_restore, dump)]
+    for name, write, load, path in methods:
+        _fill_store(count, rooms, rng)
+        write_ms = _timed(write, path)
+        size = os.path.getsize(path)
+        _reset_store()
+        load_ms = _timed(load, path)
+        restored = sum(len(log) for log in E2EE.MESSAGES.values())
+        rows.append([f"{count:,}", name, f"{write_ms:,.0f}", f"{size / 2**20:,.1f}", f"{load_ms:,.0f}",
+                     f"{restored / (load_ms / 1000):,.0f}", f"{restored:,}"])
+    # Startup replay of the same messages from the durable log
+    _reset_store()
+    saved, E2EE.DURABLE = E2EE.DURABLE, E2EE.DurableLog(os.path.join(directory, f"log{count}"))
+    try:
+        _fill_store(count, rooms, rng)
+        E2EE.DURABLE.seal()
+        size = sum(os.path.getsize(p) for s in E2EE.DURABLE.shards for p in s.segment_paths())
+        _reset_store()
+        fresh = E2EE.DurableLog(os.path.join(directory, f"log{count}"))
+        E2EE.DURABLE = None
+        load_ms = _timed(fresh.recover)
+        restored = sum(len(log) for log in E2EE.MESSAGES.values())
+        rows.append([f"{count:,}", "durable log replay", "-", f"{size / 2**20:,.1f}", f"{load_ms:,.0f}",
+                     f"{restored / (load_ms / 1000):,.0f}", f"{restored:,}"])
+    finally:
+        E2EE.DURABLE = saved
+        _reset_store()
+    return rows
+
+
+def _sio_backoff(attempt, rng):
+    """Socket.IO client reconnection delay: 1s doubling to 5s, +-50% jitter."""
+    delay = min(1.0 * 2 ** attempt, 5.0)
+    return delay + (rng.random() * 2 - 1) * 0.5 * delay
+
+
+def _storm_run(engine, port, mode, args, snapshot):
+    env = {"E2EE_SNAPSHOT_PATH": snapshot, "E2EE_DRAIN_JITTER_SECONDS": str(args.jitter)}
+    proc = _start_server(engine, port, **env)
+    joined, failures, heads, lock = [], [0], [], threading.Lock()
+    connected = threading.Barrier(args.clients + 1)
+    signalled = threading.Event()
+    t_signal = [0.0]
+
+    def rejoin(i):
+        c = RawClient(port)
+        c.emit("join", {"room": "STORM", "username": f"c{i}", "since": 0})
+        while True:
+            name, data = c.event()[:2]
+            if name == "history":
+                return c, data["head"]
+
+    def client(i):
+        rng = random.Random(i)
+        c, _ = rejoin(i)
+        connected.wait()
+        delay = None
+        try:
+            while True:
+                name, data = c.event()[:2]
+                if name == "restart":
+                    delay = data["delay_ms"] / 1000.0
+                    break
+        except Exception:
+            pass        # connection lost: the Socket.IO client backs off before its first retry
+        c.close()
+        signalled.wait()
+        attempt = 0
+        if delay is not None:
+            time.sleep(delay)
+        else:
+            time.sleep(_sio_backoff(0, rng))
+        while True:
+            try:
+                c, head = rejoin(i)
+                break
+            except Exception:
+                with lock:
+                    failures[0] += 1
+                attempt += 1
+                time.sleep(_sio_backoff(attempt, rng))
+        with lock:
+            joined.append(time.time() - t_signal[0])
+            heads.append(head)
+        c.close()
+
+    try:
+        threads = [threading.Thread(target=client, args=(i,), daemon=True) for i in range(args.clients)]
+        for t in threads:
+            t.start()
+        connected.wait()
+        sender = RawClient(port)
+        sender.emit("join", {"room": "STORM", "username": "sender"})
+        for k in range(args.messages):
+            sender.emit("message", {"room": "STORM", "user": "sender", "msg": f"m{k}"})
+        time.sleep(1.0)
+        sender.close()
+
+        t_signal[0] = time.time()
+        signalled.set()
+        if mode == "drain":
+            proc.send_signal(signal.SIGTERM)
+        else:
+            proc.kill()
+        proc.wait()
+        down = time.time() - t_signal[0]
+        proc = _start_server(engine, port, **env)
+        up = time.time() - t_signal[0]
+        for t in threads:
+            t.join(timeout=args.jitter + 60)
+        joined.sort()
+        bins = {}
+        for t in joined:
+            bins[int(t * 10)] = bins.get(int(t * 10), 0) + 1
+        kept = sum(1 for h in heads if h == args.messages)
+        return [engine, mode, f"{down:.2f}", f"{up:.2f}", f"{len(joined)}/{args.clients}",
+                f"{max(bins.values(), default=0) * 10:,}", f"{failures[0]:,}",
+                f"{_percentile(joined, 50):.2f}", f"{_percentile(joined, 99):.2f}", f"{kept}/{len(heads)}"]
+    finally:
+        proc.kill()
+        proc.wait()
+
+
+def bench_drain(args):
+    directory = tempfile.mkdtemp(prefix="e2ee-bench-")
+    try:
+        rows = []
+        for count in args.counts:
+            rows.extend(_snapshot_rows(count, args.rooms, directory))
+        report(f"Save and load the store, 12-word messages over {args.rooms:,} rooms",
+               rows, ["messages", "method", "write ms", "MiB", "load ms", "msgs/s loaded", "restored"])
+        rows = []
+        for i, engine in enumerate(args.engines):
+            for j, mode in enumerate(("kill", "drain")):
+                snapshot = os.path.join(directory, f"storm-{engine}-{mode}.bin")
+                rows.append(_storm_run(engine, args.port + 10 * i + j, mode, args, snapshot))
+        report(f"Redeploy with {args.clients} connected clients, {args.messages} stored messages "
+               f"(drain jitter {args.jitter:g}s; seconds from the signal)",
+               rows, ["engine", "shutdown", "old gone s", "new up s", "rejoined", "peak joins/s",
+                      "failed tries", "p50 s", "p99 s", "history kept"])
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+# ===========================
+# CLI
+# ===========================
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Secure Chat micro-benchmarks")
+    sub = parser.add_subparsers(dest="scenario", required=True)
+
+    p = sub.add_parser("contention", help="store throughput as concurrent rooms grow")
+    p.add_argument("--rooms", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    p.add_argument("--ops", type=int, default=200)
+    p.add_argument("--hold", type=float, default=0.0005, help="seconds each writer yields while holding the lock")
+    p.add_argument("--stripes", type=int, default=E2EE.LOCK_STRIPES)
+    p.set_defaults(func=bench_contention)
+
+    p = sub.add_parser("memory", help="bytes per stored message, dict layout vs RoomLog")
+    p.add_argument("--messages", type=int, default=1_000_000)
+    p.add_argument("--rooms", type=int, default=1000)
+    p.add_argument("--users", type=int, default=50)
+    p.add_argument("--length", type=int, default=64, help="ciphertext length in bytes")
+    p.set_defaults(func=bench_memory)
+
+    p = sub.add_parser("broker", help="cross-worker broadcast latency through the broker")
+    p.add_argument("--count", type=int, default=5000)
+    p.add_argument("--workers", type=int, nargs="+", default=[2, 4, 8])
+    p.add_argument("--interval", type=float, default=0.0002, help="seconds between publishes")
+    p.set_defaults(func=bench_broker)
+
+    p = sub.add_parser("wire", help="bandwidth and CPU of the base64 string vs binary payload path")
+    p.add_argument("--count", type=int, default=20_000)
+    p.add_argument("--words", type=int, nargs="+", default=[8, 64, 512], help="words per message")
+    p.set_defaults(func=bench_wire)
+
+    p = sub.add_parser("metrics", help="cost of the /metrics instrumentation per message")
+    p.add_argument("--count", type=int, default=1_000_000)
+    p.add_argument("--e2e-count", type=int, default=100_000)
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(func=bench_metrics)
+
+    p = sub.add_parser("metrics-worker", help=argparse.SUPPRESS)
+    p.add_argument("--count", type=int, default=100_000)
+    p.set_defaults(func=bench_metrics_worker)
+
+    p = sub.add_parser("durable", help="write throughput with persistence on/off and recovery time")
+    p.add_argument("--count", type=int, default=200_000)
+    p.add_argument("--recover", type=int, default=1_000_000, help="messages to write, then replay")
+    p.add_argument("--rooms", type=int, default=1000)
+    p.set_defaults(func=bench_durable)
+
+    p = sub.add_parser("budget", help="flood rooms and check stored bytes stay under the memory budget")
+    p.add_argument("--count", type=int, default=40_000)
+    p.add_argument("--rooms", type=int, default=20_000, help="throwaway rooms to spray")
+    p.add_argument("--min-size", type=int, default=256)
+    p.add_argument("--max-size", type=int, default=8192)
+    p.add_argument("--budget", type=int, nargs="+", default=[16, 64], help="budgets to test, in MiB")
+    p.add_argument("--room-cap", type=int, default=4, help="per-room cap in MiB")
+    p.set_defaults(func=bench_budget)
+
+    p = sub.add_parser("engines", help="connections, memory per idle connection and broadcast latency per engine")
+    p.add_argument("--engines", nargs="+", default=["eventlet", "threading", "asgi"])
+    p.add_argument("--idle", type=int, default=500, help="idle connections to open")
+    p.add_argument("--listeners", type=int, default=50)
+    p.add_argument("--messages", type=int, default=200)
+    p.add_argument("--interval", type=float, default=0.005, help="seconds between broadcasts")
+    p.add_argument("--port", type=int, default=5290)
+    p.set_defaults(func=bench_engines)
+
+    p = sub.add_parser("pages", help="requests/sec and bytes per page view, inline vs static assets")
+    p.add_argument("--count", type=int, default=3000)
+    p.set_defaults(func=bench_pages)
+
+    p = sub.add_parser("render", help="headless Chromium: render N messages, old renderer vs virtualized (needs playwright)")
+    p.add_argument("--count", type=int, default=50_000)
+    p.add_argument("--chunk", type=int, default=200, help="messages delivered between frames")
+    p.add_argument("--text", default="meet me at the usual place at 9")
+    p.add_argument("--cpu-slowdown", type=float, default=1.0, help="CDP CPU throttling, e.g. 4 for a phone")
+    p.set_defaults(func=bench_render)
+
+    p = sub.add_parser("attachments", help="server RSS while uploading and downloading large attachments")
+    p.add_argument("--engines", nargs="+", default=["eventlet", "threading"])
+    p.add_argument("--sizes", nargs="+", type=int, default=[16, 128, 512], help="file sizes in MiB")
+    p.add_argument("--port", type=int, default=5390)
+    p.set_defaults(func=bench_attachments)
+
+    p = sub.add_parser("roomids", help="room code allocation rate and collisions with many live rooms")
+    p.add_argument("--live", type=int, default=10_000_000, help="live rooms already allocated")
+    p.add_argument("--count", type=int, default=1_000_000, help="codes to allocate")
+    p.add_argument("--lengths", nargs="+", type=int, default=[6, 8])
+    p.add_argument("--pool", type=int, default=E2EE.ROOM_ID_POOL)
+    p.set_defaults(func=bench_roomids)
+
+    p = sub.add_parser("transport", help="WebSocket deflate: bytes, CPU and idle connections per config; adaptive pings")
+    p.add_argument("--engines", nargs="+", default=["eventlet", "threading", "asgi"])
+    p.add_argument("--words", nargs="+", type=int, default=[3, 12, 40], help="message sizes for the codec table")
+    p.add_argument("--idle", type=int, default=300)
+    p.add_argument("--listeners", type=int, default=20)
+    p.add_argument("--messages", type=int, default=300)
+    p.add_argument("--message-words", type=int, default=12)
+    p.add_argument("--interval", type=float, default=0.005)
+    p.add_argument("--heartbeat-clients", type=int, default=50)
+    p.add_argument("--heartbeat-seconds", type=float, default=30, help="0 skips the heartbeat run")
+    p.add_argument("--port", type=int, default=5400)
+    p.set_defaults(func=bench_transport)
+
+    p = sub.add_parser("drain", help="snapshot/restore time and the reconnect storm after SIGTERM vs a hard kill")
+    p.add_argument("--counts", nargs="+", type=int, default=[100_000, 1_000_000], help="stored messages")
+    p.add_argument("--rooms", type=int, default=10_000)
+    p.add_argument("--engines", nargs="+", default=["eventlet"])
+    p.add_argument("--clients", type=int, default=300)
+    p.add_argument("--messages", type=int, default=200, help="stored in the storm room before the restart")
+    p.add_argument("--jitter", type=float, default=E2EE.DRAIN_JITTER_SECONDS)
+    p.add_argument("--port", type=int, default=5500)
+    p.set_defaults(func=bench_drain)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
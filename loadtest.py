@@ -0,0 +1,533 @@
+# loadtest.py - Load generator and latency benchmark for the Secure Chat server (E2EE.py)
+#
+# Starts E2EE.py on a local port and drives simulated Socket.IO clients
+# through the real 'join'/'message' events, then reports fan-out latency,
+# throughput and server CPU/RSS. Results are written as JSON so runs can be
+# compared between releases.
+#
+# Usage:  python loadtest.py rooms --clients 1000 --rooms 200 --json out.json
+#         python loadtest.py huge --clients 2000 --senders 10
+#         python loadtest.py reconnect --clients 1000 --waves 5
+#         python loadtest.py soak --clients 3000 --duration 120
+#         python loadtest.py compare old.json new.json
+#
+# Clients are plain asyncio websockets speaking Engine.IO 4 / Socket.IO 5, so
+# a single load process can hold thousands of them; only Linux /proc is used
+# to sample the server.
+
+# ===========================
+# Standard Library Imports
+# ===========================
+import os
+import sys
+import time
+import json
+import base64
+import socket
+import random
+import asyncio
+import argparse
+import platform
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+# ===========================
+# Minimal websocket client
+# ===========================
+class Closed(Exception):
+    pass
+
+
+class WebSocket:
+    """RFC 6455 client over asyncio streams: text frames, ping/pong, close."""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    @classmethod
+    async def connect(cls, host, port, path):
+        reader, writer = await asyncio.open_connection(host, port)
+        key = base64.b64encode(os.urandom(16)).decode()
+        writer.write((f"GET {path} HTTP/1.1\r\nHost: {host}:{port}\r\nUpgrade: websocket\r\n"
+                      f"Connection: Upgrade\r\nSec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n\r\n").encode())
+        head = await reader.readuntil(b"\r\n\r\n")
+        if not head.startswith(b"HTTP/1.1 101"):
+            writer.close()
+            raise ConnectionError(head.split(b"\r\n", 1)[0].decode(errors="replace"))
+        return cls(reader, writer)
+
+    def send(self, text, opcode=0x1):
+        data = text.encode() if isinstance(text, str) else text
+        n = len(data)
+        if n < 126:
+            header = bytes((0x80 | opcode, 0x80 | n))
+        elif n < 1 << 16:
+            header = bytes((0x80 | opcode, 0x80 | 126)) + n.to_bytes(2, "big")
+        else:
+            header = bytes((0x80 | opcode, 0x80 | 127)) + n.to_bytes(8, "big")
+        mask = os.urandom(4)
+        # Client frames must be masked; XOR as one big integer instead of per byte
+        pad = (mask * (n // 4 + 1))[:n]
+        masked = (int.from_bytes(data, "big") ^ int.from_bytes(pad, "big")).to_bytes(n, "big") if n else b""
+        self.writer.write(header + mask + masked)
+
+    async def recv(self):
+        """Return the next text (str) or binary (bytes) message."""
+        parts, first = [], None
+        while True:
+            b0, b1 = await self.reader.readexactly(2)
+            opcode, n = b0 & 0x0F, b1 & 0x7F
+            if n == 126:
+                n = int.from_bytes(await self.reader.readexactly(2), "big")
+            elif n == 127:
+                n = int.from_bytes(await self.reader.readexactly(8), "big")
+            payload = await self.reader.readexactly(n) if n else b""
+            if opcode == 0x8:
+                raise Closed()
+            if opcode == 0x9:
+                self.send(payload, opcode=0xA)
+                continue
+            if opcode == 0xA:
+                continue
+            if first is None:
+                first = opcode
+            parts.append(payload)
+            if b0 & 0x80:
+                data = b"".join(parts)
+                return data.decode() if first == 0x1 else data
+
+    def close(self):
+        try:
+            self.send(b"", opcode=0x8)
+        except Exception:
+            pass
+        self.writer.close()
+
+
+class ChatClient:
+    """One simulated user: a Socket.IO connection in one room."""
+
+    def __init__(self, name, room):
+        self.name = name
+        self.room = room
+        self.ws = None
+        self.joined = None      # asyncio.Event set when the join's 'history' arrives
+        self.reader = None
+
+    async def connect(self, port, on_event):
+        self.ws = await WebSocket.connect("127.0.0.1", port, "/socket.io/?EIO=4&transport=websocket")
+        if not (await self.ws.recv()).startswith("0"):      # Engine.IO open
+            raise ConnectionError("no Engine.IO open packet")
+        self.ws.send("40")                                   # Socket.IO connect to "/"
+        while not (await self.ws.recv()).startswith("40"):
+            pass
+        self.joined = asyncio.Event()
+        self.reader = asyncio.ensure_future(self._read(on_event))
+        self.emit("join", {"room": self.room, "username": self.name})
+        await self.joined.wait()
+
+    def emit(self, event, data):
+        self.ws.send("42" + json.dumps([event, data]))
+
+    async def _read(self, on_event):
+        try:
+            while True:
+                frame = await self.ws.recv()
+                if frame == "2":
+                    self.ws.send("3")        # heartbeat
+                elif isinstance(frame, str) and frame.startswith("42"):
+                    event = json.loads(frame[2:])
+                    if event[0] == "history":
+                        self.joined.set()
+                    on_event(self, event[0], event[1] if len(event) > 1 else None)
+        except (Closed, asyncio.IncompleteReadError, ConnectionError):
+            pass
+
+    async def close(self):
+        if self.reader is not None:
+            self.reader.cancel()
+        if self.ws is not None:
+            self.ws.close()
+
+
+# ===========================
+# Server under test
+# ===========================
+class Server:
+    """E2EE.py in a subprocess, sampled through /proc."""
+
+    def __init__(self, port, engine, env):
+        self.port = port
+        self.engine = engine
+        self.env = dict(os.environ, PORT=str(port), **env)
+        if engine:
+            self.env["E2EE_ENGINE"] = engine
+        self.proc = None
+        self.rss_peak = 0
+        self._cpu_mark = None
+
+    def start(self):
+        self.proc = subprocess.Popen([sys.executable, "-W", "ignore", os.path.join(HERE, "E2EE.py")], env=self.env,
+                                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        deadline = time.time() + 30
+        while time.time() < deadline:
+            if self.proc.poll() is not None:
+                raise RuntimeError(f"E2EE.py exited with status {self.proc.returncode}")
+            try:
+                socket.create_connection(("127.0.0.1", self.port), timeout=0.5).close()
+                return self
+            except OSError:
+                time.sleep(0.1)
+        self.stop()
+        raise RuntimeError(f"E2EE.py did not listen on port {self.port}")
+
+    def stop(self):
+        if self.proc is not None:
+            self.proc.kill()
+            self.proc.wait()
+
+    def rss(self):
+        with open(f"/proc/{self.proc.pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    value = int(line.split()[1]) * 1024
+                    self.rss_peak = max(self.rss_peak, value)
+                    return value
+        return 0
+
+    def cpu_seconds(self):
+        with open(f"/proc/{self.proc.pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+    def mark(self):
+        """Start a CPU measurement window."""
+        self._cpu_mark = (time.perf_counter(), self.cpu_seconds())
+
+    def cpu_percent(self):
+        """Server CPU since mark(), in percent of one core."""
+        wall, cpu = self._cpu_mark
+        return (self.cpu_seconds() - cpu) / max(1e-9, time.perf_counter() - wall) * 100.0
+
+
+# ===========================
+# Measurement
+# ===========================
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    k = min(len(sorted_values) - 1, int(round(pct / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[k]
+
+
+def summarize(samples):
+    """Latency summary in milliseconds."""
+    s = sorted(samples)
+    return {"count": len(s), "p50": percentile(s, 50) * 1e3, "p99": percentile(s, 99) * 1e3,
+            "p999": percentile(s, 99.9) * 1e3, "max": (s[-1] * 1e3) if s else 0.0}
+
+
+class Recorder:
+    """Collects publish->receive delays of chat messages stamped by senders."""
+
+    def __init__(self):
+        self.latencies = []
+        self.deliveries = 0
+
+    def on_event(self, client, name, data):
+        if name == "message":
+            self._record(client, data)
+        elif name == "messages":             # E2EE_BATCH_WINDOW_MS > 0
+            for item in data.get("messages", ()):
+                self._record(client, item)
+
+    def _record(self, client, data):
+        msg = data.get("msg") if isinstance(data, dict) else None
+        if msg and msg.startswith("t:") and data.get("user") != client.name:
+            self.deliveries += 1
+            self.latencies.append(time.perf_counter() - float(msg[2:]))
+
+
+async def open_clients(port, specs, on_event, concurrency):
+    """Connect ChatClient(name, room) for each spec, `concurrency` handshakes at a time."""
+    gate = asyncio.Semaphore(concurrency)
+    connect_times, errors = [], []
+
+    async def one(name, room):
+        async with gate:
+            c = ChatClient(name, room)
+            t0 = time.perf_counter()
+            try:
+                await asyncio.wait_for(c.connect(port, on_event), 30)
+            except Exception as e:
+                errors.append(type(e).__name__)
+                await c.close()
+                return None
+            connect_times.append(time.perf_counter() - t0)
+            return c
+    clients = await asyncio.gather(*(one(n, r) for n, r in specs))
+    return [c for c in clients if c is not None], connect_times, errors
+
+
+async def send_load(senders, rate, duration):
+    """Each sender emits `rate` stamped messages per second for `duration` seconds."""
+    interval = 1.0 / rate
+    sent = 0
+
+    async def run(c):
+        nonlocal sent
+        # Spread senders across the interval so they do not fire in lockstep
+        await asyncio.sleep(random.random() * interval)
+        next_at = time.perf_counter()
+        stop = next_at + duration
+        while next_at < stop:
+            c.emit("message", {"room": c.room, "user": c.name, "msg": f"t:{time.perf_counter()!r}"})
+            sent += 1
+            next_at += interval
+            await asyncio.sleep(max(0.0, next_at - time.perf_counter()))
+    await asyncio.gather(*(run(c) for c in senders))
+    return sent
+
+
+# ===========================
+# Scenarios
+# ===========================
+async def traffic(server, args, rooms):
+    """Shared body of the 'rooms' and 'huge' scenarios."""
+    rec = Recorder()
+    specs = [(f"u{i}", f"LT{i % rooms:05d}") for i in range(args.clients)]
+    clients, connect_times, errors = await open_clients(server.port, specs, rec.on_event, args.concurrency)
+    if args.senders:
+        senders = clients[:args.senders]
+    else:
+        # One sender per room
+        seen, senders = set(), []
+        for c in clients:
+            if c.room not in seen:
+                seen.add(c.room)
+                senders.append(c)
+    await asyncio.sleep(0.5)
+    server.mark()
+    cpu0 = time.process_time()
+    t0 = time.perf_counter()
+    sent = await send_load(senders, args.rate, args.duration)
+    await asyncio.sleep(args.drain)
+    elapsed = time.perf_counter() - t0
+    result = {
+        "clients": len(clients),
+        "rooms": rooms,
+        "senders": len(senders),
+        "messages_sent": sent,
+        "deliveries": rec.deliveries,
+        "expected_deliveries": round(sum(sum(1 for c in clients if c.room == s.room) - 1 for s in senders)
+                                     * args.rate * args.duration),
+        "sent_per_sec": sent / args.duration,
+        "delivered_per_sec": rec.deliveries / elapsed,
+        "latency_ms": summarize(rec.latencies),
+        "connect_ms": summarize(connect_times),
+        "connect_errors": len(errors),
+        "server": {"cpu_percent": server.cpu_percent(), "rss_mb": server.rss() / 2**20},
+        "loadgen_cpu_percent": (time.process_time() - cpu0) / elapsed * 100.0,
+    }
+    for c in clients:
+        await c.close()
+    return result
+
+
+async def scenario_rooms(server, args):
+    """Many small rooms, one sender each."""
+    return await traffic(server, args, args.rooms)
+
+
+async def scenario_huge(server, args):
+    """Every client in one room; a few senders fan out to all of them."""
+    return await traffic(server, args, 1)
+
+
+async def scenario_reconnect(server, args):
+    """All clients drop and reconnect at once, `waves` times; measures rejoin time."""
+    rec = Recorder()
+    specs = [(f"u{i}", f"LT{i % args.rooms:05d}") for i in range(args.clients)]
+    clients, _, errors = await open_clients(server.port, specs, rec.on_event, args.concurrency)
+    server.mark()
+    waves = []
+    for _ in range(args.waves):
+        for c in clients:
+            await c.close()
+        t0 = time.perf_counter()
+        # Everyone at once: no handshake throttling beyond the listen backlog
+        clients, times, errs = await open_clients(server.port, specs, rec.on_event, len(specs))
+        waves.append({"storm_seconds": time.perf_counter() - t0, "reconnected": len(clients),
+                      "errors": len(errs), "rejoin_ms": summarize(times)})
+        errors += errs
+        await asyncio.sleep(args.pause)
+    result = {
+        "clients": args.clients,
+        "rooms": args.rooms,
+        "waves": waves,
+        "reconnect_errors": len(errors),
+        "server": {"cpu_percent": server.cpu_percent(), "rss_mb": server.rss() / 2**20},
+    }
+    for c in clients:
+        await c.close()
+    return result
+
+
+async def scenario_soak(server, args):
+    """Idle connections held for `duration`; server RSS/CPU sampled over time."""
+    rec = Recorder()
+    rss0 = server.rss()
+    specs = [(f"u{i}", f"LT{i % args.rooms:05d}") for i in range(args.clients)]
+    clients, connect_times, errors = await open_clients(server.port, specs, rec.on_event, args.concurrency)
+    server.mark()
+    samples = []
+    t0 = time.perf_counter()
+    while time.perf_counter() - t0 < args.duration:
+        await asyncio.sleep(args.sample)
+        alive = sum(1 for c in clients if not c.reader.done())
+        samples.append({"t": round(time.perf_counter() - t0, 1), "rss_mb": server.rss() / 2**20, "alive": alive})
+    alive = sum(1 for c in clients if not c.reader.done())
+    result = {
+        "clients": len(clients),
+        "rooms": args.rooms,
+        "alive_at_end": alive,
+        "connect_ms": summarize(connect_times),
+        "connect_errors": len(errors),
+        "rss_per_connection_kb": (server.rss() - rss0) / max(1, len(clients)) / 1024,
+        "server": {"cpu_percent": server.cpu_percent(), "rss_mb": server.rss() / 2**20},
+        "samples": samples,
+    }
+    for c in clients:
+        await c.close()
+    return result
+
+
+SCENARIOS = {
+    "rooms": scenario_rooms,
+    "huge": scenario_huge,
+    "reconnect": scenario_reconnect,
+    "soak": scenario_soak,
+}
+
+
+# ===========================
+# Reporting
+# ===========================
+def git_revision():
+    try:
+        return subprocess.run(["git", "-C", HERE, "describe", "--always", "--dirty"],
+                              capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def flatten(value, prefix=""):
+    """{'a': {'b': 1}} -> {'a.b': 1}; lists are left out."""
+    out = {}
+    for k, v in value.items():
+        key = f"{prefix}{k}"
+        if isinstance(v, dict):
+            out.update(flatten(v, key + "."))
+        elif isinstance(v, (int, float)) and not isinstance(v, bool):
+            out[key] = v
+    return out
+
+
+def print_result(doc):
+    print(f"\n=== {doc['scenario']} ({doc['engine'] or 'auto'} engine, {doc['revision'] or 'unknown revision'}) ===")
+    for key, value in flatten(doc["result"]).items():
+        print(f"{key:>32}  {value:,.2f}" if isinstance(value, float) else f"{key:>32}  {value:,}")
+
+
+def compare(args):
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    a, b = flatten(old["result"]), flatten(new["result"])
+    print(f"\n=== {old['scenario']}: {old['revision']} -> {new['revision']} ===")
+    print(f"{'metric':>32}  {'old':>12}  {'new':>12}  {'change':>8}")
+    for key in a:
+        if key in b:
+            change = f"{(b[key] / a[key] - 1) * 100:+.1f}%" if a[key] else ""
+            print(f"{key:>32}  {a[key]:>12,.2f}  {b[key]:>12,.2f}  {change:>8}")
+
+
+def run(args):
+    env = {} if args.keep_rate_limits else {"E2EE_RATE_PER_SID": "0", "E2EE_RATE_PER_USER": "0"}
+    for item in args.env:
+        key, _, value = item.partition("=")
+        env[key] = value
+    server = Server(args.port, args.engine, env).start()
+    try:
+        result = asyncio.run(SCENARIOS[args.scenario](server, args))
+        result.setdefault("server", {})["rss_peak_mb"] = server.rss_peak / 2**20
+    finally:
+        server.stop()
+    params = {k: v for k, v in vars(args).items() if k not in ("func", "json")}
+    doc = {
+        "scenario": args.scenario,
+        "engine": args.engine,
+        "revision": git_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "host": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+        "params": params,
+        "result": result,
+    }
+    print_result(doc)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(doc, f, indent=2)
+        print(f"\nwrote {args.json}")
+
+
+# ===========================
+# CLI
+# ===========================
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Secure Chat load tester")
+    sub = parser.add_subparsers(dest="scenario", required=True)
+
+    def scenario(name, help, clients, rooms):
+        p = sub.add_parser(name, help=help)
+        p.add_argument("--clients", type=int, default=clients)
+        p.add_argument("--rooms", type=int, default=rooms)
+        p.add_argument("--engine", choices=["eventlet", "threading", "asgi"], help="E2EE_ENGINE for the server")
+        p.add_argument("--port", type=int, default=5390)
+        p.add_argument("--concurrency", type=int, default=100, help="handshakes in flight while connecting")
+        p.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="extra server environment")
+        p.add_argument("--keep-rate-limits", action="store_true", help="leave the per-sid/user rate limits on")
+        p.add_argument("--json", help="write machine-readable results here")
+        p.set_defaults(func=run)
+        return p
+
+    for name, help, clients, rooms in (("rooms", "many small rooms, one sender each", 1000, 200),
+                                       ("huge", "one room holding every client", 1000, 1)):
+        p = scenario(name, help, clients, rooms)
+        p.add_argument("--senders", type=int, default=0 if name == "rooms" else 5, help="0 = one per room")
+        p.add_argument("--rate", type=float, default=2.0, help="messages per second per sender")
+        p.add_argument("--duration", type=float, default=20.0)
+        p.add_argument("--drain", type=float, default=2.0, help="seconds to wait for deliveries after sending")
+
+    p = scenario("reconnect", "everyone disconnects and reconnects at once", 1000, 100)
+    p.add_argument("--waves", type=int, default=3)
+    p.add_argument("--pause", type=float, default=2.0, help="seconds between storms")
+
+    p = scenario("soak", "idle connections held open, server sampled over time", 2000, 400)
+    p.add_argument("--duration", type=float, default=120.0, help="longer than the 25s ping interval")
+    p.add_argument("--sample", type=float, default=5.0)
+
+    p = sub.add_parser("compare", help="diff two --json result files")
+    p.add_argument("old")
+    p.add_argument("new")
+    p.set_defaults(func=compare)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])